@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+batch.py
+
+Offline batch transcription of local audio files, without going
+through a Google Drive folder.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .concurrency import ConcurrencyLimits
+from .manifest import describe_file, wav_duration
+from .retry import APIError, FatalError, RetryableError, call_with_retries
+from .transcribe import (APP_CACHE_DIR, CONCURRENCY_LIMITS, RETRY_BASE_SECS,
+                         RETRY_MAX_ATTEMPTS, RETRY_MAX_SECS,
+                         convert_input_to_wav, get_speech_service,
+                         get_storage_service, mkdir_p,
+                         poll_transcription_results, probe_audio,
+                         storage_delete_object, storage_object_matches,
+                         storage_upload_object, submit_transcription_request,
+                         trim_silence, write_transcription)
+
+logger = logging.getLogger(__name__)
+
+# extensions of audio files, for files which mimetypes does not know
+AUDIO_EXTENSIONS = frozenset([
+    '.3gp', '.aac', '.aiff', '.amr', '.flac', '.m4a', '.mp3', '.ogg',
+    '.opus', '.wav', '.wma'])
+
+# how often to poll the Speech API for submitted files
+POLL_SECS = 10
+
+# how often to log progress
+PROGRESS_SECS = 30
+
+
+class BatchError(Exception):
+    '''A file which could not be prepared for transcription.'''
+    pass
+
+
+def is_audio_file(path):
+    '''
+    Returns True if the file at `path` looks like an audio recording.
+
+    Arguments:
+    - `path`:
+    '''
+    mimetype, _encoding = mimetypes.guess_type(path)
+    return ((mimetype or '').startswith('audio/') or
+            os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS)
+
+
+def transcription_path_for(input_path, root, output_dir=None):
+    '''
+    Returns where the transcription of the audio file `input_path`
+    should be written: next to the file, or if `output_dir` is given,
+    at the same path relative to `output_dir` as the file has relative
+    to `root`.
+
+    Arguments:
+    - `input_path`:
+    - `root`: the directory given on the command line
+    - `output_dir`:
+    '''
+    txt_path = os.path.splitext(input_path)[0] + '.txt'
+    if output_dir is None:
+        return txt_path
+    return os.path.join(os.path.abspath(output_dir),
+                        os.path.relpath(txt_path, root))
+
+
+def find_audio_files(paths, output_dir=None):
+    '''
+    Returns a list of (input path, transcription path) pairs for the
+    audio files in `paths`.  Files are taken as they are; directories
+    are searched recursively for audio files.
+
+    Arguments:
+    - `paths`: a list of files and directories
+    - `output_dir`: see `transcription_path_for`
+    '''
+    found = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            found.append((path, transcription_path_for(
+                path, os.path.dirname(path), output_dir)))
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                input_path = os.path.join(dirpath, filename)
+                if is_audio_file(input_path):
+                    found.append((input_path, transcription_path_for(
+                        input_path, path, output_dir)))
+    return found
+
+
+class BatchManifest(dict):
+    '''
+    The progress of a batch, keyed by input path, backed by a file
+    with one JSON object per line.  Each update appends one line, so
+    that recording the progress of one file does not rewrite the
+    entries of thousands of others; the file is compacted when it is
+    loaded.  Updates may come from several threads.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Constructor.
+
+        Arguments:
+        - `filename`:
+        '''
+        super(BatchManifest, self).__init__()
+        self._filename = filename
+        self._lock = threading.Lock()
+        num_lines = 0
+        try:
+            with open(filename, 'rb') as input_file:
+                for line in input_file:
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    self[entry['path']] = entry
+                    num_lines += 1
+        except IOError:
+            pass
+        if num_lines > len(self):
+            with open(filename, 'wb') as output_file:
+                for entry in self.values():
+                    output_file.write(self._encode(entry))
+        self._file = open(filename, 'ab')
+
+    @staticmethod
+    def _encode(entry):
+        return (json.dumps(entry, sort_keys=True, ensure_ascii=False) +
+                '\n').encode('utf-8')
+
+    def update_entry(self, path, **values):
+        '''
+        Updates the entry for the input file `path` with `values`, and
+        records it in the manifest file.  Returns the new entry.
+
+        Arguments:
+        - `path`:
+        '''
+        with self._lock:
+            entry = dict(self.get(path, {}), path=path, **values)
+            self[path] = entry
+            self._file.write(self._encode(entry))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        return entry
+
+    def close(self):
+        '''Closes the manifest file.'''
+        self._file.close()
+
+
+class ThreadServices(threading.local):
+    '''
+    The Google API services used by the current thread; each thread
+    needs its own, as their HTTP connections cannot be shared.
+    '''
+
+    def __init__(self, service_account):
+        '''
+        Constructor.
+
+        Arguments:
+        - `service_account`:
+        '''
+        super(ThreadServices, self).__init__()
+        self.storage = get_storage_service(service_account)
+        self.speech = get_speech_service(service_account)
+
+
+def call_api(func, *args, **kwargs):
+    '''
+    Calls the Google API helper function `func` with the given
+    arguments, blocking to retry after transient failures.
+
+    Arguments:
+    - `func`:
+    '''
+    return call_with_retries(lambda: func(*args, **kwargs),
+                             max_attempts=RETRY_MAX_ATTEMPTS,
+                             base_secs=RETRY_BASE_SECS,
+                             max_secs=RETRY_MAX_SECS)
+
+
+@contextmanager
+def limited(limit, key, work=None):
+    '''
+    Context manager which runs the block as the operation `key` of the
+    `AIMDLimit` `limit`, waiting until the limit allows it.  A
+    `RetryableError` raised in the block counts as congestion.
+
+    Arguments:
+    - `limit`:
+    - `key`:
+    - `work`: see `AIMDLimit.release`
+    '''
+    limit.acquire(key)
+    try:
+        yield
+    except RetryableError:
+        limit.release(key, ok=False)
+        raise
+    except BaseException:
+        limit.discard(key)
+        raise
+    limit.release(key, work=work)
+
+
+class BatchRun(object):
+    '''
+    Transcribes a list of local audio files.  A pool of worker threads
+    transcodes, trims and uploads the files and submits them to the
+    Speech API; the main thread polls the submitted files and writes
+    their transcriptions.  The number of transcodes, uploads and
+    Speech API operations in flight is adjusted to the observed
+    latency, errors and system load (see `concurrency.AIMDLimit`).
+    Each step is recorded in a `BatchManifest`, so that a rerun skips
+    finished files and picks up submitted ones.
+    '''
+
+    def __init__(self, settings, manifest_path, num_workers=4):
+        '''
+        Constructor.
+
+        Arguments:
+        - `settings`: a `FolderConfig` giving the bucket, language,
+          phrases and service account
+        - `manifest_path`:
+        - `num_workers`: the largest number of files prepared at once
+        '''
+        self.settings = settings
+        self.manifest = BatchManifest(manifest_path)
+        self.num_workers = num_workers
+        limit_settings = dict(CONCURRENCY_LIMITS)
+        for name in ('transcode', 'upload'):
+            limit_settings[name] = dict(
+                limit_settings[name],
+                initial=min(limit_settings[name].get('initial', num_workers),
+                            num_workers),
+                maximum=num_workers)
+        self.limits = ConcurrencyLimits(limit_settings)
+        self.services = ThreadServices(settings.service_account)
+        self.scratch_dir = os.path.join(APP_CACHE_DIR, 'batch', 'scratch')
+        mkdir_p(self.scratch_dir)
+        self.start_time = None
+        self.num_total = 0
+        self.num_done = 0
+        self.num_failed = 0
+        self.audio_secs_done = 0.0
+
+    def scratch_path(self, input_path, suffix):
+        '''
+        Returns a path in the scratch directory for an intermediate
+        file of `input_path`.  The name includes a hash of the input
+        path, as inputs in different directories may share a name;
+        it also becomes the name of the Cloud Storage object.
+
+        Arguments:
+        - `input_path`:
+        - `suffix`: e.g., '.wav'
+        '''
+        digest = hashlib.md5(input_path.encode('utf-8')).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(input_path))[0]
+        return os.path.join(self.scratch_dir,
+                            '{}-{}{}'.format(digest, stem, suffix))
+
+    @staticmethod
+    def input_signature(input_path):
+        '''
+        Returns the size and modification time of `input_path`, used
+        to notice inputs which changed since they were transcribed.
+
+        Arguments:
+        - `input_path`:
+        '''
+        stat = os.stat(input_path)
+        return {'input_size': stat.st_size, 'input_mtime': stat.st_mtime}
+
+    def is_current(self, input_path, entry):
+        '''
+        Returns True if the manifest `entry` describes the current
+        version of `input_path`.
+
+        Arguments:
+        - `input_path`:
+        - `entry`:
+        '''
+        signature = self.input_signature(input_path)
+        return all(entry.get(key) == value
+                   for key, value in signature.items())
+
+    def prepare(self, item):
+        '''
+        Runs in a worker thread: transcodes, trims and uploads one
+        file, and submits it to the Speech API.  Returns a pair of the
+        input path and an error message (None on success).
+
+        Arguments:
+        - `item`: an (input path, transcription path) pair
+        '''
+        input_path, transcription_path = item
+        wav_path = self.scratch_path(input_path, '.wav')
+        trimmed_path = self.scratch_path(input_path, '.trimmed.wav')
+        try:
+            signature = self.input_signature(input_path)
+            probe = probe_audio(input_path)
+            if probe is None:
+                raise BatchError('ffprobe cannot read the file')
+            with limited(self.limits['transcode'], input_path,
+                         work=probe['duration']):
+                if (convert_input_to_wav(input_path, wav_path, probe) != 0 or
+                        wav_duration(wav_path) is None):
+                    raise BatchError('ffmpeg could not convert the file')
+                if (trim_silence(wav_path, trimmed_path) != 0 or
+                        wav_duration(trimmed_path) is None):
+                    raise BatchError('sox could not trim the file')
+            os.remove(wav_path)
+            manifest = describe_file(trimmed_path, audio=True)
+            # recorded before the upload, so that the object is deleted
+            # if anything fails from here on, even in a later run
+            self.manifest.update_entry(
+                input_path, state='uploading',
+                object=os.path.basename(trimmed_path))
+            with limited(self.limits['upload'], input_path,
+                         work=manifest['size'] / 1024 ** 2):
+                response = call_api(storage_upload_object,
+                                    self.services.storage,
+                                    self.settings.bucket, trimmed_path)
+            if not storage_object_matches(response, manifest):
+                raise BatchError('uploaded object does not match the '
+                                 'local file')
+            os.remove(trimmed_path)
+            # the Speech API operation stays in flight until `collect`
+            speech_limit = self.limits['speech']
+            speech_limit.acquire(input_path)
+            try:
+                response = call_api(submit_transcription_request,
+                                    self.services.speech,
+                                    self.settings.bucket, trimmed_path,
+                                    phrases=self.settings.phrases,
+                                    language_code=self.settings.language)
+            except RetryableError:
+                speech_limit.release(input_path, ok=False)
+                raise
+            except BaseException:
+                speech_limit.discard(input_path)
+                raise
+            self.manifest.update_entry(
+                input_path, state='submitted', operation=response['name'],
+                object=os.path.basename(trimmed_path),
+                transcription=transcription_path,
+                duration=manifest['duration'], **signature)
+            return input_path, None
+        except Exception as exc:
+            logger.exception('Could not prepare %s', input_path)
+            for path in (wav_path, trimmed_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.discard_object(input_path)
+            self.manifest.update_entry(input_path, state='failed',
+                                       error=str(exc))
+            return input_path, str(exc)
+
+    def collect(self, input_path):
+        '''
+        Runs in the main thread: polls the Speech API for a submitted
+        file, and if it is finished, writes its transcription and
+        deletes its Cloud Storage object.  Returns True if the file
+        needs no more polling.
+
+        Arguments:
+        - `input_path`:
+        '''
+        entry = self.manifest[input_path]
+        try:
+            response = call_api(poll_transcription_results,
+                                self.services.speech, entry['operation'])
+        except FatalError as exc:
+            self.limits['speech'].discard(input_path)
+            return self.fail(input_path, str(exc))
+        except APIError as exc:
+            logger.warning('Could not poll %s: %s', input_path, exc)
+            return False
+        if not response.get('done'):
+            return False
+        if 'error' in response:
+            self.limits['speech'].release(input_path, ok=False)
+            return self.fail(input_path, 'Speech API: {}'.format(
+                response['error'].get('message', response['error'])))
+        self.limits['speech'].release(input_path, work=entry.get('duration'))
+        mkdir_p(os.path.dirname(entry['transcription']))
+        write_transcription(response, entry['transcription'])
+        self.discard_object(input_path)
+        self.manifest.update_entry(input_path, state='done')
+        self.num_done += 1
+        self.audio_secs_done += entry.get('duration') or 0.0
+        logger.info('Transcribed %s', input_path)
+        return True
+
+    def fail(self, input_path, error):
+        '''
+        Records that `input_path` could not be transcribed.  Returns
+        True.
+
+        Arguments:
+        - `input_path`:
+        - `error`:
+        '''
+        logger.error('Could not transcribe %s: %s', input_path, error)
+        self.discard_object(input_path)
+        self.manifest.update_entry(input_path, state='failed', error=error)
+        self.num_failed += 1
+        return True
+
+    def discard_object(self, input_path):
+        '''
+        Deletes the Cloud Storage object recorded for `input_path`, if
+        any, and drops it from the manifest.
+
+        Arguments:
+        - `input_path`:
+        '''
+        object_name = (self.manifest.get(input_path) or {}).get('object')
+        if not object_name:
+            return
+        try:
+            call_api(storage_delete_object, self.services.storage,
+                     self.settings.bucket, object_name)
+        except APIError as exc:
+            logger.warning('Could not delete gs://%s/%s: %s',
+                           self.settings.bucket, object_name, exc)
+            return
+        self.manifest.update_entry(input_path, object=None)
+
+    def log_progress(self, num_in_progress):
+        '''
+        Logs how many files are finished, the throughput so far, and
+        an estimate of the time remaining.
+
+        Arguments:
+        - `num_in_progress`:
+        '''
+        elapsed_secs = max(time.time() - self.start_time, 1e-6)
+        files_per_min = self.num_done * 60.0 / elapsed_secs
+        num_remaining = self.num_total - self.num_done - self.num_failed
+        if self.num_done:
+            eta = time.strftime(
+                '%H:%M:%S',
+                time.gmtime(num_remaining * elapsed_secs / self.num_done))
+        else:
+            eta = 'unknown'
+        logger.info('Batch: %d/%d done, %d failed, %d in progress; '
+                    '%.1f files/min, %.1f audio mins/min; ETA %s; '
+                    'in flight: %s',
+                    self.num_done, self.num_total, self.num_failed,
+                    num_in_progress, files_per_min,
+                    self.audio_secs_done / elapsed_secs, eta,
+                    self.limits.status())
+
+    def run(self, items):
+        '''
+        Transcribes the audio files `items`.  Returns the number of
+        files which failed.
+
+        Arguments:
+        - `items`: a list of (input path, transcription path) pairs
+        '''
+        todo = []
+        submitted = set()
+        num_skipped = 0
+        for input_path, transcription_path in items:
+            entry = self.manifest.get(input_path)
+            if entry is None or not self.is_current(input_path, entry):
+                # the object of an earlier attempt at an old version
+                self.discard_object(input_path)
+                todo.append((input_path, transcription_path))
+            elif (entry['state'] == 'done' and
+                  os.path.exists(entry['transcription'])):
+                num_skipped += 1
+            elif entry['state'] == 'submitted':
+                submitted.add(input_path)
+                self.limits['speech'].restore(input_path)
+            else:
+                # e.g., failed, or stopped during an upload
+                self.discard_object(input_path)
+                todo.append((input_path, transcription_path))
+        # smallest files first, to get the most transcriptions back
+        # soonest
+        todo.sort(key=lambda item: os.path.getsize(item[0]))
+        self.num_total = len(todo) + len(submitted)
+        logger.info('Batch: %d files to transcribe (%d already submitted), '
+                    '%d already done', self.num_total, len(submitted),
+                    num_skipped)
+
+        self.start_time = time.time()
+        results = queue.Queue()
+        pool = ThreadPool(self.num_workers)
+        for item in todo:
+            pool.apply_async(self.prepare, (item,), callback=results.put)
+        pool.close()
+        num_preparing = len(todo)
+        next_poll_time = next_progress_time = self.start_time
+        try:
+            while num_preparing or submitted:
+                try:
+                    input_path, error = results.get(timeout=1)
+                    num_preparing -= 1
+                    if error is None:
+                        submitted.add(input_path)
+                    else:
+                        self.num_failed += 1
+                except queue.Empty:
+                    pass
+                now = time.time()
+                if now >= next_poll_time:
+                    next_poll_time = now + POLL_SECS
+                    submitted.difference_update(
+                        [input_path for input_path in sorted(submitted)
+                         if self.collect(input_path)])
+                if now >= next_progress_time:
+                    next_progress_time = now + PROGRESS_SECS
+                    self.log_progress(num_preparing + len(submitted))
+        finally:
+            pool.terminate()
+            pool.join()
+            self.manifest.close()
+        self.log_progress(0)
+        return self.num_failed
+
+
+def run_batch(paths, settings, output_dir=None, num_workers=4,
+              manifest_path=None):
+    '''
+    Transcribes the audio files in `paths` (files, or directories to
+    search).  Returns the number of files which failed.
+
+    Arguments:
+    - `paths`:
+    - `settings`: a `FolderConfig`
+    - `output_dir`: where to write transcriptions (default: next to
+      the inputs)
+    - `num_workers`:
+    - `manifest_path`: where to record progress
+    '''
+    items = find_audio_files(paths, output_dir)
+    return BatchRun(settings, manifest_path, num_workers).run(items)
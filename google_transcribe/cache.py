@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+cache.py
+
+Size-capped management of the intermediate files which transcription
+jobs write into the cache directory.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import logging
+import os
+import time
+
+from .datastore import load_data, store_data
+
+logger = logging.getLogger(__name__)
+
+# Retention policies for kinds of artifact:
+# - delete the file as soon as its job no longer needs it
+RETAIN_UNTIL_CONSUMED = 'consumed'
+# - keep the file until the cache runs over its budget
+RETAIN_LRU = 'lru'
+
+
+class CacheManager(object):
+    '''
+    Keeps an index of the intermediate files (artifacts) in the cache
+    directory, together with their sizes and last access times, and
+    deletes them according to a per-kind retention policy and a total
+    byte budget.
+
+    Jobs declare which of their artifacts they still need (see
+    `set_needed`); such files are never evicted.  When the cache
+    exceeds its budget, the least recently used of the remaining
+    files are deleted.
+
+    Changes to the index are written to its file by `flush`, which
+    should be called regularly (e.g., once per iteration of the
+    polling loop), rather than once per change.
+    '''
+
+    def __init__(self, index_filename, budget_bytes=None, retention=None):
+        '''
+        Constructor.
+
+        Arguments:
+        - `index_filename`: path of the JSON file holding the index
+        - `budget_bytes`: the maximum total size of the cached
+          artifacts, or None for no limit
+        - `retention`: a dict mapping artifact kinds to retention
+          policies; kinds which are not listed use RETAIN_LRU
+        '''
+        self.index_filename = index_filename
+        self.is_new = not os.path.exists(index_filename)
+        self.index = {} if self.is_new else load_data(index_filename)
+        self._dirty = False
+        self.budget_bytes = budget_bytes
+        self.retention = dict(retention or {})
+        self.total_bytes = sum(entry['size'] for entry in self.index.values())
+        # job name -> set of artifact kinds that the job still needs
+        self._needed = {}
+        self._warned_full = False
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def flush(self):
+        '''Writes the index to its file, if it has changed.'''
+        if self._dirty:
+            store_data(self.index_filename, self.index)
+            self._dirty = False
+
+    def _is_needed(self, entry):
+        return entry['kind'] in self._needed.get(entry['job'], ())
+
+    def register(self, path, job_name, kind):
+        '''
+        Records a newly written artifact in the index, then evicts
+        files if the cache has run over its budget.
+
+        Arguments:
+        - `path`: the path of the artifact
+        - `job_name`: the job which produced the artifact
+        - `kind`: the kind of artifact (e.g., 'wav')
+        '''
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            logger.warning('Cannot register missing cache file %s', path)
+            return
+        if path in self.index:
+            self.total_bytes -= self.index[path]['size']
+        self.total_bytes += size
+        self.index[path] = {'job': job_name, 'kind': kind, 'size': size,
+                            'atime': time.time()}
+        self._dirty = True
+        self.enforce_budget()
+
+    def touch(self, path):
+        '''
+        Marks an artifact as recently used.
+
+        Arguments:
+        - `path`:
+        '''
+        if path in self.index:
+            self.index[path]['atime'] = time.time()
+            self._dirty = True
+
+    def set_needed(self, job_name, kinds):
+        '''
+        Declares which kinds of artifact a job still needs.  Artifacts
+        of this job which are no longer needed, and whose retention
+        policy is RETAIN_UNTIL_CONSUMED, are deleted immediately.
+
+        Arguments:
+        - `job_name`:
+        - `kinds`: an iterable of artifact kinds; pass an empty
+          iterable once the job is finished
+        '''
+        kinds = frozenset(kinds)
+        if kinds:
+            self._needed[job_name] = kinds
+        else:
+            self._needed.pop(job_name, None)
+        consumed = [path for path, entry in self.index.items()
+                    if entry['job'] == job_name and
+                    entry['kind'] not in kinds and
+                    self.retention.get(entry['kind'], RETAIN_LRU) ==
+                    RETAIN_UNTIL_CONSUMED]
+        for path in consumed:
+            self.remove(path)
+
+    def rename(self, path, new_path):
+        '''
+        Records that an artifact has been moved (e.g., from memory to
+        disk; see `scratch.ScratchSpace.spill`).
+
+        Arguments:
+        - `path`: the old path
+        - `new_path`:
+        '''
+        if path in self.index:
+            self.index[new_path] = self.index.pop(path)
+            self._dirty = True
+
+    def remove(self, path):
+        '''
+        Deletes an artifact and drops it from the index.
+
+        Arguments:
+        - `path`:
+        '''
+        try:
+            os.remove(path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                logger.warning('Could not delete cache file %s: %s', path,
+                               exc)
+                return
+        if path in self.index:
+            self.total_bytes -= self.index[path]['size']
+            del self.index[path]
+            self._dirty = True
+        logger.debug('Removed cache file %s', path)
+
+    def enforce_budget(self):
+        '''
+        Deletes the least recently used artifacts which are not needed
+        by an active job, until the cache is within its budget.
+        '''
+        if self.budget_bytes is None or self.total_bytes <= self.budget_bytes:
+            self._warned_full = False
+            return
+        candidates = sorted((entry['atime'], path)
+                            for path, entry in self.index.items()
+                            if not self._is_needed(entry))
+        for _atime, path in candidates:
+            if self.total_bytes <= self.budget_bytes:
+                break
+            logger.info('Evicting cache file %s', path)
+            self.remove(path)
+        if self.total_bytes > self.budget_bytes and not self._warned_full:
+            logger.warning('Cache holds %d bytes (budget %d), all of which '
+                           'are needed by active jobs', self.total_bytes,
+                           self.budget_bytes)
+            self._warned_full = True
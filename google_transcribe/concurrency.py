@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+concurrency.py
+
+Limits on the number of operations of each kind (uploads, transcodes,
+Speech API operations, ...) in flight at once, adjusted at runtime by
+additive increase, multiplicative decrease (as in TCP congestion
+control).
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def system_load():
+    '''
+    Returns the one-minute load average per CPU, or None where this is
+    not available.  On Linux, the load average counts processes
+    waiting for the disk as well as those waiting for a CPU.
+    '''
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (AttributeError, NotImplementedError, OSError):
+        return None
+
+
+class AIMDLimit(object):
+    '''
+    An adaptive limit on the number of operations in flight.
+
+    Operations are identified by a key (e.g., a job name) from
+    `try_acquire` or `acquire` until `release`.  On release, the
+    operation's latency is compared with the latency expected from
+    its work (e.g., megabytes or seconds of audio) at the baseline
+    rate: the lowest smoothed latency per unit of work seen, which
+    drifts back up towards the current one, so that an outlier or a
+    lasting change in the service does not leave it too low.  While
+    operations succeed in close to the expected time, the limit grows
+    by `increase` per limit's worth of operations; a failure (e.g.,
+    HTTP 429), a smoothed latency above `tolerance` times the
+    expected one, or a system load above `max_load` multiplies the
+    limit by `decrease`, at most once per `holdoff_secs`.  The limit
+    only grows while it is in use, so that an idle limit does not
+    drift up to `maximum`.
+    '''
+
+    def __init__(self, name, initial=4, minimum=1, maximum=64, increase=1.0,
+                 decrease=0.5, tolerance=2.0, holdoff_secs=10.0,
+                 resolution_secs=0.1, smoothing=0.2, baseline_decay=0.01,
+                 max_load=None, load=system_load, clock=time.time):
+        '''
+        Constructor.
+
+        Arguments:
+        - `name`: the kind of operation, for logging
+        - `initial`: the starting limit
+        - `minimum`:
+        - `maximum`:
+        - `increase`: added to the limit for each limit's worth of
+          successful operations
+        - `decrease`: factor applied to the limit on congestion
+        - `tolerance`: how many times the expected latency operations
+          may take before it counts as congestion
+        - `holdoff_secs`: the least time between decreases
+        - `resolution_secs`: the latency which cannot be told apart
+          from none (e.g., the interval at which the operation is
+          polled), allowed on top of the expected latency
+        - `smoothing`: the weight of each operation in the moving
+          averages of the latency
+        - `baseline_decay`: the fraction by which the baseline moves
+          towards the current latency per operation
+        - `max_load`: the system load (see `system_load`) above which
+          the limit is decreased, or None to ignore the load
+        - `load`: function returning the system load
+        - `clock`: function returning the current time in seconds
+        '''
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.holdoff_secs = holdoff_secs
+        self.resolution_secs = resolution_secs
+        self.smoothing = smoothing
+        self.baseline_decay = baseline_decay
+        self.max_load = max_load
+        self.load = load
+        self.clock = clock
+        self.in_flight = {}
+        # moving average of the latency per unit of work, and its
+        # (decaying) minimum
+        self.rate = None
+        self.baseline = None
+        # moving average of latencies relative to the expected ones
+        self.congestion = None
+        self.last_decrease_time = None
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        return '{} {}/{}'.format(self.name, len(self.in_flight),
+                                 self.capacity)
+
+    @property
+    def capacity(self):
+        '''The number of operations which may be in flight.'''
+        return max(self.minimum, int(self.limit))
+
+    def _try_acquire(self, key):
+        if key in self.in_flight:
+            return True
+        if len(self.in_flight) >= self.capacity:
+            return False
+        self.in_flight[key] = self.clock()
+        return True
+
+    def try_acquire(self, key):
+        '''
+        Starts the operation `key` if the limit allows it.  Returns
+        True if the operation may go ahead.
+
+        Arguments:
+        - `key`:
+        '''
+        with self._cond:
+            return self._try_acquire(key)
+
+    def acquire(self, key):
+        '''
+        Starts the operation `key`, waiting until the limit allows it.
+
+        Arguments:
+        - `key`:
+        '''
+        with self._cond:
+            while not self._try_acquire(key):
+                self._cond.wait(1.0)
+
+    def restore(self, key, start_time=None):
+        '''
+        Counts the operation `key`, which was started earlier (e.g.,
+        before a restart), as in flight, regardless of the limit.
+        Does nothing if it is already counted.
+
+        Arguments:
+        - `key`:
+        - `start_time`: when the operation started, if known
+        '''
+        with self._cond:
+            self.in_flight.setdefault(key, start_time)
+
+    def release(self, key, ok=True, work=None):
+        '''
+        Finishes the operation `key`, and adjusts the limit.
+
+        Arguments:
+        - `key`:
+        - `ok`: False if the operation failed in a way which suggests
+          congestion (e.g., a rate limit or a timeout)
+        - `work`: the size of the operation (e.g., megabytes or
+          seconds of audio), by which its latency is divided
+        '''
+        with self._cond:
+            if key not in self.in_flight:
+                return
+            saturated = len(self.in_flight) >= self.capacity
+            start_time = self.in_flight.pop(key)
+            if not ok:
+                self._decrease('failure')
+            elif start_time is not None:
+                self._observe(self.clock() - start_time, work or 1.0,
+                              saturated)
+            self._cond.notify_all()
+
+    def discard(self, key):
+        '''
+        Forgets the operation `key` (e.g., an abandoned job) without
+        adjusting the limit.
+
+        Arguments:
+        - `key`:
+        '''
+        with self._cond:
+            if self.in_flight.pop(key, False) is not False:
+                self._cond.notify_all()
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def _observe(self, latency, work, saturated):
+        self.rate = self._average(self.rate, latency / work)
+        if self.baseline is None or self.rate < self.baseline:
+            self.baseline = self.rate
+        else:
+            self.baseline += self.baseline_decay * (self.rate - self.baseline)
+        expected = self.baseline * work + self.resolution_secs
+        self.congestion = self._average(self.congestion, latency / expected)
+        if self.congestion > self.tolerance:
+            self._decrease('latency {:.3g} x expected'.format(
+                self.congestion))
+            return
+        load = self.load() if self.max_load is not None else None
+        if load is not None and load > self.max_load:
+            self._decrease('load {:.2f}'.format(load))
+        elif saturated:
+            self._set_limit(min(self.maximum,
+                                self.limit + self.increase / self.limit),
+                            'raised')
+
+    def _decrease(self, reason):
+        now = self.clock()
+        if (self.last_decrease_time is not None and
+                now - self.last_decrease_time < self.holdoff_secs):
+            return
+        self.last_decrease_time = now
+        self._set_limit(max(self.minimum, self.limit * self.decrease),
+                        'lowered ({})'.format(reason))
+
+    def _set_limit(self, limit, change):
+        old_capacity = self.capacity
+        self.limit = limit
+        if self.capacity != old_capacity:
+            logger.info('Concurrency limit for %s %s to %d', self.name,
+                        change, self.capacity)
+
+
+class ConcurrencyLimits(dict):
+    '''
+    The adaptive limits of a process, keyed by the kind of operation.
+    '''
+
+    def __init__(self, settings, **kwargs):
+        '''
+        Constructor.
+
+        Arguments:
+        - `settings`: a dict mapping kinds of operation to dicts of
+          keyword arguments for `AIMDLimit`
+        - `kwargs`: keyword arguments for every `AIMDLimit` (e.g.,
+          `clock`)
+        '''
+        super(ConcurrencyLimits, self).__init__()
+        for name, limit_settings in settings.items():
+            options = dict(kwargs)
+            options.update(limit_settings)
+            self[name] = AIMDLimit(name, **options)
+
+    def status(self):
+        '''
+        Returns a line describing the operations in flight and the
+        limit of each kind.
+        '''
+        return ', '.join(str(self[name]) for name in sorted(self))
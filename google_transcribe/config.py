@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+config.py
+
+Per-folder settings and other options, read from a JSON-formatted
+configuration file.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import fnmatch
+import logging
+import os
+
+from .datastore import load_data
+
+logger = logging.getLogger(__name__)
+
+
+class FolderConfig(object):
+    '''
+    The settings for one monitored Google Drive folder: where its
+    audio is staged, how it is transcribed, and which credentials are
+    used to do so.
+    '''
+
+    def __init__(self, name, bucket, language='en-US', phrases=None,
+                 client_secret='secret.json', oauth_storage='storage.dat',
+                 service_account='semantics-exam-marking.json', weight=1.0,
+                 object_prefix=''):
+        '''
+        Constructor.
+
+        Arguments:
+        - `name`: the name of the Google Drive folder
+        - `bucket`: the Google Cloud Storage bucket where WAV files are
+          stored during transcription
+        - `language`: a BCP-47 language tag for the Speech API
+        - `phrases`: a list of words or phrases to pass to the Speech
+          API as hints
+        - `client_secret`: filename of the OAuth 2.0 client ID in the
+          credentials directory
+        - `oauth_storage`: filename where the OAuth 2.0 token is kept
+          in the credentials directory
+        - `service_account`: filename of the Google Cloud Service
+          account key in the credentials directory
+        - `weight`: this folder's relative share of the daemon's time
+        - `object_prefix`: prepended to the names of this folder's
+          objects in the bucket; a prefix used by nothing else lets
+          the daemon clean up any objects left under it
+        '''
+        self.name = name
+        self.bucket = bucket
+        self.language = language
+        self.phrases = phrases
+        self.client_secret = client_secret
+        self.oauth_storage = oauth_storage
+        self.service_account = service_account
+        self.weight = float(weight)
+        self.object_prefix = object_prefix
+
+    def __str__(self):
+        return '<Folder name={} bucket={}>'.format(self.name, self.bucket)
+
+    @property
+    def drive_credentials(self):
+        '''Key identifying the Google Drive credentials of this folder.'''
+        return (self.client_secret, self.oauth_storage)
+
+    @property
+    def cloud_credentials(self):
+        '''Key identifying the Google Cloud credentials of this folder.'''
+        return self.service_account
+
+
+def load_folder_configs(filename, defaults):
+    '''
+    Reads the list of monitored folders from the JSON configuration
+    file `filename`.  The file should contain an object with a
+    "folders" list; each entry holds the keyword arguments of a
+    `FolderConfig`, and any missing setting is taken from `defaults`.
+    If the file does not exist, a single folder is configured from
+    `defaults`.
+
+    Arguments:
+    - `filename`:
+    - `defaults`: a dict of keyword arguments for `FolderConfig`
+    '''
+    try:
+        data = load_data(filename)
+    except IOError:
+        logger.info('No configuration file at %s; using defaults', filename)
+        return [FolderConfig(**defaults)]
+    folders = []
+    for entry in data.get('folders', []):
+        settings = dict(defaults)
+        settings.update(entry)
+        folders.append(FolderConfig(**settings))
+    names = [folder.name for folder in folders]
+    if not folders or len(set(names)) != len(names):
+        raise Exception(
+            'Configuration file {} must list one or more folders with '
+            'distinct names'.format(filename))
+    return folders
+
+
+def load_api_quotas(filename, defaults):
+    '''
+    Reads the rate limits for the Google APIs from the "quotas" object
+    of the JSON configuration file `filename`, which maps API names
+    (e.g., "drive") or API method names (e.g., "speech.operations.get")
+    to objects with the keys "rate" (calls per second) and optionally
+    "burst".  Entries override those in `defaults`.
+
+    Arguments:
+    - `filename`:
+    - `defaults`: a dict of quotas
+    '''
+    quotas = dict(defaults)
+    try:
+        quotas.update(load_data(filename).get('quotas', {}))
+    except IOError:
+        pass
+    return quotas
+
+
+class PriorityPins(object):
+    '''
+    Priorities pinned by the operator for particular files, read from
+    the "priorities" object of the JSON configuration file.  This maps
+    file names, or glob patterns, to the priority to use for matching
+    jobs in place of their estimated processing time (see
+    `LoopAction.priority`): 0 puts a job ahead of all others, and a
+    large number behind them.  The file is read again whenever it
+    changes, so pins can be set while the daemon runs.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Constructor.
+
+        Arguments:
+        - `filename`:
+        '''
+        self.filename = filename
+        self.pins = {}
+        self._mtime = None
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Reads the configuration file again if it has changed.
+        '''
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            pins = load_data(self.filename).get('priorities', {})
+        except (IOError, ValueError) as exc:
+            if mtime is not None:
+                logger.warning('Could not read priorities from %s: %s',
+                               self.filename, exc)
+            pins = {}
+        if pins != self.pins:
+            logger.info('Priority pins: %s', pins or 'none')
+        self.pins = pins
+
+    def lookup(self, name):
+        '''
+        Returns the pinned priority for the file `name`, or None.
+
+        Arguments:
+        - `name`:
+        '''
+        if name in self.pins:
+            return float(self.pins[name])
+        for pattern, priority in sorted(self.pins.items()):
+            if fnmatch.fnmatchcase(name, pattern):
+                return float(priority)
+        return None
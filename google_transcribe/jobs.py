@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+jobs.py
+
+The transcription job records, keyed by Google Drive file ID and
+indexed in memory by name and by state, and the SQLite file in which
+they are stored one row per job.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import logging
+import os
+
+from .sharedstore import connect, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def _dumps(data):
+    return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+
+def suffixed_name(name, drive_id):
+    '''
+    Returns `name` with the start of the Drive file ID `drive_id`
+    added to it, to tell apart recordings which share a name.
+
+    Arguments:
+    - `name`:
+    - `drive_id`:
+    '''
+    stem, ext = os.path.splitext(name)
+    return '{}-{}{}'.format(stem, drive_id[:8], ext)
+
+
+class JobRecord(object):
+    '''
+    The persistent state of one transcription job, whose recording is
+    the Google Drive file `drive_id`.
+
+    `name` is the recording's file name on Google Drive, and
+    `local_name` the name from which the job's intermediate files,
+    Cloud Storage object and transcription are named; the two differ
+    if another recording with the same name was seen first.
+    '''
+
+    __slots__ = ('drive_id', 'name', 'local_name', 'folder', 'state',
+                 'drive_parents', 'drive_md5', 'drive_size', 'created_time',
+                 'artifacts', 'probe', 'storage_id', 'submitted_time',
+                 'attempts', 'last_error', 'stalls', 'failed')
+
+    def __init__(self, drive_id, name, folder=None, state='uploaded',
+                 local_name=None, **fields):
+        '''
+        Constructor.
+
+        Arguments:
+        - `drive_id`: the Google Drive file ID of the recording
+        - `name`: the recording's file name
+        - `folder`: the name of the monitored folder the job belongs
+          to, or None for the first configured folder
+        - `state`: see `transcribe.TRANSCRIPTION_JOB_STATES`
+        - `local_name`: defaults to `name`
+        - `fields`: values for any of the other slots
+        '''
+        self.drive_id = drive_id
+        self.name = name
+        self.local_name = local_name or name
+        self.folder = folder
+        self.state = state
+        self.drive_parents = None
+        self.drive_md5 = None
+        self.drive_size = None
+        self.created_time = None
+        # manifests of the job's outputs (see manifest.describe_file)
+        self.artifacts = {}
+        self.probe = None
+        # the Speech API operation name
+        self.storage_id = None
+        self.submitted_time = None
+        # consecutive failed attempts at the current state
+        self.attempts = 0
+        self.last_error = None
+        self.stalls = 0
+        # the error for which the job was given up on
+        self.failed = None
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<JobRecord {} {} {}>'.format(self.drive_id, self.name,
+                                             self.state)
+
+    @classmethod
+    def from_dict(cls, data):
+        '''
+        Makes a job record from its stored form (see `to_dict`);
+        unknown keys, written by older versions, are ignored.
+
+        Arguments:
+        - `data`:
+        '''
+        record = cls(data['drive_id'], data['name'])
+        record.update(data)
+        return record
+
+    def update(self, data):
+        '''
+        Replaces the contents of this record with the stored form
+        `data`, in place.
+
+        Arguments:
+        - `data`:
+        '''
+        JobRecord.__init__(self, data['drive_id'], data['name'])
+        for key in self.__slots__:
+            if data.get(key) is not None:
+                setattr(self, key, data[key])
+
+    def to_dict(self):
+        '''
+        Returns the stored form of this record: a dict of its slots
+        which are set.
+        '''
+        return dict((key, getattr(self, key)) for key in self.__slots__
+                    if getattr(self, key) is not None)
+
+
+class JobStore(object):
+    '''
+    The job records of a daemon, indexed by Drive file ID, by name and
+    by state, and stored in a SQLite file, one row per job, which
+    several daemons can share (see `sharedstore`).  `save` writes a
+    single record, so the cost of a change does not grow with the
+    number of jobs; changes made by other processes are picked up by
+    `refresh`.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Constructor.
+
+        Arguments:
+        - `filename`: the SQLite file
+        '''
+        self._conn = connect(filename)
+        self._version = 0
+        # IDs of the records which have a row in the file
+        self._stored = set()
+        self.by_id = {}
+        # name -> set of Drive file IDs
+        self.by_name = {}
+        # state -> set of Drive file IDs
+        self.by_state = {}
+        self.refresh()
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def __contains__(self, drive_id):
+        return drive_id in self.by_id
+
+    def get(self, drive_id):
+        '''
+        Returns the record of the job for the Drive file `drive_id`,
+        or None.
+
+        Arguments:
+        - `drive_id`:
+        '''
+        return self.by_id.get(drive_id)
+
+    def find(self, name):
+        '''
+        Returns the records of the jobs whose recording is called
+        `name`.
+
+        Arguments:
+        - `name`:
+        '''
+        return [self.by_id[drive_id] for drive_id in
+                self.by_name.get(name, ())]
+
+    def in_state(self, state):
+        '''
+        Returns the records of the jobs in state `state`.
+
+        Arguments:
+        - `state`:
+        '''
+        return [self.by_id[drive_id] for drive_id in
+                self.by_state.get(state, ())]
+
+    def _index(self, record):
+        self.by_id[record.drive_id] = record
+        self.by_name.setdefault(record.name, set()).add(record.drive_id)
+        self.by_state.setdefault(record.state, set()).add(record.drive_id)
+
+    def _unindex(self, record):
+        for index, key in ((self.by_name, record.name),
+                           (self.by_state, record.state)):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(record.drive_id)
+                if not ids:
+                    del index[key]
+
+    def unique_local_name(self, name, drive_id, others=()):
+        '''
+        Returns the local name for a new job for the Drive file
+        `drive_id` called `name`.  Of the recordings which share a
+        name, the one with the lowest file ID keeps it, unless another
+        job already uses it; the others have the start of their file
+        ID added to it (see `suffixed_name`).  So, given the same
+        folder listing, the names do not depend on the order in which
+        the files are listed, or on which jobs exist already.
+
+        Arguments:
+        - `name`:
+        - `drive_id`:
+        - `others`: the IDs of other recordings called `name` (e.g.,
+          from a folder listing), which may not have jobs yet
+        '''
+        other_ids = (set(self.by_name.get(name, ())) | set(others)) - set(
+            [drive_id])
+        taken = any(self.by_id[other].local_name == name
+                    for other in self.by_name.get(name, ())
+                    if other != drive_id)
+        if not taken and all(drive_id < other for other in other_ids):
+            return name
+        return suffixed_name(name, drive_id)
+
+    def add(self, record):
+        '''
+        Adds the new job `record`, and saves it.  Returns the record
+        which is now stored for its Drive file: `record`, or, if
+        another process added the job first, that process's record.
+
+        Arguments:
+        - `record`:
+        '''
+        if record.drive_id in self.by_id:
+            return self.by_id[record.drive_id]
+        self._index(record)
+        self.save(record)
+        return self.by_id[record.drive_id]
+
+    def set_state(self, record, state):
+        '''
+        Moves the job `record` into `state`, keeping the state index
+        up to date.  The record is not saved.
+
+        Arguments:
+        - `record`:
+        - `state`:
+        '''
+        self._unindex(record)
+        record.state = state
+        self._index(record)
+
+    def save(self, record):
+        '''
+        Writes the job `record` to the file.
+
+        Arguments:
+        - `record`:
+        '''
+        data = _dumps(record.to_dict())
+        with transaction(self._conn):
+            version = self._conn.execute(
+                'SELECT COALESCE(MAX(version), 0) + 1 FROM jobs').fetchone()[0]
+            if record.drive_id in self._stored:
+                self._conn.execute(
+                    'UPDATE jobs SET record = ?, version = ? '
+                    'WHERE drive_id = ?', (data, version, record.drive_id))
+                inserted = True
+            else:
+                # a new job; if another process created it first, its
+                # record wins
+                inserted = self._conn.execute(
+                    'INSERT OR IGNORE INTO jobs '
+                    '(drive_id, record, version) VALUES (?, ?, ?)',
+                    (record.drive_id, data, version)).rowcount > 0
+        if not inserted:
+            self.reload(record.drive_id)
+        self._stored.add(record.drive_id)
+
+    def _load(self, drive_id, data):
+        '''
+        Updates (in place) or adds the record of the job for the Drive
+        file `drive_id` from its stored form.  Returns True if the job
+        was not known before.
+        '''
+        self._stored.add(drive_id)
+        record = self.by_id.get(drive_id)
+        if record is not None:
+            self._unindex(record)
+            record.update(json.loads(data))
+            self._index(record)
+            return False
+        self._index(JobRecord.from_dict(json.loads(data)))
+        return True
+
+    def refresh(self, keep=()):
+        '''
+        Loads the job records which other processes have written since
+        the last refresh.  Records are updated in place, so references
+        to them stay valid.  Returns the list of Drive file IDs of the
+        jobs which were not known before.
+
+        Arguments:
+        - `keep`: IDs of jobs whose local record is authoritative
+          (e.g., because this process holds their lease), and which
+          should not be overwritten
+        '''
+        new_ids = []
+        rows = self._conn.execute(
+            'SELECT drive_id, record, version FROM jobs '
+            'WHERE version > ? ORDER BY version', (self._version,)).fetchall()
+        for drive_id, data, version in rows:
+            self._version = max(self._version, version)
+            if drive_id in keep:
+                continue
+            if self._load(drive_id, data):
+                new_ids.append(drive_id)
+        return new_ids
+
+    def reload(self, drive_id):
+        '''
+        Replaces the local record of the job for the Drive file
+        `drive_id` with the one in the file, in place.  Returns False
+        if the job is not in the file.
+
+        Arguments:
+        - `drive_id`:
+        '''
+        row = self._conn.execute(
+            'SELECT record FROM jobs WHERE drive_id = ?',
+            (drive_id,)).fetchone()
+        if row is None:
+            return False
+        self._load(drive_id, row[0])
+        return True
+
+    def import_records(self, records, default_folder=None):
+        '''
+        Adds job records written by older versions, which kept them in
+        a dict keyed by file name (e.g., in ``pstorage.json``).
+        Records for Drive files which already have a job are skipped.
+        Returns the number of records added.
+
+        Arguments:
+        - `records`: a dict mapping file names to job record dicts
+        - `default_folder`: the folder of records which have none
+        '''
+        num_added = 0
+        for name, data in sorted(records.items()):
+            if not data.get('drive_id') or data['drive_id'] in self.by_id:
+                continue
+            data = dict(data, name=name, local_name=name)
+            if data.get('storage_id') == 'unknown':
+                del data['storage_id']
+            data.setdefault('folder', default_folder)
+            self.add(JobRecord.from_dict(data))
+            num_added += 1
+        return num_added
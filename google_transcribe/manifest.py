@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+manifest.py
+
+Small descriptions (manifests) of the files produced by transcription
+jobs, used to check whether a stage's output already exists and is
+complete, so that the stage need not be run again.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import base64
+import binascii
+import hashlib
+import os
+import wave
+
+# slack allowed between the size of a WAV file and the size of its
+# audio data, for the header and any metadata chunks
+WAV_HEADER_SLACK_BYTES = 4096
+
+
+def md5_file(path, chunk_size=1024 * 1024):
+    '''
+    Returns the MD5 checksum of the file at `path`, as a hex string.
+
+    Arguments:
+    - `path`:
+    - `chunk_size`:
+    '''
+    digest = hashlib.md5()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def md5_base64_to_hex(md5_base64):
+    '''
+    Converts an MD5 checksum in base64 (as reported by Google Cloud
+    Storage) into a hex string.
+
+    Arguments:
+    - `md5_base64`:
+    '''
+    return binascii.hexlify(base64.b64decode(md5_base64)).decode('ascii')
+
+
+def wav_duration(path):
+    '''
+    Returns the duration in seconds of the WAV file at `path`, or None
+    if the file is not a complete WAV file (e.g., because the program
+    writing it was interrupted before it filled in the header).
+
+    Arguments:
+    - `path`:
+    '''
+    try:
+        wav_file = wave.open(path, 'rb')
+    except (wave.Error, EOFError, IOError, OSError):
+        return None
+    try:
+        nframes = wav_file.getnframes()
+        data_bytes = nframes * wav_file.getsampwidth() * wav_file.getnchannels()
+        framerate = wav_file.getframerate()
+    finally:
+        wav_file.close()
+    file_bytes = os.path.getsize(path)
+    if (not nframes or not framerate or file_bytes < data_bytes or
+            file_bytes > data_bytes + WAV_HEADER_SLACK_BYTES):
+        return None
+    return float(nframes) / framerate
+
+
+def describe_file(path, audio=False, **extra):
+    '''
+    Returns a manifest for the file at `path`: a dict with its size
+    and MD5 checksum, and for WAV files (`audio` True) its duration.
+    Further entries can be passed as keyword arguments.
+
+    Arguments:
+    - `path`:
+    - `audio`:
+    '''
+    manifest = {'size': os.path.getsize(path), 'md5': md5_file(path)}
+    if audio:
+        manifest['duration'] = wav_duration(path)
+    manifest.update(extra)
+    return manifest
+
+
+def file_matches(path, manifest):
+    '''
+    Returns True if the file at `path` exists and has the size and MD5
+    checksum recorded in `manifest`.  The size is checked first, so
+    that most mismatches are found without reading the file.
+
+    Arguments:
+    - `path`:
+    - `manifest`: a dict with the keys 'size' and 'md5', or None
+    '''
+    if not manifest or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) != int(manifest['size']):
+        return False
+    return md5_file(path) == manifest['md5']
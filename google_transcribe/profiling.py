@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+profiling.py
+
+On-demand profiling and tick timing for the polling loop.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TickStats(object):
+    '''Accumulated wall times for one kind of poll loop action.'''
+
+    def __init__(self):
+        '''Constructor.'''
+        self.count = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+    def record(self, elapsed):
+        '''
+        Records a single tick.
+
+        Arguments:
+        - `elapsed`: the wall time of the tick in seconds
+        '''
+        self.count += 1
+        self.total_secs += elapsed
+        self.max_secs = max(self.max_secs, elapsed)
+
+    @property
+    def mean_secs(self):
+        '''The mean wall time of a tick, in seconds.'''
+        if not self.count:
+            return 0.0
+        return self.total_secs / self.count
+
+
+class LoopProfiler(object):
+    '''
+    Instrumentation for the polling loop.
+
+    Every tick is timed, and the timings are accumulated per kind of
+    action (see `LoopAction.profile_key`); ticks which take longer
+    than `slow_tick_secs` are logged.  When requested (by default, on
+    receipt of SIGUSR1), cProfile is switched on for `profile_secs`
+    seconds and the collected statistics are written into
+    `output_dir`.
+    '''
+
+    def __init__(self, output_dir, slow_tick_secs=5.0, profile_secs=60.0):
+        '''
+        Constructor.
+
+        Arguments:
+        - `output_dir`: directory where profiling output is written
+        - `slow_tick_secs`: ticks taking longer than this are logged
+        - `profile_secs`: how long cProfile stays switched on after a
+          request
+        '''
+        self.output_dir = output_dir
+        self.slow_tick_secs = slow_tick_secs
+        self.profile_secs = profile_secs
+        self.tick_stats = {}
+        self._profile = None
+        self._profile_end_time = None
+        self._profile_requested = False
+
+    def install_signal_handler(self):
+        '''
+        Installs a SIGUSR1 handler which requests a profiling run.
+        Does nothing on platforms without SIGUSR1.
+        '''
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._handle_signal)
+
+    def _handle_signal(self, _signum, _frame):
+        # only raise a flag here; cProfile is switched on from the
+        # polling loop (see `poll`)
+        self._profile_requested = True
+
+    def request_profile(self):
+        '''Requests a profiling run, starting at the next `poll`.'''
+        self._profile_requested = True
+
+    @property
+    def profiling(self):
+        '''True if cProfile is currently switched on.'''
+        return self._profile is not None
+
+    def poll(self):
+        '''
+        Starts or stops cProfile as needed.  Should be called once per
+        iteration of the polling loop.
+        '''
+        if self._profile_requested:
+            self._profile_requested = False
+            self._profile_end_time = time.time() + self.profile_secs
+            if self._profile is None:
+                logger.info('Profiling for %d seconds', self.profile_secs)
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+        if (self._profile is not None and
+                self._profile_end_time < time.time()):
+            self.stop_profile()
+
+    def stop_profile(self):
+        '''
+        Switches cProfile off and writes the collected statistics to
+        the output directory.  Returns the path of the stats file, or
+        None if no profile was running.
+        '''
+        if self._profile is None:
+            return None
+        profile, self._profile = self._profile, None
+        profile.disable()
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        stem = os.path.join(self.output_dir,
+                            'profile-' + time.strftime('%Y%m%d-%H%M%S'))
+        profile.dump_stats(stem + '.pstats')
+        # a human readable summary alongside the binary stats
+        with open(stem + '.txt', 'w') as output_file:
+            output_file.write('\n'.join(self.summary_lines()) + '\n\n')
+            stats = pstats.Stats(profile, stream=output_file)
+            stats.sort_stats('cumulative').print_stats(50)
+        logger.info('Wrote profile to %s.pstats', stem)
+        return stem + '.pstats'
+
+    def time_tick(self, action):
+        '''
+        Calls `action.tick()`, recording its wall time, and returns
+        the tick's result.
+
+        Arguments:
+        - `action`: a `LoopAction`
+        '''
+        key = action.profile_key()
+        start = time.time()
+        try:
+            return action.tick()
+        finally:
+            elapsed = time.time() - start
+            if key not in self.tick_stats:
+                self.tick_stats[key] = TickStats()
+            self.tick_stats[key].record(elapsed)
+            if elapsed > self.slow_tick_secs:
+                logger.warning('Slow tick: %s took %.2f secs (%s)', key,
+                               elapsed, str(action))
+
+    def summary_lines(self):
+        '''
+        Returns a list of lines summarising the tick timings, slowest
+        total first.
+        '''
+        lines = ['{:<48} {:>8} {:>10} {:>10} {:>10}'.format(
+            'action', 'ticks', 'total', 'mean', 'max')]
+        for key, stats in sorted(self.tick_stats.items(),
+                                 key=lambda kv: -kv[1].total_secs):
+            lines.append('{:<48} {:>8d} {:>10.3f} {:>10.4f} {:>10.3f}'.format(
+                key, stats.count, stats.total_secs, stats.mean_secs,
+                stats.max_secs))
+        return lines
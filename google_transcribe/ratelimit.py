@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+ratelimit.py
+
+Token bucket rate limiting for calls to the Google APIs.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import functools
+import logging
+import threading
+import time
+
+from .tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    '''
+    A token bucket: tokens accumulate at `rate` per second, up to
+    `burst`, and each call takes one.
+    '''
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        '''
+        Constructor.
+
+        Arguments:
+        - `rate`: tokens added per second
+        - `burst`: the maximum number of tokens held (default: one
+          second's worth, but at least 1)
+        - `clock`: function returning the current time in seconds
+        - `sleep`: function used to wait for tokens
+        '''
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.last_time = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def reserve(self, tokens=1):
+        '''
+        Takes `tokens` from the bucket, going into debt if necessary,
+        and returns the number of seconds the caller must wait before
+        using them.
+
+        Arguments:
+        - `tokens`:
+        '''
+        with self._lock:
+            self._refill()
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self, tokens=1):
+        '''
+        Takes `tokens` from the bucket, waiting until they are
+        available.  Returns the number of seconds waited.
+
+        Arguments:
+        - `tokens`:
+        '''
+        wait_secs = self.reserve(tokens)
+        if wait_secs > 0:
+            self.sleep(wait_secs)
+        return wait_secs
+
+
+class RateLimiter(object):
+    '''
+    A collection of token buckets, one for each configured API (e.g.,
+    'drive') and API method (e.g., 'speech.operations.get').  A call to
+    a method must take a token from both the API's bucket and the
+    method's bucket, where these are configured.
+    '''
+
+    def __init__(self, quotas=None, clock=time.time, sleep=time.sleep):
+        '''
+        Constructor.
+
+        Arguments:
+        - `quotas`: a dict mapping API or API method names to dicts
+          with the keys 'rate' (calls per second) and optionally
+          'burst'
+        - `clock`:
+        - `sleep`:
+        '''
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = {}
+        self.configure(quotas or {})
+
+    def configure(self, quotas):
+        '''
+        Replaces the configured quotas.
+
+        Arguments:
+        - `quotas`: see the constructor
+        '''
+        self.buckets = dict(
+            (name, TokenBucket(quota['rate'], quota.get('burst'),
+                               clock=self.clock, sleep=self.sleep))
+            for name, quota in quotas.items())
+
+    def acquire(self, api, method):
+        '''
+        Waits until a call to `method` of `api` is allowed.  Returns
+        the number of seconds waited.
+
+        Arguments:
+        - `api`: e.g., 'drive'
+        - `method`: e.g., 'files.list'
+        '''
+        buckets = [self.buckets[name]
+                   for name in (api, '{}.{}'.format(api, method))
+                   if name in self.buckets]
+        wait_secs = max([bucket.reserve() for bucket in buckets] or [0.0])
+        if wait_secs > 0:
+            logger.debug('Rate limiting %s.%s for %.2f secs', api, method,
+                         wait_secs)
+            with TRACER.span('rate limit', 'wait', api=api, method=method):
+                self.sleep(wait_secs)
+        return wait_secs
+
+
+# The rate limiter used by the Google API helper functions.
+LIMITER = RateLimiter()
+
+
+def rate_limited(api, method):
+    '''
+    Decorator for a function which makes one call to `method` of
+    `api`, so that it waits for the shared rate limiter first.
+
+    Arguments:
+    - `api`:
+    - `method`:
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            LIMITER.acquire(api, method)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+retry.py
+
+Error classification, exponential backoff with jitter, and per-API
+circuit breakers for calls to the Google APIs.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import functools
+import logging
+import random
+import socket
+import threading
+import time
+
+from .tracing import TRACER
+from .watchdog import StageTimeout
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes which indicate a transient failure
+RETRYABLE_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+
+# reasons given with a 403 status which indicate a transient failure
+RETRYABLE_403_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded',
+                         'backendError')
+
+# errno values of socket errors which indicate a transient failure
+RETRYABLE_ERRNOS = frozenset([
+    errno.ECONNABORTED, errno.ECONNREFUSED, errno.ECONNRESET,
+    errno.EHOSTUNREACH, errno.ENETDOWN, errno.ENETUNREACH, errno.EPIPE,
+    errno.ETIMEDOUT])
+
+# modules (and their submodules, e.g., httplib2.error) whose
+# exceptions are raised for broken connections
+RETRYABLE_MODULES = ('httplib2', 'http.client', 'httplib', 'ssl')
+
+# modules (and their submodules) whose exceptions are raised for
+# errors reported by the Google APIs or their authorisation servers
+API_MODULES = ('googleapiclient', 'apiclient', 'oauth2client')
+
+# exceptions from the connection modules which will fail again if
+# retried
+FATAL_CONNECTION_ERRORS = frozenset([
+    'RedirectMissingLocation', 'RedirectLimit', 'RelativeURIError',
+    'MalformedHeader', 'ProxiesUnavailableError',
+    'UnimplementedDigestAuthOptionError',
+    'UnimplementedHmacDigestAuthOptionError'])
+
+
+class APIError(Exception):
+    '''
+    A failed call to a Google API.  `cause` holds the original
+    exception.
+    '''
+
+    def __init__(self, api, cause):
+        '''
+        Constructor.
+
+        Arguments:
+        - `api`: the name of the API (e.g., 'drive')
+        - `cause`: the exception raised by the call
+        '''
+        super(APIError, self).__init__('{} API: {}: {}'.format(
+            api, type(cause).__name__, cause))
+        self.api = api
+        self.cause = cause
+
+
+class RetryableError(APIError):
+    '''A failed call to a Google API which is worth retrying.'''
+    pass
+
+
+class FatalError(APIError):
+    '''A failed call to a Google API which will fail again if retried.'''
+    pass
+
+
+class CircuitOpenError(RetryableError):
+    '''
+    A call to a Google API which was not made, because the API's
+    circuit breaker is open.  `retry_time` is when the breaker will
+    let a trial call through.
+    '''
+
+    def __init__(self, api, retry_time):
+        '''
+        Constructor.
+
+        Arguments:
+        - `api`:
+        - `retry_time`:
+        '''
+        super(CircuitOpenError, self).__init__(
+            api, Exception('circuit open until {}'.format(
+                time.strftime('%H:%M:%S', time.localtime(retry_time)))))
+        self.retry_time = retry_time
+
+
+def _from_modules(exc, modules):
+    module = type(exc).__module__ or ''
+    return any(module == name or module.startswith(name + '.')
+               for name in modules)
+
+
+def is_api_error(exc):
+    '''
+    Returns True if the exception `exc`, raised while calling a Google
+    API, came from the API or the connection to it, rather than from
+    the local machine (e.g., a missing file or a full disk).
+
+    Arguments:
+    - `exc`:
+    '''
+    if getattr(getattr(exc, 'resp', None), 'status', None) is not None:
+        return True
+    if isinstance(exc, (socket.timeout, socket.herror, socket.gaierror)):
+        return True
+    if _from_modules(exc, RETRYABLE_MODULES + API_MODULES):
+        return True
+    if isinstance(exc, (IOError, OSError, socket.error)):
+        return getattr(exc, 'errno', None) in RETRYABLE_ERRNOS
+    return False
+
+
+def is_retryable(exc):
+    '''
+    Returns True if the exception `exc`, raised by a call to a Google
+    API, indicates a transient failure.
+
+    Arguments:
+    - `exc`:
+    '''
+    # googleapiclient.errors.HttpError
+    status = getattr(getattr(exc, 'resp', None), 'status', None)
+    if status is not None:
+        status = int(status)
+        if status in RETRYABLE_STATUS_CODES:
+            return True
+        if status == 403:
+            content = getattr(exc, 'content', b'') or b''
+            if not isinstance(content, str):
+                content = content.decode('utf-8', 'replace')
+            return any(reason in content for reason in RETRYABLE_403_REASONS)
+        return False
+    if isinstance(exc, (socket.timeout, socket.herror, socket.gaierror)):
+        return True
+    if _from_modules(exc, RETRYABLE_MODULES):
+        return type(exc).__name__ not in FATAL_CONNECTION_ERRORS
+    if isinstance(exc, (IOError, OSError, socket.error)):
+        return getattr(exc, 'errno', None) in RETRYABLE_ERRNOS
+    return False
+
+
+def backoff_delay(attempt, base_secs=5.0, max_secs=30 * 60.0,
+                  rng=random.random):
+    '''
+    Returns how long to wait before retry number `attempt` (counting
+    from 1): a random time between half and all of an exponentially
+    growing bound, so that jobs which failed together do not retry
+    together.
+
+    Arguments:
+    - `attempt`:
+    - `base_secs`: the bound for the first retry
+    - `max_secs`: the largest bound
+    - `rng`: function returning a random number in [0, 1)
+    '''
+    bound = min(max_secs, base_secs * 2 ** max(attempt - 1, 0))
+    return bound * (0.5 + 0.5 * rng())
+
+
+class CircuitBreaker(object):
+    '''
+    Stops calls to an API after `failure_threshold` consecutive
+    transient failures.  The breaker then stays open for
+    `cooldown_secs`, after which one trial call is let through; if
+    that fails too, the breaker reopens for twice as long (up to
+    `max_cooldown_secs`).
+    '''
+
+    def __init__(self, api, failure_threshold=5, cooldown_secs=30.0,
+                 max_cooldown_secs=30 * 60.0, clock=time.time):
+        '''
+        Constructor.
+
+        Arguments:
+        - `api`: the name of the API
+        - `failure_threshold`:
+        - `cooldown_secs`:
+        - `max_cooldown_secs`:
+        - `clock`: function returning the current time in seconds
+        '''
+        self.api = api
+        self.failure_threshold = failure_threshold
+        self.base_cooldown_secs = cooldown_secs
+        self.max_cooldown_secs = max_cooldown_secs
+        self.clock = clock
+        self.failures = 0
+        self.cooldown_secs = cooldown_secs
+        self.open_until = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        '''True if calls are currently being refused.'''
+        return self.open_until is not None
+
+    def before_call(self):
+        '''
+        Raises `CircuitOpenError` if the call should not be made.
+        '''
+        with self._lock:
+            if self.open_until is None:
+                return
+            if self.clock() < self.open_until or self._trial:
+                raise CircuitOpenError(self.api, self.open_until)
+            # let one trial call through
+            self._trial = True
+
+    def record_success(self):
+        '''Records a successful call.'''
+        with self._lock:
+            if self.open_until is not None:
+                logger.info('Circuit for %s API closed', self.api)
+            self.failures = 0
+            self.cooldown_secs = self.base_cooldown_secs
+            self.open_until = None
+            self._trial = False
+
+    def record_local_error(self):
+        '''
+        Records a call which failed before it reached the API (e.g.,
+        because a local file was missing); if it was the trial call,
+        another one is let through.
+        '''
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        '''Records a call which failed with a transient error.'''
+        with self._lock:
+            self.failures += 1
+            if self._trial:
+                self.cooldown_secs = min(self.max_cooldown_secs,
+                                         self.cooldown_secs * 2)
+            elif self.failures < self.failure_threshold:
+                return
+            self._trial = False
+            self.open_until = self.clock() + self.cooldown_secs
+            logger.warning('Circuit for %s API opened for %d secs after %d '
+                           'failures', self.api, self.cooldown_secs,
+                           self.failures)
+
+
+# The circuit breakers for each API.
+BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(api):
+    '''
+    Returns the circuit breaker for the API named `api`.
+
+    Arguments:
+    - `api`:
+    '''
+    with _BREAKERS_LOCK:
+        if api not in BREAKERS:
+            BREAKERS[api] = CircuitBreaker(api)
+        return BREAKERS[api]
+
+
+def guarded(api):
+    '''
+    Decorator for a function which calls the Google API named `api`.
+    The call is refused while the API's circuit breaker is open.  An
+    error from the API or the connection to it (see `is_api_error`)
+    is reported to the breaker and re-raised as a `RetryableError` or
+    a `FatalError`; other exceptions (e.g., an IOError for a missing
+    local file) are re-raised unchanged, so that the caller can deal
+    with them as local errors.
+
+    Arguments:
+    - `api`:
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            breaker = get_breaker(api)
+            breaker.before_call()
+            try:
+                with TRACER.span(func.__name__, 'api.' + api):
+                    result = func(*args, **kwargs)
+            except StageTimeout:
+                # aborted by the watchdog: let it through, but count
+                # the stall against the API
+                breaker.record_failure()
+                raise
+            except Exception as exc:
+                if not is_api_error(exc):
+                    breaker.record_local_error()
+                    raise
+                if is_retryable(exc):
+                    breaker.record_failure()
+                    raise RetryableError(api, exc)
+                # a fatal error still means the API is up
+                breaker.record_success()
+                raise FatalError(api, exc)
+            breaker.record_success()
+            return result
+        return wrapper
+    return decorator
+
+
+def call_with_retries(func, max_attempts=10, base_secs=5.0,
+                      max_secs=30 * 60.0, sleep=time.sleep):
+    '''
+    Calls `func()`, which calls a function decorated with `guarded`,
+    retrying after transient failures with exponential backoff (and
+    waiting for open circuit breakers).  This blocks the calling
+    thread, so it is meant for worker threads rather than the polling
+    loop.  Raises the last `RetryableError` after `max_attempts`
+    failures, and any `FatalError` immediately.
+
+    Arguments:
+    - `func`: a function taking no arguments
+    - `max_attempts`:
+    - `base_secs`: see `backoff_delay`
+    - `max_secs`: see `backoff_delay`
+    - `sleep`:
+    '''
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except CircuitOpenError as exc:
+            sleep(max(exc.retry_time - time.time(), 0) +
+                  backoff_delay(1, base_secs, max_secs))
+        except RetryableError as exc:
+            attempt += 1
+            if attempt >= max_attempts:
+                raise
+            delay = backoff_delay(attempt, base_secs, max_secs)
+            logger.warning('%s; retrying in %d secs', exc, delay)
+            sleep(delay)
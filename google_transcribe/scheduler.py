@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+scheduler.py
+
+The polling loop, shared fairly between groups of actions.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+
+from .tracing import TRACER
+
+
+class Scheduler(list):
+    '''
+    The list of `LoopAction` objects in the polling loop, together
+    with the logic to tick them.
+
+    Actions are grouped by `LoopAction.share_group` (e.g., by Google
+    Drive folder), and the time spent ticking is divided between the
+    groups using deficit round robin: on each pass, every group with
+    ready actions is credited with `quantum_secs` (scaled by its
+    weight), and may tick its actions until it has used up its
+    credit.  A group whose ticks overran its credit sits out later
+    passes until the other groups have caught up, so one large
+    backlog cannot starve the rest.
+
+    Within a group, ready actions are ticked shortest job first: in
+    order of `LoopAction.priority`, the estimated processing time the
+    action has left.  To keep long jobs from starving, an action's
+    priority is reduced by `aging_rate` seconds for every second it
+    has been waiting since it became ready (its `next_tick_time`).
+    '''
+
+    def __init__(self, quantum_secs=1.0, weights=None, tick=None,
+                 aging_rate=1.0):
+        '''
+        Constructor.
+
+        Arguments:
+        - `quantum_secs`: the tick time credited to a group per pass
+        - `weights`: a dict mapping group names to relative weights
+          (default 1)
+        - `tick`: a function used to tick an action, returning the
+          tick's result (e.g., `LoopProfiler.time_tick`); defaults to
+          calling `action.tick()`
+        - `aging_rate`: seconds of priority gained per second waited
+        '''
+        super(Scheduler, self).__init__()
+        self.quantum_secs = quantum_secs
+        self.weights = dict(weights or {})
+        self.tick = tick or (lambda action: action.tick())
+        self.aging_rate = aging_rate
+        self.deficits = {}
+        self._counter = itertools.count()
+
+    def _heap_entry(self, action, now):
+        '''
+        Returns the entry for `action` in a group's ready queue.
+
+        Arguments:
+        - `action`:
+        - `now`:
+        '''
+        waited_secs = max(now - action.next_tick_time, 0.0)
+        # the counter breaks ties in insertion order
+        return (action.priority() - self.aging_rate * waited_secs,
+                next(self._counter), action)
+
+    def _ready_groups(self):
+        '''
+        Returns an ordered dict mapping each group name to a heap of
+        that group's actions which are ready to tick (see
+        `_heap_entry`).
+        '''
+        now = time.time()
+        groups = OrderedDict()
+        for action in self:
+            if action.should_tick():
+                groups.setdefault(action.share_group(), []).append(
+                    self._heap_entry(action, now))
+        for queue in groups.values():
+            heapq.heapify(queue)
+        return groups
+
+    def run_once(self):
+        '''
+        Performs one pass of the scheduler.  Returns True if some
+        actions asked to be ticked again immediately but were deferred
+        to a later pass; in that case, the caller should not sleep
+        before the next pass.
+        '''
+        groups = self._ready_groups()
+        # groups without work keep any debt, but do not bank credit
+        for group in list(self.deficits):
+            if group not in groups:
+                self.deficits[group] = min(self.deficits[group], 0.0)
+        for group in groups:
+            self.deficits[group] = (self.deficits.get(group, 0.0) +
+                                    self.quantum_secs *
+                                    self.weights.get(group, 1.0))
+        # stay work conserving: if every group with work is in debt,
+        # advance them all until the least indebted one can run
+        if groups:
+            best = max(self.deficits[group] for group in groups)
+            if best <= 0:
+                for group in groups:
+                    self.deficits[group] += (-best + self.quantum_secs *
+                                             self.weights.get(group, 1.0))
+        pending = False
+        for group, queue in groups.items():
+            while queue and self.deficits[group] > 0:
+                action = heapq.heappop(queue)[-1]
+                start = time.time()
+                # time spent ready, but waiting for its turn
+                TRACER.complete('queued', 'scheduler',
+                                max(action.next_tick_time,
+                                    action.last_tick_time),
+                                start, group=group, **action.trace_tags())
+                again = self.tick(action)
+                end = time.time()
+                action.last_tick_time = end
+                self.deficits[group] -= end - start
+                if again:
+                    # its priority may have changed with its state
+                    heapq.heappush(queue, self._heap_entry(action, end))
+            if queue:
+                pending = True
+        return pending
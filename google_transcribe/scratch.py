@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+scratch.py
+
+Scratch space for the intermediate files of transcription jobs,
+optionally kept in memory (in a tmpfs directory, such as /dev/shm)
+up to a byte budget, and spilled to the cache directory on disk
+beyond it.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import logging
+import mmap
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+@contextmanager
+def open_mapped(path):
+    '''
+    Context manager which opens the file at `path` for reading as a
+    read-only memory map, so that a file in memory (e.g., on a tmpfs)
+    is read without copying it into a buffer first.  Empty files,
+    which cannot be mapped, are opened as ordinary files.
+
+    Arguments:
+    - `path`:
+    '''
+    with open(path, 'rb') as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            yield input_file
+            return
+        mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+class ScratchSpace(object):
+    '''
+    Chooses where each intermediate file lives: under `ram_dir` (a
+    directory on a tmpfs) while the files there total less than
+    `budget_bytes`, and otherwise under `disk_dir`.
+
+    Files are addressed by a subdirectory and a file name (see
+    `path`), and are looked for in memory first, then on disk, so a
+    file can be moved from one to the other (see `spill`) without its
+    users noticing, as long as they ask for its path again before
+    each use.
+
+    The bytes in memory are kept as a running total, so that looking
+    up a path does not walk the directory: files are counted at their
+    expected size when `path` places them in memory, and recounted at
+    their actual size by `spill`, which should be called after files
+    are written.
+    '''
+
+    def __init__(self, disk_dir=None, ram_dir=None, budget_bytes=None):
+        '''
+        Constructor.
+
+        Arguments:
+        - `disk_dir`: the directory on disk
+        - `ram_dir`: the directory in memory, or None to keep all files
+          on disk
+        - `budget_bytes`: the most the files under `ram_dir` may hold
+        '''
+        self.disk_dir = None
+        self.ram_dir = None
+        self.budget_bytes = 0
+        self._lock = threading.Lock()
+        # path -> size of the files in memory, and their total
+        self._ram_sizes = {}
+        self._ram_bytes = 0
+        self.configure(disk_dir, ram_dir, budget_bytes)
+
+    def configure(self, disk_dir, ram_dir=None, budget_bytes=None):
+        '''
+        Sets the directories and the budget (see the constructor).
+
+        Arguments:
+        - `disk_dir`:
+        - `ram_dir`:
+        - `budget_bytes`:
+        '''
+        self.disk_dir = disk_dir
+        self.ram_dir = ram_dir
+        self.budget_bytes = budget_bytes or 0
+        with self._lock:
+            self._ram_sizes = {}
+            self._ram_bytes = 0
+        if ram_dir is not None:
+            _mkdir_p(ram_dir)
+            logger.info('Keeping up to %d MB of intermediate files in %s',
+                        self.budget_bytes // 1024 ** 2, ram_dir)
+            with self._lock:
+                for _mtime, size, path in self.ram_files():
+                    self._count(path, size)
+
+    def _count(self, path, size):
+        '''Sets the size counted for the file `path` in memory.'''
+        self._ram_bytes += size - self._ram_sizes.get(path, 0)
+        self._ram_sizes[path] = size
+
+    def _uncount(self, path):
+        self._ram_bytes -= self._ram_sizes.pop(path, 0)
+
+    def ram_files(self):
+        '''
+        Returns a list of (modification time, size, path) for the
+        files in memory, found by walking the directory.
+        '''
+        files = []
+        if self.ram_dir is None:
+            return files
+        for dirpath, _dirnames, filenames in os.walk(self.ram_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def ram_bytes(self):
+        '''
+        Returns the total size of the files in memory, as of the last
+        `spill`, plus the expected sizes of files placed there since.
+        '''
+        return self._ram_bytes
+
+    def path(self, subdir, filename, size=None):
+        '''
+        Returns the path of the file `filename` in the subdirectory
+        `subdir`: where it is, if it exists; otherwise in memory, if
+        the budget has room for it, or else on disk.
+
+        Arguments:
+        - `subdir`: the kind of file (e.g., 'wav_files')
+        - `filename`:
+        - `size`: the expected size of the file, if it is about to be
+          written
+        '''
+        disk_path = os.path.join(self.disk_dir, subdir, filename)
+        if self.ram_dir is None:
+            _mkdir_p(os.path.dirname(disk_path))
+            return disk_path
+        ram_path = os.path.join(self.ram_dir, subdir, filename)
+        if os.path.exists(ram_path):
+            return ram_path
+        with self._lock:
+            # a file which was counted but is gone (e.g., deleted from
+            # the cache) no longer takes up room
+            self._uncount(ram_path)
+            if (os.path.exists(disk_path) or
+                    self._ram_bytes + (size or 0) > self.budget_bytes):
+                _mkdir_p(os.path.dirname(disk_path))
+                return disk_path
+            self._count(ram_path, size or 0)
+        _mkdir_p(os.path.dirname(ram_path))
+        return ram_path
+
+    def spill(self, keep=()):
+        '''
+        Moves the oldest files in memory to disk until those left are
+        within the budget.  Returns a list of (old path, new path) for
+        the files which were moved.  The files counted in memory are
+        recounted at their actual sizes first.
+
+        Arguments:
+        - `keep`: paths which should stay in memory if possible (e.g.,
+          the file which is about to be read)
+        '''
+        moves = []
+        if self.ram_dir is None:
+            return moves
+        with self._lock:
+            files = []
+            for path in list(self._ram_sizes):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # deleted, or never written
+                    self._uncount(path)
+                    continue
+                self._count(path, stat.st_size)
+                files.append((stat.st_mtime, stat.st_size, path))
+            files.sort(key=lambda entry: (entry[2] in keep, entry[0]))
+            for _mtime, size, path in files:
+                if self._ram_bytes <= self.budget_bytes:
+                    break
+                new_path = os.path.join(self.disk_dir,
+                                        os.path.relpath(path, self.ram_dir))
+                _mkdir_p(os.path.dirname(new_path))
+                try:
+                    shutil.move(path, new_path)
+                except (IOError, OSError) as exc:
+                    logger.warning('Could not move %s to disk: %s', path, exc)
+                    continue
+                logger.info('Spilled %s (%d bytes) to disk', path, size)
+                self._uncount(path)
+                moves.append((path, new_path))
+        return moves
+
+
+# The scratch space of this process.
+SCRATCH = ScratchSpace()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+sharedstore.py
+
+The SQLite file which holds the job store (see `jobs.JobStore`), and
+which several daemon instances can share, together with time-limited
+leases which those instances use to divide the work between them.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    drive_id TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_version ON jobs (version);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+'''
+
+
+def connect(filename):
+    '''
+    Opens a connection to the shared SQLite file `filename`, creating
+    the tables if necessary.  Transactions are managed explicitly
+    (see `transaction`).
+
+    Arguments:
+    - `filename`:
+    '''
+    conn = sqlite3.connect(filename, timeout=30, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    '''
+    Context manager which runs a block in an immediate (write-locked)
+    transaction on `conn`.
+
+    Arguments:
+    - `conn`:
+    '''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+class LeaseManager(object):
+    '''
+    Time-limited, named leases held in the shared SQLite file.
+
+    A process holds a lease until it releases it, or until it stops
+    renewing it; a background thread renews all leases held by this
+    process every `lease_secs / 3` seconds, so the leases of a crashed
+    process expire after at most `lease_secs` seconds and can then be
+    claimed by another process.
+    '''
+
+    def __init__(self, filename, lease_secs=60.0, max_jobs=None,
+                 owner=None, clock=time.time):
+        '''
+        Constructor.
+
+        Arguments:
+        - `filename`: the shared SQLite file
+        - `lease_secs`: how long a lease lasts without renewal
+        - `max_jobs`: the maximum number of job leases this process
+          will hold at once, or None for no limit
+        - `owner`: a unique name for this process
+        - `clock`: function returning the current time in seconds
+        '''
+        self._filename = filename
+        self._conn = connect(filename)
+        self.lease_secs = lease_secs
+        self.clock = clock
+        self.max_jobs = max_jobs
+        self.owner = owner or '{}:{}:{}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.held = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    def claim(self, name):
+        '''
+        Claims (or renews) the lease `name` for this process.  Returns
+        True if the lease is now held by this process.
+
+        Arguments:
+        - `name`:
+        '''
+        now = self.clock()
+        with self._lock:
+            with transaction(self._conn):
+                row = self._conn.execute(
+                    'SELECT owner, expires FROM leases WHERE name = ?',
+                    (name,)).fetchone()
+                if row is not None and row[0] != self.owner and row[1] > now:
+                    return False
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO leases (name, owner, expires) '
+                    'VALUES (?, ?, ?)', (name, self.owner,
+                                         now + self.lease_secs))
+            if row is not None and row[0] != self.owner:
+                logger.info('Took over expired lease %s from %s', name,
+                            row[0])
+            self.held.add(name)
+        return True
+
+    def claim_job(self, name):
+        '''
+        Claims the lease for the job `name`, unless this process
+        already holds `max_jobs` job leases.  Returns True if the
+        lease is now held by this process.
+
+        Arguments:
+        - `name`:
+        '''
+        lease = 'job:' + name
+        if lease not in self.held and self.max_jobs is not None:
+            num_jobs = len([x for x in self.held if x.startswith('job:')])
+            if num_jobs >= self.max_jobs:
+                return False
+        return self.claim(lease)
+
+    def holds_job(self, name):
+        '''Returns True if this process holds the lease for job `name`.'''
+        return 'job:' + name in self.held
+
+    def release(self, name):
+        '''
+        Gives up the lease `name`.
+
+        Arguments:
+        - `name`:
+        '''
+        with self._lock:
+            with transaction(self._conn):
+                self._conn.execute(
+                    'DELETE FROM leases WHERE name = ? AND owner = ?',
+                    (name, self.owner))
+            self.held.discard(name)
+
+    def release_job(self, name):
+        '''Gives up the lease for job `name`.'''
+        self.release('job:' + name)
+
+    def held_jobs(self):
+        '''Returns the IDs of the jobs whose leases this process holds.'''
+        return set(x[len('job:'):] for x in self.held if x.startswith('job:'))
+
+    def renew(self, conn=None):
+        '''
+        Extends all leases held by this process, and forgets any which
+        have been lost (e.g., because this process stalled for longer
+        than `lease_secs`).
+
+        Arguments:
+        - `conn`: the SQLite connection to use (connections cannot be
+          shared between threads)
+        '''
+        conn = conn or self._conn
+        with self._lock:
+            with transaction(conn):
+                conn.execute('UPDATE leases SET expires = ? WHERE owner = ?',
+                             (self.clock() + self.lease_secs, self.owner))
+                still_held = set(row[0] for row in conn.execute(
+                    'SELECT name FROM leases WHERE owner = ?', (self.owner,)))
+            for name in self.held - still_held:
+                logger.warning('Lost lease %s', name)
+            self.held &= still_held
+
+    def start_heartbeat(self):
+        '''
+        Starts the background thread which renews this process's
+        leases.
+        '''
+        if self._heartbeat is not None:
+            return
+
+        def heartbeat():
+            conn = connect(self._filename)
+            while True:
+                time.sleep(self.lease_secs / 3.0)
+                try:
+                    self.renew(conn)
+                except sqlite3.Error as exc:
+                    logger.warning('Could not renew leases: %s', exc)
+
+        self._heartbeat = threading.Thread(target=heartbeat,
+                                           name='lease-heartbeat')
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
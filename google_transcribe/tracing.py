@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+tracing.py
+
+Opt-in timeline tracing of transcription jobs: spans for state
+handlers, API calls, subprocesses and waits, written to rotating files
+in the Chrome Trace Event format, which chrome://tracing and Perfetto
+(ui.perfetto.dev) open as a timeline with one row per job.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class _NullSpan(object):
+    '''The span returned while tracing is off, or not sampled.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        '''Ignores extra arguments.'''
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    '''
+    A span being timed; see `Tracer.span`.  Spans opened inside it on
+    the same thread inherit its job tags.
+    '''
+
+    def __init__(self, tracer, name, cat, context, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.context = context
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.tracer._push(self.context)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        self.tracer._pop()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer._complete(self.name, self.cat, self.start, end,
+                              self.context, self.args)
+        return False
+
+    def set(self, **args):
+        '''
+        Adds arguments to the span (e.g., the outcome of the work).
+
+        Arguments:
+        - `args`:
+        '''
+        self.args.update(args)
+
+
+class Tracer(object):
+    '''
+    Records spans and instant events, and writes them to files in the
+    Chrome Trace Event (JSON array) format.
+
+    Spans are tagged with a job (`job` and `drive_id` arguments), and
+    are drawn on a row of their own for each job; spans without a job
+    are drawn on the row of their thread.  Jobs are sampled by a hash
+    of their Drive file ID, so a sampled job's timeline is complete.
+
+    Overhead is bounded: events are buffered and written in batches,
+    at most `max_events_per_sec` events are kept per second (the
+    number dropped is recorded as a counter), and each file is closed
+    once it reaches `max_file_bytes` or the day changes, keeping the
+    newest `max_files` files.
+    '''
+
+    def __init__(self):
+        '''Constructor.  Tracing is off until `configure` is called.'''
+        self.enabled = False
+        self.output_dir = None
+        self.sample_rate = 1.0
+        self.max_file_bytes = None
+        self.max_files = None
+        self.max_events_per_sec = None
+        self.flush_secs = 1.0
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._buffer = []
+        self._file = None
+        self._file_day = None
+        self._file_bytes = 0
+        self._num_files = 0
+        self._num_written = 0
+        self._last_flush = 0.0
+        self._tracks = {}
+        self._named_tracks = set()
+        self._window = None
+        self._window_events = 0
+        self._dropped = 0
+
+    def configure(self, output_dir, sample_rate=1.0,
+                  max_file_bytes=100 * 1024 ** 2, max_files=14,
+                  max_events_per_sec=1000, flush_secs=1.0):
+        '''
+        Turns tracing on.
+
+        Arguments:
+        - `output_dir`: the directory for the trace files
+        - `sample_rate`: the fraction of jobs to trace
+        - `max_file_bytes`: the size at which a file is closed
+        - `max_files`: how many trace files to keep
+        - `max_events_per_sec`: events beyond this are dropped
+        - `flush_secs`: how often buffered events are written
+        '''
+        with self._lock:
+            self.output_dir = output_dir
+            self.sample_rate = sample_rate
+            self.max_file_bytes = max_file_bytes
+            self.max_files = max_files
+            self.max_events_per_sec = max_events_per_sec
+            self.flush_secs = flush_secs
+            self.enabled = True
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        logger.info('Tracing %d%% of jobs to %s', sample_rate * 100,
+                    output_dir)
+
+    def sampled(self, drive_id):
+        '''
+        Returns True if the job for the Drive file `drive_id` is
+        traced.
+
+        Arguments:
+        - `drive_id`:
+        '''
+        if self.sample_rate >= 1.0:
+            return True
+        key = zlib.crc32(drive_id.encode('utf-8')) & 0xffffffff
+        return key % 10000 < self.sample_rate * 10000
+
+    # ------------------------------------------------------------
+    #  Recording
+    # ------------------------------------------------------------
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = [{}]
+        return stack
+
+    def _push(self, context):
+        self._stack().append(context)
+
+    def _pop(self):
+        self._stack().pop()
+
+    def _context(self, job=None, drive_id=None):
+        '''
+        Returns the job tags for a new event: those given, or else
+        those of the innermost open span on this thread.  Returns None
+        if the job is not sampled.
+        '''
+        if job is None and drive_id is None:
+            context = self._stack()[-1]
+        else:
+            context = {'job': job, 'drive_id': drive_id}
+            if drive_id is not None and not self.sampled(drive_id):
+                context['skip'] = True
+        return None if context.get('skip') else context
+
+    def span(self, name, cat, job=None, drive_id=None, **args):
+        '''
+        Returns a context manager which records the block it runs as a
+        span (a complete event).
+
+        Arguments:
+        - `name`: e.g., the state handler or API method
+        - `cat`: the category (e.g., 'state', 'api.drive')
+        - `job`: the job's name, if not inherited from an open span
+        - `drive_id`: the job's Drive file ID, likewise
+        - `args`: extra arguments shown with the span
+        '''
+        if not self.enabled:
+            return NULL_SPAN
+        context = self._context(job, drive_id)
+        if context is None:
+            return _SkippedSpan(self)
+        return _Span(self, _text(name), cat, context, args)
+
+    def complete(self, name, cat, start, end, job=None, drive_id=None,
+                 **args):
+        '''
+        Records a span which has already finished (e.g., a wait
+        measured elsewhere).
+
+        Arguments:
+        - `name`:
+        - `cat`:
+        - `start`: the start time, in seconds since the epoch
+        - `end`: the end time
+        - `job`:
+        - `drive_id`:
+        - `args`:
+        '''
+        if not self.enabled:
+            return
+        context = self._context(job, drive_id)
+        if context is not None:
+            self._complete(_text(name), cat, start, end, context, args)
+
+    def instant(self, name, cat, job=None, drive_id=None, **args):
+        '''
+        Records an instant event (e.g., a retry being scheduled).
+
+        Arguments:
+        - `name`:
+        - `cat`:
+        - `job`:
+        - `drive_id`:
+        - `args`:
+        '''
+        if not self.enabled:
+            return
+        context = self._context(job, drive_id)
+        if context is None:
+            return
+        event = self._event(_text(name), cat, time.time(), context, args)
+        event['ph'] = 'i'
+        event['s'] = 't'
+        self._record(event)
+
+    def _complete(self, name, cat, start, end, context, args):
+        event = self._event(name, cat, start, context, args)
+        event['ph'] = 'X'
+        event['dur'] = int(max(end - start, 0.0) * 1e6)
+        self._record(event)
+
+    def _event(self, name, cat, timestamp, context, args):
+        job = context.get('job')
+        if job is not None:
+            args = dict(args, job=job, drive_id=context.get('drive_id'))
+            track = 'job ' + job
+        else:
+            track = threading.current_thread().name
+        return {'name': name, 'cat': cat, 'ts': int(timestamp * 1e6),
+                'pid': self.pid, 'tid': track,
+                'args': dict((key, _text(value))
+                             for key, value in args.items())}
+
+    def _record(self, event):
+        now = time.time()
+        with self._lock:
+            window = int(now)
+            if window != self._window:
+                if self._dropped:
+                    self._buffer.append({
+                        'name': 'dropped events', 'ph': 'C',
+                        'ts': int(now * 1e6), 'pid': self.pid,
+                        'args': {'dropped': self._dropped}})
+                    logger.warning('Dropped %d trace events', self._dropped)
+                    self._dropped = 0
+                self._window = window
+                self._window_events = 0
+            if (self.max_events_per_sec is not None and
+                    self._window_events >= self.max_events_per_sec):
+                self._dropped += 1
+                return
+            self._window_events += 1
+            self._buffer.append(event)
+            if now - self._last_flush >= self.flush_secs:
+                self.flush()
+
+    # ------------------------------------------------------------
+    #  Output
+    # ------------------------------------------------------------
+
+    def _track_id(self, track, lines):
+        '''
+        Returns the numeric thread ID for the row `track`, adding a
+        metadata event naming the row to `lines` if the current file
+        does not have one yet.
+        '''
+        if track not in self._tracks:
+            self._tracks[track] = len(self._tracks) + 1
+        tid = self._tracks[track]
+        if track not in self._named_tracks:
+            self._named_tracks.add(track)
+            lines.append(json.dumps({
+                'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                'tid': tid, 'args': {'name': track}}))
+        return tid
+
+    def poll(self):
+        '''
+        Writes the buffered events if they have waited `flush_secs`.
+        Should be called regularly (e.g., once per iteration of the
+        polling loop), so that events are written while it is idle.
+        '''
+        if self._buffer and time.time() - self._last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        '''Writes the buffered events to the current trace file.'''
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._buffer:
+                return
+            self._rotate()
+            lines = []
+            for event in self._buffer:
+                if 'tid' in event:
+                    event['tid'] = self._track_id(event['tid'], lines)
+                lines.append(json.dumps(event, sort_keys=True))
+            self._buffer = []
+            # the array is left open until the file is closed; the
+            # trace viewers accept a file which ends without it
+            data = ''.join(
+                (',\n' if self._num_written + idx else '') + line
+                for idx, line in enumerate(lines)).encode('utf-8')
+            try:
+                self._file.write(data)
+                self._file.flush()
+            except (IOError, OSError) as exc:
+                logger.warning('Could not write trace events: %s', exc)
+            self._num_written += len(lines)
+            self._file_bytes += len(data)
+
+    def _rotate(self):
+        '''Opens a new trace file, if there is none or it is full.'''
+        day = time.strftime('%Y%m%d')
+        if self._file is not None and (
+                self._file_day != day or
+                self._file_bytes >= self.max_file_bytes):
+            self._close_file()
+        if self._file is not None:
+            return
+        self._num_files += 1
+        path = os.path.join(self.output_dir, 'trace-{}-{}-{:04d}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S'), self.pid, self._num_files))
+        self._file = open(path, 'wb')
+        self._file.write(b'[\n')
+        self._file_day = day
+        self._file_bytes = 0
+        self._num_written = 0
+        self._named_tracks = set()
+        logger.info('Writing trace events to %s', path)
+        self._remove_old_files()
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        try:
+            self._file.write(b'\n]\n')
+            self._file.close()
+        except (IOError, OSError) as exc:
+            logger.warning('Could not close trace file: %s', exc)
+        self._file = None
+
+    def _remove_old_files(self):
+        names = sorted(name for name in os.listdir(self.output_dir)
+                       if name.startswith('trace-') and
+                       name.endswith('.json'))
+        for name in names[:-self.max_files]:
+            try:
+                os.remove(os.path.join(self.output_dir, name))
+            except OSError as exc:
+                logger.warning('Could not delete trace file %s: %s', name,
+                               exc)
+
+    def close(self):
+        '''Writes any buffered events, and closes the trace file.'''
+        with self._lock:
+            if not self.enabled:
+                return
+            self.flush()
+            self._close_file()
+
+
+class _SkippedSpan(_NullSpan):
+    '''
+    The span returned for an unsampled job, which keeps spans nested
+    inside it from being recorded.
+    '''
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.tracer._push({'skip': True})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._pop()
+        return False
+
+
+# The tracer of this process.
+TRACER = Tracer()
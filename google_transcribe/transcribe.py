@@ -25,24 +25,45 @@ Speech API.
 
 from __future__ import absolute_import, unicode_literals
 
+import atexit
+import calendar
 import errno
+import json
 import logging
 import mimetypes
 import os
-import socket
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 
 import click
 import httplib2
 from appdirs import AppDirs
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 from oauth2client import client, tools
 from oauth2client.file import Storage
 
-from .datastore import PersistentDict
+from .cache import RETAIN_LRU, RETAIN_UNTIL_CONSUMED, CacheManager
+from .concurrency import ConcurrencyLimits
+from .config import (FolderConfig, PriorityPins, load_api_quotas,
+                     load_folder_configs)
+from .datastore import load_data
+from .jobs import JobRecord, JobStore, suffixed_name
+from .manifest import (describe_file, file_matches, md5_base64_to_hex,
+                       md5_file, wav_duration)
+from .profiling import LoopProfiler
+from .ratelimit import LIMITER, rate_limited
+from .retry import (CircuitOpenError, FatalError, RetryableError,
+                    backoff_delay, guarded)
+from .scheduler import Scheduler
+from .scratch import SCRATCH, open_mapped
+from .sharedstore import LeaseManager
+from .tracing import TRACER
+from .watchdog import Watchdog, run_subprocess
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     stream=sys.stderr, level=logging.DEBUG)
@@ -53,6 +74,10 @@ logger = logging.getLogger(__name__)
 #  CONFIGURATION
 # ============================================================
 
+# These settings are the defaults for each folder listed in the
+# configuration file (config.json in the configuration directory);
+# without a configuration file, only FOLDER_NAME is monitored.
+
 # The name of the folder on the user's Google Drive which will be
 # monitored for audio recording files.
 FOLDER_NAME = 'Exams'
@@ -61,9 +86,163 @@ FOLDER_NAME = 'Exams'
 # are stored during transcription.
 BUCKET = 'semantics-exam-marking.appspot.com'
 
+# The language of the recordings, as a BCP-47 language tag.
+LANGUAGE = 'en-US'
+
+# Words or phrases which the Speech API should expect to hear.
+PHRASES = ["semantics", "representation", "representational",
+           "denotation", "denotational", "reference", "referential"]
+
+# Credentials files (in the credentials directory): the OAuth 2.0
+# client ID and token storage for Google Drive, and the Google Cloud
+# Service account key.
+CLIENT_SECRET_FILE = 'secret.json'
+OAUTH_STORAGE_FILE = 'storage.dat'
+SERVICE_ACCOUNT_FILE = 'semantics-exam-marking.json'
+
+FOLDER_DEFAULTS = {
+    'name': FOLDER_NAME,
+    'bucket': BUCKET,
+    'language': LANGUAGE,
+    'phrases': PHRASES,
+    'client_secret': CLIENT_SECRET_FILE,
+    'oauth_storage': OAUTH_STORAGE_FILE,
+    'service_account': SERVICE_ACCOUNT_FILE,
+}
+
 # The name of the user agent to represent this app to Google Drive
 USER_AGENT_NAME = 'Samarkand'
 
+# Rate limits for the Google APIs, derived from the project's quotas;
+# these can be overridden in the "quotas" section of the
+# configuration file.  Keys are API names, or API method names, and
+# rates are in calls per second.
+API_QUOTAS = {
+    # Drive: 1000 queries per 100 seconds per user
+    'drive': {'rate': 10.0, 'burst': 20},
+    # Cloud Storage: writes to a bucket are ramped up gradually
+    'storage': {'rate': 50.0, 'burst': 50},
+    'storage.objects.insert': {'rate': 5.0, 'burst': 10},
+    # Speech: 900 requests per minute
+    'speech': {'rate': 15.0, 'burst': 15},
+}
+
+# Timeout in seconds for connecting to, and for each read from, the
+# Google APIs.
+HTTP_TIMEOUT_SECS = 60
+
+# Size in bytes of each chunk of an upload to Cloud Storage (a
+# multiple of 256 KB).
+UPLOAD_CHUNK_BYTES = 8 * 1024 ** 2
+
+# The private Google Drive property (appProperties) of a transcription
+# which holds the file ID of its recording.
+TRANSCRIPTION_RECORDING_PROPERTY = 'recording_id'
+
+# Deadline in seconds for each run of ffmpeg or sox.
+SUBPROCESS_TIMEOUT_SECS = 60 * 60
+
+# Time budget in seconds for a single tick of a TranscriptionJobAction
+# in each state; a tick which runs longer is aborted by the watchdog
+# and retried later.
+STAGE_DEADLINES = {
+    'uploaded': 60 * 60,
+    'downloaded': SUBPROCESS_TIMEOUT_SECS + 60,
+    'wav': SUBPROCESS_TIMEOUT_SECS + 60,
+    'trimmed': 60 * 60,
+    'stored': 5 * 60,
+    'submitted': 5 * 60,
+    'transcribed': 10 * 60,
+    'saved': 5 * 60,
+    'cleaned': 60,
+}
+
+# Time budget in seconds for a tick of a DriveMonitorAction.
+MONITOR_DEADLINE_SECS = 5 * 60
+
+# How long to wait before retrying an action whose tick stalled.
+STALL_RETRY_SECS = 60
+
+# Retry policy for failed Google API calls: the bound on the first
+# backoff, the largest bound, and the number of consecutive failed
+# attempts after which a job is given up on.
+RETRY_BASE_SECS = 5
+RETRY_MAX_SECS = 30 * 60
+RETRY_MAX_ATTEMPTS = 10
+
+# Speech API operations which have not finished after this many
+# seconds are cancelled and resubmitted.
+SPEECH_OPERATION_DEADLINE_SECS = 6 * 60 * 60
+
+# The audio format which the Speech API is asked to transcribe: 16 kHz
+# mono LINEAR16.  Inputs are converted to this format, unless they
+# are already WAV files in it.
+SPEECH_SAMPLE_RATE = 16000
+SPEECH_CHANNELS = 1
+SPEECH_CODEC = 'pcm_s16le'
+
+# Jobs are worked on shortest first.  The processing time left for a
+# job is estimated from its audio duration and from the estimated
+# cost of each of its remaining stages, in seconds per second of audio
+# (indexed by the state which the stage starts from).  Until a job's
+# recording is downloaded and probed, its duration is estimated from
+# its size on Google Drive.
+STAGE_COSTS = {
+    'uploaded': 0.02,       # download
+    'downloaded': 0.05,     # transcode
+    'wav': 0.02,            # trim silence
+    'trimmed': 0.03,        # upload
+    'submitted': 0.4,       # Speech API
+}
+ESTIMATED_BYTES_PER_AUDIO_SEC = 4000
+UNKNOWN_DURATION_SECS = 30 * 60
+
+# How much a waiting job's priority improves, in seconds of estimated
+# processing time per second waited, so that long jobs are not starved
+# by a stream of short ones.
+PRIORITY_AGING_RATE = 1.0
+
+# Adaptive limits on the number of operations of each kind in flight
+# at once (see concurrency.AIMDLimit).  The daemon limits its Speech
+# API operations; batch mode also limits its transcodes (backing off
+# when the machine is loaded) and its uploads, up to --jobs of each.
+# A Speech API operation is first polled after 15 seconds and then
+# every 10 seconds, so its latency is only known to within 25 seconds.
+CONCURRENCY_LIMITS = {
+    'speech': {'initial': 8, 'maximum': 200, 'tolerance': 3.0,
+               'holdoff_secs': 60, 'resolution_secs': 25},
+    'transcode': {'initial': 2, 'max_load': 1.0},
+    'upload': {'initial': 2},
+}
+
+# The default byte budget for the intermediate audio and text files
+# kept in the cache directory.
+CACHE_BUDGET_BYTES = 2 * 1024 ** 3
+
+# The default byte budget for the intermediate files kept in memory
+# with --ram-scratch; files beyond it are spilled to the cache
+# directory.
+RAM_SCRATCH_BUDGET_BYTES = 512 * 1024 ** 2
+
+# Retention policy for each kind of intermediate file: RETAIN_LRU
+# files are kept until the cache runs over its budget, and
+# RETAIN_UNTIL_CONSUMED files are deleted as soon as the job which
+# produced them has no further use for them.
+CACHE_RETENTION = {
+    'input': RETAIN_LRU,
+    'wav': RETAIN_UNTIL_CONSUMED,
+    'trimmed': RETAIN_LRU,
+    'transcription': RETAIN_LRU,
+}
+
+# Limits on the timeline traces written with --trace-dir: the size at
+# which a trace file is closed (a new one is also started each day),
+# how many files are kept, and how many events are kept per second
+# (the rest are dropped and counted).
+TRACE_MAX_FILE_BYTES = 100 * 1024 ** 2
+TRACE_MAX_FILES = 14
+TRACE_MAX_EVENTS_PER_SEC = 1000
+
 # ============================================================
 #  AUTHORISATION
 # ============================================================
@@ -89,65 +268,114 @@ def get_credentials_path(filename, check_file_exists=True):
     return path
 
 
-def get_drive_service():
+def get_drive_service(client_secret=CLIENT_SECRET_FILE,
+                      oauth_storage=OAUTH_STORAGE_FILE):
     '''
     Returns an object used to interact with the Google Drive API.
+
+    Arguments:
+    - `client_secret`: filename of the OAuth 2.0 client ID in the
+      credentials directory
+    - `oauth_storage`: filename where the OAuth 2.0 token is kept in
+      the credentials directory
     '''
     flow = client.flow_from_clientsecrets(
-        get_credentials_path('secret.json'),
+        get_credentials_path(client_secret),
         'https://www.googleapis.com/auth/drive')
     flow.user_agent = USER_AGENT_NAME
-    store = Storage(get_credentials_path('storage.dat', False))
+    store = Storage(get_credentials_path(oauth_storage, False))
     credentials = store.get()
     if not credentials or credentials.invalid:
         flags = tools.argparser.parse_args(args=[])
         credentials = tools.run_flow(flow, store, flags)
-    http = credentials.authorize(httplib2.Http())
+    http = credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT_SECS))
     service = discovery.build('drive', 'v3', http=http)
     return service
 
 
-def get_service_acct_http():
+def get_service_acct_http(service_account=SERVICE_ACCOUNT_FILE):
     '''
     Returns an HTTP connection object which is authorised using this
     app's Google Service Account.
+
+    Arguments:
+    - `service_account`: filename of the Google Cloud Service account
+      key in the credentials directory
     '''
-    # Application default credentials provided by env variable
-    # GOOGLE_APPLICATION_CREDENTIALS
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = get_credentials_path(
-        'semantics-exam-marking.json')
-    credentials = (client.GoogleCredentials.get_application_default()
+    credentials = (client.GoogleCredentials.from_stream(
+        get_credentials_path(service_account))
                    .create_scoped(
                        ['https://www.googleapis.com/auth/cloud-platform']))
-    http = httplib2.Http()
+    http = httplib2.Http(timeout=HTTP_TIMEOUT_SECS)
     credentials.authorize(http)
     return http
 
 
-def get_storage_service():
+def get_storage_service(service_account=SERVICE_ACCOUNT_FILE):
     '''
     Returns an object used to interact with the Google Cloud Storage
     API.
+
+    Arguments:
+    - `service_account`:
     '''
-    http = get_service_acct_http()
+    http = get_service_acct_http(service_account)
     return discovery.build('storage', 'v1', http=http)
 
 
-def get_speech_service():
+def get_speech_service(service_account=SERVICE_ACCOUNT_FILE):
     '''
     Returns an object used to interact with the Google Cloud Speech
     API.
+
+    Arguments:
+    - `service_account`:
     '''
-    http = get_service_acct_http()
+    http = get_service_acct_http(service_account)
     service = discovery.build('speech', 'v1', http=http)
     return service
 
 
+def get_folder_services(folders, shared):
+    '''
+    Builds the services dict for each monitored folder.  Folders which
+    use the same credentials share the same service objects (and so
+    the same HTTP connections).  Returns a dict mapping folder names
+    to services dicts.
+
+    Arguments:
+    - `folders`: a list of `FolderConfig` objects
+    - `shared`: a dict of entries which are common to every folder's
+      services dict (e.g., the cache manager)
+    '''
+    drive_services = {}
+    cloud_services = {}
+    folder_services = {}
+    for folder in folders:
+        if folder.drive_credentials not in drive_services:
+            drive_services[folder.drive_credentials] = get_drive_service(
+                folder.client_secret, folder.oauth_storage)
+        if folder.cloud_credentials not in cloud_services:
+            cloud_services[folder.cloud_credentials] = (
+                get_storage_service(folder.service_account),
+                get_speech_service(folder.service_account))
+        storage, speech = cloud_services[folder.cloud_credentials]
+        services = dict(shared)
+        services.update({'drive': drive_services[folder.drive_credentials],
+                         'storage': storage,
+                         'speech': speech,
+                         'folder': folder})
+        folder_services[folder.name] = services
+    return folder_services
+
+
 # ============================================================
 #  GOOGLE DRIVE API
 # ============================================================
 
 
+@guarded('drive')
+@rate_limited('drive', 'files.list')
 def drive_get_folder_id(drive_service, folder_name):
     '''
     Finds the folder ID of the folder with the given name on the
@@ -169,6 +397,8 @@ def drive_get_folder_id(drive_service, folder_name):
     return results['files'][0]['id']
 
 
+@guarded('drive')
+@rate_limited('drive', 'files.list')
 def drive_list_most_recent_files(drive_service, folder_id):
     '''
     Lists the most recent files in the given folder of the user's
@@ -186,18 +416,90 @@ def drive_list_most_recent_files(drive_service, folder_id):
         spaces='drive',
         corpus='user',
         fields=("nextPageToken, files(id, mimeType, modifiedTime, "
-                "name, parents)")).execute()
+                "name, parents, size, md5Checksum)")).execute()
     return results
 
 
+@guarded('drive')
+@rate_limited('drive', 'files.list')
+def drive_list_folder_page(drive_service, folder_id, page_token=None):
+    '''
+    Lists one page of the audio recording and TXT files in the given
+    folder of the user's Google Drive.
+
+    Arguments:
+    - `drive_service`:
+    - `folder_id`:
+    - `page_token`: the nextPageToken of the previous page
+    '''
+    return drive_service.files().list(
+        pageSize=1000,
+        pageToken=page_token,
+        q=("'{}' in parents and trashed = false and "
+           "(mimeType contains 'audio/' or mimeType = 'text/plain')").format(
+               folder_id),
+        spaces='drive',
+        corpus='user',
+        fields=("nextPageToken, files(id, mimeType, modifiedTime, "
+                "name, parents, size, md5Checksum, appProperties)")).execute()
+
+
+def drive_list_folder(drive_service, folder_id):
+    '''
+    Lists all of the audio recording and TXT files in the given folder
+    of the user's Google Drive, one page at a time.
+
+    Arguments:
+    - `drive_service`:
+    - `folder_id`:
+    '''
+    files = []
+    page_token = None
+    while True:
+        results = drive_list_folder_page(drive_service, folder_id,
+                                         page_token)
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+
+@guarded('drive')
+@rate_limited('drive', 'files.list')
+def drive_find_file(drive_service, name, folder_id):
+    '''
+    Finds the file with the given name in the given folder of the
+    user's Google Drive.  Returns a dict with the file's id, size and
+    md5Checksum, or None if there is no such file.
+
+    Arguments:
+    - `drive_service`:
+    - `name`:
+    - `folder_id`:
+    '''
+    results = drive_service.files().list(
+        pageSize=1,
+        q="'{}' in parents and name = '{}' and trashed = false".format(
+            folder_id, name.replace("\\", "\\\\").replace("'", "\\'")),
+        spaces='drive',
+        corpus='user',
+        fields="files(id, size, md5Checksum)").execute()
+    if not results or not results.get('files'):
+        return None
+    return results['files'][0]
+
+
 # https://developers.google.com/drive/v3/web/about-sdk
 # https://developers.google.com/drive/v3/web/manage-downloads
 # https://developers.google.com/drive/v3/web/about-auth
+@guarded('drive')
 def drive_download_file(drive_service, file_id, output_filename,
                         verbose=False):
     '''
     Downloads the file with the given file ID on the user's Google
-    Drive to the local file with the path `output_filename`.
+    Drive to the local file with the path `output_filename`.  The
+    download is rate limited per chunk, since each chunk is a separate
+    request.
 
     Arguments:
     - `drive_service`:
@@ -210,6 +512,8 @@ def drive_download_file(drive_service, file_id, output_filename,
         downloader = MediaIoBaseDownload(output_file, request)
         done = False
         while done is False:
+            # each chunk is a separate request
+            LIMITER.acquire('drive', 'files.get_media')
             status, done = downloader.next_chunk()
             if verbose:
                 logger.info("Download %d%%.", int(status.progress() * 100))
@@ -218,8 +522,10 @@ def drive_download_file(drive_service, file_id, output_filename,
 # http://stackoverflow.com/q/20922944/1062499
 # https://developers.google.com/drive/v3/web/manage-uploads
 # https://developers.google.com/drive/v3/reference/files/create
+@guarded('drive')
+@rate_limited('drive', 'files.create')
 def drive_upload_file(drive_service, input_filename, parent_folder_ids,
-                      mimetype=None):
+                      mimetype=None, properties=None):
     '''
     Uploads a file from the local disk (stored at `input_filename`) to
     the user's Google Drive, placing it in the directories indicated
@@ -231,6 +537,8 @@ def drive_upload_file(drive_service, input_filename, parent_folder_ids,
     - `parent_folder_ids`: a list of Google Drive folder IDs, where
       the file will be stored
     - `mimetype`:
+    - `properties`: a dict of private properties of this application
+      to set on the file
     '''
     if mimetype is None:
         mimetype, _enc = mimetypes.guess_type(input_filename)
@@ -240,6 +548,8 @@ def drive_upload_file(drive_service, input_filename, parent_folder_ids,
     }
     if mimetype is not None:
         body['mimeType'] = mimetype
+    if properties:
+        body['appProperties'] = properties
 
     with open(input_filename, 'rb') as input_file:
         req = drive_service.files().create(
@@ -254,61 +564,191 @@ def drive_upload_file(drive_service, input_filename, parent_folder_ids,
 # ============================================================
 
 
+def storage_object_name(filename, prefix=''):
+    '''
+    Returns the name of the Google Cloud Storage object for the local
+    file `filename`.
+
+    Arguments:
+    - `filename`:
+    - `prefix`: prepended to the name (see `FolderConfig`)
+    '''
+    return prefix + os.path.basename(filename)
+
+
 # https://cloud.google.com/storage/docs/json_api/v1/json-api-python-samples
-def storage_upload_object(storage_service, bucket, filename):
+@guarded('storage')
+@rate_limited('storage', 'objects.insert')
+def storage_upload_object(storage_service, bucket, filename, prefix=''):
     '''
     Uploads a file from the local drive to the Google Cloud Storage.
+    The upload is resumable, and rate limited per chunk, since each
+    chunk is a separate request.
 
     Arguments:
     - `storage_service`:
     - `bucket`:
     - `filename`:
+    - `prefix`: see `storage_object_name`
     '''
     # This is the request body as specified:
     # http://g.co/cloud/storage/docs/json_api/v1/objects/insert#request
     body = {
-        'name': os.path.basename(filename),
+        'name': storage_object_name(filename, prefix),
     }
 
     # Now insert them into the specified bucket as a media insertion.
     # http://g.co/dv/resources/api-libraries/documentation/storage/v1/python/latest/storage_v1.objects.html#insert
-    with open(filename, 'rb') as input_file:
+    with open_mapped(filename) as input_file:
         req = storage_service.objects().insert(
             bucket=bucket, body=body,
-            # You can also just set media_body=filename, but for the sake of
-            # demonstration, pass in the more generic file handle, which could
-            # very well be a StringIO or similar.
+            # chunks are read from the memory-mapped file as they are
+            # sent, so the file is never held in a buffer as a whole
             media_body=MediaIoBaseUpload(input_file,
-                                         'application/octet-stream'))
-        resp = req.execute()
+                                         'application/octet-stream',
+                                         chunksize=UPLOAD_CHUNK_BYTES,
+                                         resumable=True))
+        _status, resp = req.next_chunk()
+        while resp is None:
+            # each further chunk is a separate request
+            LIMITER.acquire('storage', 'objects.insert')
+            _status, resp = req.next_chunk()
 
     return resp
 
 
+@guarded('storage')
+@rate_limited('storage', 'objects.get')
+def storage_get_object(storage_service, bucket, filename, prefix=''):
+    '''
+    Gets the metadata (including size and md5Hash) of a file on the
+    Google Cloud Storage, or None if there is no such file.
+
+    Arguments:
+    - `storage_service`:
+    - `bucket`:
+    - `filename`:
+    - `prefix`: see `storage_object_name`
+    '''
+    req = storage_service.objects().get(
+        bucket=bucket, object=storage_object_name(filename, prefix))
+    try:
+        return req.execute()
+    except HttpError as exc:
+        if int(exc.resp.status) == 404:
+            return None
+        raise
+
+
+def storage_object_matches(response, manifest):
+    '''
+    Returns True if the Google Cloud Storage object metadata
+    `response` has the size and MD5 checksum in `manifest`.
+
+    Arguments:
+    - `response`:
+    - `manifest`: a dict with the keys 'size' and 'md5' (see
+      `manifest.describe_file`)
+    '''
+    return (int(response['size']) == manifest['size'] and
+            'md5Hash' in response and
+            md5_base64_to_hex(response['md5Hash']) == manifest['md5'])
+
+
 # https://cloud.google.com/storage/docs/json_api/v1/json-api-python-samples
-def storage_delete_object(storage_service, bucket, filename):
+@guarded('storage')
+@rate_limited('storage', 'objects.delete')
+def storage_delete_object(storage_service, bucket, filename, prefix=''):
     '''
-    Deletes a file from the Google Cloud Storage.
+    Deletes a file from the Google Cloud Storage.  A file which is
+    already gone is not an error.
 
     Arguments:
     - `storage_service`:
     - `bucket`:
     - `filename`:
+    - `prefix`: see `storage_object_name`
     '''
-    req = storage_service.objects().delete(bucket=bucket,
-                                           object=os.path.basename(filename))
-    resp = req.execute()
+    req = storage_service.objects().delete(
+        bucket=bucket, object=storage_object_name(filename, prefix))
+    try:
+        resp = req.execute()
+    except HttpError as exc:
+        if int(exc.resp.status) == 404:
+            return None
+        raise
 
     return resp
 
 
+@guarded('storage')
+@rate_limited('storage', 'objects.list')
+def storage_list_objects_page(storage_service, bucket, prefix='',
+                              page_token=None):
+    '''
+    Lists one page of the files on the Google Cloud Storage whose
+    names start with `prefix`.
+
+    Arguments:
+    - `storage_service`:
+    - `bucket`:
+    - `prefix`:
+    - `page_token`: the nextPageToken of the previous page
+    '''
+    req = storage_service.objects().list(
+        bucket=bucket, prefix=prefix or None, pageToken=page_token,
+        fields=('nextPageToken, '
+                'items(name, size, md5Hash, generation, timeCreated)'))
+    return req.execute()
+
+
+def storage_object_age(obj):
+    '''
+    Returns the age in seconds of a Google Cloud Storage object, from
+    its entry in an objects.list response, or None if it is not known.
+
+    Arguments:
+    - `obj`:
+    '''
+    created = obj.get('timeCreated')
+    if not created:
+        return None
+    # RFC 3339 in UTC, e.g., 2016-10-29T12:34:56.789Z
+    return time.time() - calendar.timegm(
+        time.strptime(created[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def storage_list_objects(storage_service, bucket, prefix=''):
+    '''
+    Lists all of the files on the Google Cloud Storage whose names
+    start with `prefix`, one page at a time.
+
+    Arguments:
+    - `storage_service`:
+    - `bucket`:
+    - `prefix`:
+    '''
+    objects = []
+    page_token = None
+    while True:
+        response = storage_list_objects_page(storage_service, bucket,
+                                             prefix, page_token)
+        objects.extend(response.get('items', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return objects
+
+
 # ============================================================
 #  GOOGLE CLOUD SPEECH API
 # ============================================================
 
 
+@guarded('speech')
+@rate_limited('speech', 'longrunningrecognize')
 def submit_transcription_request(speech_service, bucket, filename,
-                                 phrases=None):
+                                 phrases=None, language_code='en-US',
+                                 prefix=''):
     '''
     Submits a job to the Google Cloud Speech API for asynchronous
     speech transcription.
@@ -320,16 +760,19 @@ def submit_transcription_request(speech_service, bucket, filename,
       storage to recognise
     - `phrases`: if specified, a list of words or phrases which Google
       should respect in the given audio data
+    - `language_code`: a BCP-47 language tag
+    - `prefix`: see `storage_object_name`
     '''
-    speech_file = 'gs://{}/{}'.format(bucket, os.path.basename(filename))
+    speech_file = 'gs://{}/{}'.format(bucket,
+                                      storage_object_name(filename, prefix))
     body = {
         'config': {
             # There are a bunch of config options you can specify. See
             # https://goo.gl/KPZn97 for the full list.
             'encoding': 'LINEAR16',  # raw 16-bit signed LE samples
-            'sampleRateHertz': 16000,  # 16 khz
+            'sampleRateHertz': SPEECH_SAMPLE_RATE,  # 16 khz
             # See https://goo.gl/A9KJ1A for a list of supported languages.
-            'languageCode': 'en-US',  # a BCP-47 language tag
+            'languageCode': language_code,  # a BCP-47 language tag
         },
         'audio': {
             'uri': speech_file
@@ -343,6 +786,8 @@ def submit_transcription_request(speech_service, bucket, filename,
     return response
 
 
+@guarded('speech')
+@rate_limited('speech', 'operations.get')
 def poll_transcription_results(speech_service, name):
     '''
     Polls the Google speech recognition service to determine the state
@@ -357,6 +802,37 @@ def poll_transcription_results(speech_service, name):
     return service_request.execute()
 
 
+@guarded('speech')
+@rate_limited('speech', 'operations.cancel')
+def cancel_transcription_request(speech_service, name):
+    '''
+    Asks the Google speech recognition service to cancel a speech
+    recognition job.
+
+    Arguments:
+    - `speech_service`:
+    - `name`: the ID of the speech recognition job
+    '''
+    service_request = speech_service.operations().cancel(name=name)
+    return service_request.execute()
+
+
+def write_transcription(response, output_filename):
+    '''
+    Writes the transcription in a finished speech recognition job
+    (the result of `poll_transcription_results`) to a TXT file, one
+    line per result.
+
+    Arguments:
+    - `response`:
+    - `output_filename`:
+    '''
+    with open(output_filename, 'w') as output_file:
+        for result in response['response'].get('results', []):
+            output_file.write(result['alternatives'][0]['transcript'] +
+                              "\n")
+
+
 # ============================================================
 #  LOCAL FILE MANAGEMENT AND SUBPROCESSING
 # ============================================================
@@ -375,7 +851,37 @@ def mkdir_p(path):
             raise
 
 
-def local_input_file_path(filename):
+# The local paths below are resolved through the scratch space (see
+# scratch.ScratchSpace), which keeps files in the cache directory, or,
+# with --ram-scratch, in memory up to a budget.  A file may be moved
+# from memory to disk between ticks, so paths should not be kept.
+# Where only a file's name is needed (e.g., for the Cloud Storage
+# object name), use the name functions, which do not look for it.
+
+def wav_name(filename):
+    '''
+    Returns the file name of the (trimmed) WAV file of an audio
+    recording file, which is also the name of its Cloud Storage
+    object (see `storage_object_name`).
+
+    Arguments:
+    - `filename`: the filename of the audio recording file
+    '''
+    return os.path.splitext(os.path.basename(filename))[0] + '.wav'
+
+
+def transcription_name(filename):
+    '''
+    Returns the file name of the transcription of an audio recording
+    file.
+
+    Arguments:
+    - `filename`: the filename of the audio recording file
+    '''
+    return os.path.splitext(os.path.basename(filename))[0] + '.txt'
+
+
+def local_input_file_path(filename, size=None):
     '''
     Returns the path on the local drive where audio recording files
     are downloaded to.
@@ -383,72 +889,163 @@ def local_input_file_path(filename):
     Arguments:
     - `filename`: the filename of an audio recording file; this file
       may be in a variety of formats (e.g., AMR, WAV, M4A, etc.)
+    - `size`: the expected size of the file, if it is about to be
+      written
     '''
-    path = os.path.join(APP_CACHE_DIR, 'amr_files')
-    mkdir_p(path)
-    return os.path.join(path, os.path.basename(filename))
+    return SCRATCH.path('amr_files', os.path.basename(filename), size)
 
 
-def local_wav_path(filename):
+def local_wav_path(filename, size=None):
     '''
     Returns the path on the local drive where WAV files are stored.
 
     Arguments:
     - `filename`: the filename of the audio recording file
+    - `size`: the expected size of the file, if it is about to be
+      written
     '''
-    path = os.path.join(APP_CACHE_DIR, 'wav_files')
-    mkdir_p(path)
-    return os.path.join(path,
-                        os.path.splitext(os.path.basename(filename))[0] +
-                        '.wav')
+    return SCRATCH.path('wav_files', wav_name(filename), size)
 
 
-def local_trimmed_wav_path(filename):
+def local_trimmed_wav_path(filename, size=None):
     '''
     Returns the path on the local drive where trimmed WAV files are
     stored.
 
     Arguments:
     - `filename`: the filename of the audio recording file
+    - `size`: the expected size of the file, if it is about to be
+      written
     '''
-    path = os.path.join(APP_CACHE_DIR, 'trimmed_wav_files')
-    mkdir_p(path)
-    return os.path.join(path,
-                        os.path.splitext(os.path.basename(filename))[0] +
-                        '.wav')
+    return SCRATCH.path('trimmed_wav_files', wav_name(filename), size)
 
 
-def local_transcription_path(filename):
+def local_transcription_path(filename, size=None):
     '''
     Returns the path on the local drive where transcribed TXT files
     are stored.
 
     Arguments:
     - `filename`: the filename of the audio recording file
+    - `size`: the expected size of the file, if it is about to be
+      written
+    '''
+    return SCRATCH.path('transcriptions', transcription_name(filename),
+                        size)
+
+
+def spill_scratch(cache, keep=()):
+    '''
+    Moves intermediate files from memory to disk until the scratch
+    space is within its budget (see `scratch.ScratchSpace.spill`), and
+    tells the cache manager where they went.
+
+    Arguments:
+    - `cache`: the `CacheManager`
+    - `keep`: paths to leave in memory if possible
+    '''
+    for path, new_path in SCRATCH.spill(keep):
+        cache.rename(path, new_path)
+
+
+# The intermediate files written by a TranscriptionJobAction: the kind
+# of artifact, the function giving its path, and the last job state
+# in which the file is still needed.  The kind is also the key of the
+# file's manifest in the job record's 'artifacts'.
+JOB_ARTIFACTS = [
+    ('input', local_input_file_path, 'downloaded'),
+    ('wav', local_wav_path, 'wav'),
+    ('trimmed', local_trimmed_wav_path, 'trimmed'),
+    ('transcription', local_transcription_path, 'transcribed'),
+]
+
+
+FFPROBE = subprocess.check_output(['which', 'ffprobe']).strip()
+
+
+def probe_audio(input_filename):
+    '''
+    Uses ffprobe to find the format of an audio recording file.
+    Returns a dict with the keys 'format', 'codec', 'sample_rate',
+    'channels' and 'duration' (in seconds), describing the file's
+    first audio stream, or None if ffprobe cannot read the file.
+
+    Arguments:
+    - `input_filename`:
+    '''
+    with tempfile.TemporaryFile() as output_file:
+        status = run_subprocess([FFPROBE, '-v', 'error',
+                                 '-select_streams', 'a:0',
+                                 '-show_entries',
+                                 'format=format_name,duration:'
+                                 'stream=codec_name,sample_rate,channels,'
+                                 'duration',
+                                 '-of', 'json', input_filename],
+                                SUBPROCESS_TIMEOUT_SECS, stdout=output_file)
+        output_file.seek(0)
+        output = output_file.read().decode('utf-8')
+    if status != 0:
+        return None
+    data = json.loads(output)
+    if not data.get('streams'):
+        return None
+    stream = data['streams'][0]
+    fmt = data.get('format', {})
+    duration = stream.get('duration', fmt.get('duration'))
+    return {
+        'format': fmt.get('format_name'),
+        'codec': stream.get('codec_name'),
+        'sample_rate': int(stream.get('sample_rate', 0)),
+        'channels': int(stream.get('channels', 0)),
+        'duration': float(duration) if duration is not None else None,
+    }
+
+
+def is_speech_ready(probe):
+    '''
+    Returns True if the result of `probe_audio` describes a WAV file
+    which is already in the format sent to the Speech API.
+
+    Arguments:
+    - `probe`:
     '''
-    path = os.path.join(APP_CACHE_DIR, 'transcriptions')
-    mkdir_p(path)
-    return os.path.join(path,
-                        os.path.splitext(os.path.basename(filename))[0] +
-                        '.txt')
+    return (probe is not None and probe['format'] == 'wav' and
+            probe['codec'] == SPEECH_CODEC and
+            probe['sample_rate'] == SPEECH_SAMPLE_RATE and
+            probe['channels'] == SPEECH_CHANNELS)
 
 
 FFMPEG = subprocess.check_output(['which', 'ffmpeg']).strip()
 
 
-def convert_input_to_wav(input_filename, wav_filename):
+def convert_input_to_wav(input_filename, wav_filename, probe=None):
     '''
     Converts an audio recording file into a WAV file using ffmpeg.
     The original audio recording file may be in a variety of formats
     (e.g., AMR, WAV, M4A, etc.).  Ffmpeg is used to convert between
     these possible input formats and PCM16 WAV files, which are used
-    by this program internally.
+    by this program internally; the conversion also downmixes and
+    resamples to the format sent to the Speech API.  If `probe` shows
+    that the input is already in that format, it is copied instead.
 
     Arguments:
     - `input_filename`:
     - `wav_filename`:
+    - `probe`: the result of `probe_audio` for the input file
     '''
-    subprocess.call([FFMPEG, '-i', input_filename, wav_filename])
+    if is_speech_ready(probe):
+        if os.path.exists(wav_filename):
+            os.remove(wav_filename)
+        try:
+            os.link(input_filename, wav_filename)
+        except OSError:
+            shutil.copyfile(input_filename, wav_filename)
+        return 0
+    return run_subprocess([FFMPEG, '-y', '-i', input_filename,
+                           '-vn', '-acodec', SPEECH_CODEC,
+                           '-ac', str(SPEECH_CHANNELS),
+                           '-ar', str(SPEECH_SAMPLE_RATE), wav_filename],
+                          SUBPROCESS_TIMEOUT_SECS)
 
 
 SOX = subprocess.check_output(['which', 'sox']).strip()
@@ -466,10 +1063,11 @@ def trim_silence(input_wav_filename, output_wav_filename):
     ignore_bursts_secs = '0.1'
     minimum_silence_secs = '2.0'
     # http://unix.stackexchange.com/questions/293376/remove-silence-from-audio-files-while-leaving-gaps
-    subprocess.call([SOX, input_wav_filename, output_wav_filename,
-                     'silence', '-l',
-                     '1', ignore_bursts_secs, silence_threshold,
-                     '-1', minimum_silence_secs, silence_threshold])
+    return run_subprocess([SOX, input_wav_filename, output_wav_filename,
+                           'silence', '-l',
+                           '1', ignore_bursts_secs, silence_threshold,
+                           '-1', minimum_silence_secs, silence_threshold],
+                          SUBPROCESS_TIMEOUT_SECS)
 
 
 # ============================================================
@@ -480,12 +1078,14 @@ def trim_silence(input_wav_filename, output_wav_filename):
 class LoopAction(object):
     '''An action which runs in the polling loop.'''
 
-    def __init__(self, pstorage, services, poll_loop):
+    def __init__(self, jobs, services, poll_loop):
         '''Constructor.'''
-        self.pstorage = pstorage
+        self.jobs = jobs
         self.services = services
         self.poll_loop = poll_loop
         self.next_tick_time = time.time() - 1
+        # when the `Scheduler` last finished ticking this action
+        self.last_tick_time = 0.0
 
     def __str__(self):
         return '<LoopAction>'
@@ -510,6 +1110,62 @@ class LoopAction(object):
         '''Identity predicate: returns True if this job is `job_id`.'''
         return False
 
+    def profile_key(self):
+        '''
+        Returns the name under which the tick timings of this action
+        are accumulated by the `LoopProfiler`.
+        '''
+        return type(self).__name__
+
+    def priority(self):
+        '''
+        Returns the estimated processing time in seconds left for this
+        action; the `Scheduler` ticks ready actions with the smallest
+        first.
+        '''
+        return 0.0
+
+    def share_group(self):
+        '''
+        Returns the name of the group whose share of the `Scheduler`
+        this action uses: the Google Drive folder it works for.
+        '''
+        return self.services['folder'].name
+
+    def tick_budget(self):
+        '''
+        Returns the time budget in seconds for this action's next
+        tick, which the `Watchdog` enforces, or None for no budget.
+        '''
+        return None
+
+    def trace_tags(self):
+        '''
+        Returns the job tags (see `tracing.Tracer.span`) for the
+        spans recorded while this action runs.
+        '''
+        return {}
+
+    def stalled(self, exc):
+        '''
+        Called by the `Watchdog` after a tick of this action was
+        aborted for running past its budget.
+
+        Arguments:
+        - `exc`: the `StageTimeout`
+        '''
+        self.set_next_tick(STALL_RETRY_SECS)
+
+    def tick_failed(self, exc):
+        '''
+        Called by the `Watchdog` after a tick of this action raised an
+        unexpected exception.
+
+        Arguments:
+        - `exc`:
+        '''
+        self.set_next_tick(STALL_RETRY_SECS)
+
 
 # interpret timestamps on file objects:
 #
@@ -519,139 +1175,674 @@ class LoopAction(object):
 # datetime.datetime.now(tz=pytz.utc) > dt
 
 
+def same_name_ids(files):
+    '''
+    Returns a dict mapping the names of the files in a Google Drive
+    files.list response to the lists of their IDs.
+
+    Arguments:
+    - `files`:
+    '''
+    ids = {}
+    for dfile in files:
+        ids.setdefault(dfile['name'], []).append(dfile['id'])
+    return ids
+
+
+def new_job_record(jobs, folder_name, dfile, state='uploaded', others=(),
+                   local_name=None):
+    '''
+    Returns a new job record for a file in a Google Drive folder.  If
+    other recordings share its name, the job's local files and
+    transcription may be named after the file ID as well (see
+    `jobs.JobStore.unique_local_name`).
+
+    Arguments:
+    - `jobs`: the `JobStore`
+    - `folder_name`:
+    - `dfile`: the file's entry in a Google Drive files.list response
+    - `state`: the job's starting state
+    - `others`: the IDs of the other files listed with the same name
+    - `local_name`: the job's local name, if it is known already
+    '''
+    return JobRecord(
+        dfile['id'], dfile['name'], folder_name, state=state,
+        local_name=local_name or jobs.unique_local_name(
+            dfile['name'], dfile['id'], others),
+        drive_parents=dfile['parents'],
+        drive_md5=dfile.get('md5Checksum'),
+        drive_size=dfile.get('size'),
+        created_time=time.time())
+
+
 class DriveMonitorAction(LoopAction):
     '''Monitor the Google Drive folder and create new jobs.'''
 
-    def __init__(self, pstorage, services, poll_loop, folder_name):
+    def __init__(self, jobs, services, poll_loop, folder_name):
         '''Constructor.'''
-        super(DriveMonitorAction, self).__init__(pstorage, services, poll_loop)
+        super(DriveMonitorAction, self).__init__(jobs, services, poll_loop)
         self.folder_name = folder_name
         self.folder_id = None
+        # consecutive failed attempts to check the folder
+        self.attempts = 0
+        # whether the job store has been checked against the folder
+        # and the bucket (see `reconcile`)
+        self.reconciled = False
 
     def __str__(self):
         return '<DriveMonitor folder={}>'.format(self.folder_name)
 
+    def tick_budget(self):
+        '''
+        Returns the time budget in seconds for this action's next
+        tick.
+        '''
+        return MONITOR_DEADLINE_SECS
+
     def tick(self):
         '''Tick method'''
         if not self.should_tick():
             return False
         self.set_next_tick(30)  # 30 seconds between checking drive
-        # cache the folder ID
-        if self.folder_id is None:
-            self.folder_id = drive_get_folder_id(self.services['drive'],
-                                                 self.folder_name)
-        if self.folder_id is None:
-            logger.fatal('Could not find Google Drive folder "%s"',
-                         self.folder_name)
-            raise Exception(
-                'ERROR: could not find Google Drive folder "{}"'.format(
-                    self.folder_name))
-        # refresh the list of files in the google drive
-        logger.info('Checking Google Drive ...')
+        # with a shared job store, only one daemon monitors each folder
+        leases = self.services.get('leases')
+        if leases is not None and not leases.claim(
+                'monitor:' + self.folder_name):
+            return False
         try:
-            results = drive_list_most_recent_files(self.services['drive'],
-                                                   self.folder_id)
-        except socket.error:
-            logger.warning('socket.error')
-            results = {}
+            # cache the folder ID
+            if self.folder_id is None:
+                self.folder_id = drive_get_folder_id(self.services['drive'],
+                                                     self.folder_name)
+            if self.folder_id is not None and not self.reconciled:
+                self.reconcile()
+                self.reconciled = True
+            if self.folder_id is not None:
+                # refresh the list of files in the google drive
+                logger.info('Checking Google Drive folder %s (in flight: '
+                            '%s) ...', self.folder_name,
+                            self.services['limits'].status())
+                results = drive_list_most_recent_files(
+                    self.services['drive'], self.folder_id)
+        except (RetryableError, FatalError) as exc:
+            self.attempts += 1
+            delay = backoff_delay(self.attempts, RETRY_BASE_SECS,
+                                  RETRY_MAX_SECS)
+            logger.warning('Could not check Google Drive folder %s (%s); '
+                           'retrying in %d secs', self.folder_name, exc,
+                           delay)
+            self.set_next_tick(delay)
+            return False
+        if self.folder_id is None:
+            # e.g., renamed; the other folders carry on meanwhile
+            self.attempts += 1
+            delay = backoff_delay(self.attempts, RETRY_BASE_SECS,
+                                  RETRY_MAX_SECS)
+            logger.warning('Could not find Google Drive folder "%s"; '
+                           'looking again in %d secs', self.folder_name,
+                           delay)
+            self.set_next_tick(delay)
+            return False
+        self.attempts = 0
         if 'files' not in results:
             return False
-        # update the persistent storage
-        self.pstorage['drive_files'] = results['files']
-        # create new jobs
-        if 'jobs' not in self.pstorage:
-            self.pstorage['jobs'] = {}
+        # create jobs for new files; only these are written to the job
+        # store
         num_created = 0
-        for dfile in self.pstorage['drive_files']:
-            if dfile['name'] not in self.pstorage['jobs']:
-                job = TranscriptionJobAction(self.pstorage, self.services,
-                                             self.poll_loop,
-                                             dfile['name'])
-                if job.initialised:
-                    self.poll_loop.append(job)
-                    num_created += 1
+        ids_by_name = same_name_ids(results['files'])
+        for dfile in sorted(results['files'], key=lambda f: f['id']):
+            if dfile['id'] in self.jobs:
+                continue
+            job_record = new_job_record(self.jobs, self.folder_name, dfile,
+                                        others=ids_by_name[dfile['name']])
+            logger.info('Initialising job %s', job_record.local_name)
+            job_record = self.jobs.add(job_record)
+            self.poll_loop.append(TranscriptionJobAction(
+                self.jobs, self.services, self.poll_loop, job_record))
+            num_created += 1
         if num_created:
             logger.info('Drive Monitor created %d new jobs', num_created)
         # done
         return False
 
+    def reconcile(self):
+        '''
+        Checks the job store against what already exists in the Google
+        Drive folder and the Cloud Storage bucket, with a few bulk
+        listings, so that work is not repeated after the job store is
+        lost, or when the folder was worked on from another machine.
+
+        With a shared job store, the job records are refreshed first,
+        and objects younger than a lease are left alone, as they may
+        belong to a job which another daemon has not yet saved.
+
+        Audio files without a job record get one: in state 'done' if
+        their transcription is already in the folder (see
+        `find_transcription`), or in state
+        'stored' (ready to submit to the Speech API) if their trimmed
+        audio is already in the bucket.  Objects in the bucket which
+        belong to finished jobs are queued for deletion, as are any
+        other objects under the folder's `object_prefix`, if it has
+        one.
+        '''
+        folder = self.services['folder']
+        logger.info('Reconciling Google Drive folder %s with bucket %s ...',
+                    self.folder_name, folder.bucket)
+        leases = self.services.get('leases')
+        if leases is not None:
+            # pick up the jobs of other daemons, so that their objects
+            # are not taken for orphans; `SharedStoreSyncAction` adds
+            # them to the polling loop
+            self.jobs.refresh(keep=leases.held_jobs())
+        files = drive_list_folder(self.services['drive'], self.folder_id)
+        objects = dict(
+            (obj['name'], obj) for obj in storage_list_objects(
+                self.services['storage'], folder.bucket,
+                folder.object_prefix))
+        transcriptions = [dfile for dfile in files
+                          if dfile.get('mimeType') == 'text/plain']
+        # the names of the transcriptions which belong to known jobs,
+        # or to recordings already looked at
+        claimed = set(transcription_name(job_record.local_name)
+                      for job_record in self.jobs
+                      if job_record.folder in (None, self.folder_name))
+        recordings = sorted(
+            (dfile for dfile in files
+             if dfile.get('mimeType', '').startswith('audio/')),
+            key=lambda dfile: dfile['id'])
+        ids_by_name = same_name_ids(recordings)
+        owned_objects = set()
+        orphans = []
+        num_done = num_resumed = 0
+        for dfile in recordings:
+            job_record = self.jobs.get(dfile['id'])
+            if job_record is not None:
+                # a known job: only clean up after it, if it is finished
+                object_name = storage_object_name(
+                    wav_name(job_record.local_name), folder.object_prefix)
+                if job_record.state == 'done' and object_name in objects:
+                    orphans.append(object_name)
+                continue
+            match = self.find_transcription(dfile, transcriptions, claimed)
+            if match is not None:
+                local_name, transcription = match
+            else:
+                local_name = self.jobs.unique_local_name(
+                    dfile['name'], dfile['id'], ids_by_name[dfile['name']])
+                transcription = None
+            claimed.add(transcription_name(local_name))
+            object_name = storage_object_name(wav_name(local_name),
+                                              folder.object_prefix)
+            owned_objects.add(object_name)
+            if transcription is not None:
+                job_record = new_job_record(self.jobs, self.folder_name,
+                                            dfile, 'done',
+                                            local_name=local_name)
+                job_record.artifacts['drive_transcription'] = {
+                    'id': transcription['id'],
+                    'md5': transcription.get('md5Checksum')}
+                if object_name in objects:
+                    orphans.append(object_name)
+                num_done += 1
+            elif object_name in objects:
+                obj = objects[object_name]
+                job_record = new_job_record(self.jobs, self.folder_name,
+                                            dfile, 'stored',
+                                            local_name=local_name)
+                job_record.artifacts['object'] = {
+                    'size': int(obj['size']),
+                    'md5': md5_base64_to_hex(obj['md5Hash']),
+                    'generation': obj.get('generation')}
+                num_resumed += 1
+            else:
+                continue
+            job_record = self.jobs.add(job_record)
+            if job_record.state != 'done':
+                self.poll_loop.append(TranscriptionJobAction(
+                    self.jobs, self.services, self.poll_loop, job_record))
+        # objects of jobs which are still running, but whose recording
+        # is no longer in the folder, are not orphans
+        for job_record in self.jobs:
+            if job_record.folder in (None, self.folder_name):
+                owned_objects.add(storage_object_name(
+                    wav_name(job_record.local_name), folder.object_prefix))
+        unknown = [name for name in objects if name not in owned_objects]
+        if leases is not None:
+            # another daemon may have uploaded an object since the
+            # refresh, and not yet saved its job record
+            ages = dict((name, storage_object_age(objects[name]))
+                        for name in unknown)
+            unknown = [name for name in unknown
+                       if ages[name] is None or
+                       ages[name] >= leases.lease_secs]
+        if unknown and folder.object_prefix:
+            orphans.extend(unknown)
+        elif unknown:
+            logger.info('Leaving %d objects in bucket %s which belong to no '
+                        'job (set object_prefix to clean these up)',
+                        len(unknown), folder.bucket)
+        if orphans:
+            self.poll_loop.append(StorageCleanupAction(
+                self.jobs, self.services, self.poll_loop, orphans))
+        logger.info('Reconciled folder %s: %d files, %d objects; %d jobs '
+                    'already done, %d resumed from the bucket, %d objects '
+                    'to delete', self.folder_name, len(files), len(objects),
+                    num_done, num_resumed, len(orphans))
+
+    def find_transcription(self, dfile, transcriptions, claimed):
+        '''
+        Looks for the transcription of the recording `dfile`, which has
+        no job record, in the listing of its folder.  Returns a pair
+        of the local name under which it was transcribed and the
+        transcription's entry in the listing, or None.
+
+        A transcription uploaded by this program names its recording
+        (see `TRANSCRIPTION_RECORDING_PROPERTY`).  Others are matched
+        by name: since the name given to a recording which shares its
+        name with others may have changed (see
+        `jobs.JobStore.unique_local_name`), the name with the start of
+        the file ID is tried, and then the plain name, unless it
+        belongs to a known job.
+
+        Arguments:
+        - `dfile`: the recording's entry in the folder listing
+        - `transcriptions`: the entries of the TXT files in the folder
+        - `claimed`: names of transcriptions which belong to other
+          recordings
+        '''
+        candidates = [suffixed_name(dfile['name'], dfile['id']),
+                      dfile['name']]
+        by_name = {}
+        for transcription in transcriptions:
+            # Drive timestamps are all UTC ISO 8601 strings, which sort
+            # chronologically
+            if (transcription.get('modifiedTime', '') <
+                    dfile.get('modifiedTime', '')):
+                continue
+            recording_id = (transcription.get('appProperties') or {}).get(
+                TRANSCRIPTION_RECORDING_PROPERTY)
+            if recording_id == dfile['id']:
+                names = [name for name in candidates
+                         if transcription_name(name) ==
+                         transcription['name']]
+                return (names[0] if names else candidates[0]), transcription
+            if recording_id is None:
+                by_name[transcription['name']] = transcription
+        for name in candidates:
+            transcription = by_name.get(transcription_name(name))
+            if (transcription is not None and
+                    transcription['name'] not in claimed):
+                return name, transcription
+        return None
+
 
 class TranscriptionJobAction(LoopAction):
-    '''Monitor the Google Drive folder and create new jobs.'''
+    '''Transcribe one recording from a Google Drive folder.'''
 
-    def __init__(self, pstorage, services, poll_loop, job_name):
-        '''Constructor.'''
-        super(TranscriptionJobAction, self).__init__(pstorage, services,
+    def __init__(self, jobs, services, poll_loop, job_record):
+        '''
+        Constructor.
+
+        Arguments:
+        - `jobs`: the `JobStore`
+        - `services`:
+        - `poll_loop`:
+        - `job_record`: the job's `JobRecord`
+        '''
+        super(TranscriptionJobAction, self).__init__(jobs, services,
                                                      poll_loop)
-        self.job_name = job_name
-        if 'jobs' not in self.pstorage:
-            self.pstorage['jobs'] = {}
-        self.initialised = True
-        # check for a job record in the pstorage
-        if self.job_name in self.pstorage['jobs']:
-            self.job_record = self.pstorage['jobs'][self.job_name]
-        else:
-            logger.info('Initialising job %s', self.job_name)
-            idx = [i for i, dfile in enumerate(pstorage['drive_files'])
-                   if dfile['name'] == self.job_name]
-            if not idx:
-                logger.error(
-                    'Could not retrieve Google Drive file ID for file "%s"',
-                    self.job_name)
-                self.initialised = False
-                return
-            idx = idx[0]
-            self.job_record = {
-                'storage_id': 'unknown',
-                'state': 'uploaded',
-                'drive_id': pstorage['drive_files'][idx]['id'],
-                'drive_parents': pstorage['drive_files'][idx]['parents'],
-            }
-            self.pstorage['jobs'][self.job_name] = self.job_record
-            self.pstorage.save()
+        self.job_record = job_record
+        # the job's identity (e.g., for leases) is its Drive file ID;
+        # its local files are named after its local name
+        self.job_id = job_record.drive_id
+        self.job_name = job_record.local_name
+        self.update_cache_needs()
 
     def __str__(self):
         return '<Transcribe name={} state={}>'.format(self.job_name,
-                                                      self.job_record['state'])
+                                                      self.job_record.state)
 
     def identity(self, job_id):
         '''Identity predicate: returns True if this job is `job_id`.'''
-        return job_id == self.job_name
+        return job_id == self.job_id
+
+    def trace_tags(self):
+        '''
+        Returns the job tags for the spans recorded while this job
+        runs.
+        '''
+        return {'job': self.job_name, 'drive_id': self.job_id}
+
+    def profile_key(self):
+        '''
+        Returns the name under which the tick timings of this action
+        are accumulated by the `LoopProfiler`; this includes the
+        current state, so that slow stages can be told apart.
+        '''
+        return '{}.{}'.format(type(self).__name__, self.job_record.state)
+
+    def priority(self):
+        '''
+        Returns the estimated processing time in seconds left for this
+        job, unless the operator has pinned its priority.
+        '''
+        pins = self.services.get('priorities')
+        if pins is not None:
+            pinned = pins.lookup(self.job_record.name)
+            if pinned is not None:
+                return pinned
+        duration = self.audio_duration()
+        if duration is None:
+            size = self.job_record.drive_size
+            duration = (float(size) / ESTIMATED_BYTES_PER_AUDIO_SEC if size
+                        else UNKNOWN_DURATION_SECS)
+        return duration * REMAINING_COSTS.get(self.job_record.state, 0.0)
+
+    def tick_budget(self):
+        '''
+        Returns the time budget in seconds for this job's next tick,
+        which depends on its state.
+        '''
+        return STAGE_DEADLINES.get(self.job_record.state)
+
+    def stalled(self, exc):
+        '''
+        Called by the `Watchdog` after a tick of this job was aborted
+        for running past its budget.  The stall counts as a failed
+        attempt (see `retry_later`), and the current state is retried
+        after at least STALL_RETRY_SECS.
+
+        Arguments:
+        - `exc`: the `StageTimeout`
+        '''
+        self.job_record.stalls += 1
+        self.retry_later(exc)
+        if not self.job_record.failed:
+            self.set_next_tick(max(STALL_RETRY_SECS,
+                                   self.next_tick_time - time.time()))
+
+    def tick_failed(self, exc):
+        '''
+        Called by the `Watchdog` after a tick of this job raised an
+        unexpected exception (e.g., an OSError from a full disk); this
+        counts as a failed attempt (see `retry_later`).  If the error
+        was caused by a missing local file, the job first moves back
+        to the state which rebuilds it.
+
+        Arguments:
+        - `exc`:
+        '''
+        self.recover_local_state()
+        self.retry_later(exc)
+
+    def set_state(self, next_state):
+        '''
+        Moves this job into the state `next_state`, and saves it.
+
+        Arguments:
+        - `next_state`:
+        '''
+        self.jobs.set_state(self.job_record, next_state)
+        self.job_record.attempts = 0
+        self.job_record.last_error = None
+        self.jobs.save(self.job_record)
+        self.update_cache_needs()
+
+    def update_cache_needs(self):
+        '''
+        Tells the cache manager which of this job's intermediate files
+        are still needed in its current state.
+        '''
+        needed = CACHE_NEEDS.get(self.job_record.state)
+        if needed is not None:
+            self.services['cache'].set_needed(self.job_name, needed)
+
+    def register_artifact(self, kind, path, manifest=None):
+        '''
+        Records a newly written intermediate file with the cache
+        manager, and its manifest in the job record.
+
+        Arguments:
+        - `kind`: the kind of artifact (see JOB_ARTIFACTS)
+        - `path`:
+        - `manifest`: the file's manifest, if already computed
+        '''
+        self.services['cache'].register(path, self.job_name, kind)
+        if manifest is None:
+            manifest = describe_file(path, audio=path.endswith('.wav'))
+        self.record_manifest(kind, manifest)
+        # make room in memory, keeping the newest file, which the next
+        # stage reads
+        spill_scratch(self.services['cache'], keep=(path,))
+
+    def record_manifest(self, kind, manifest):
+        '''
+        Stores the manifest of one of this job's outputs in the job
+        record (it is saved with the next change of state).
+
+        Arguments:
+        - `kind`: the kind of artifact (see JOB_ARTIFACTS), or the
+          name of a remote output (e.g., 'object')
+        - `manifest`: a dict (see `manifest.describe_file`)
+        '''
+        self.job_record.artifacts[kind] = manifest
+
+    def get_manifest(self, kind):
+        '''
+        Returns the manifest of one of this job's outputs, or None.
+
+        Arguments:
+        - `kind`:
+        '''
+        return self.job_record.artifacts.get(kind)
+
+    def output_is_valid(self, kind, path, source_kind, source_path):
+        '''
+        Returns True if the output file of a local processing stage is
+        already present and complete, so that the stage can be
+        skipped.  This is the case if the file matches its manifest,
+        which was made from the current input file; or, if there is no
+        manifest (the daemon stopped before it was saved), if the file
+        is a complete WAV file written after the input file.
+
+        Arguments:
+        - `kind`: the kind of the output file
+        - `path`: the path of the output file
+        - `source_kind`: the kind of the stage's input file
+        - `source_path`: the path of the stage's input file
+        '''
+        manifest = self.get_manifest(kind)
+        source_manifest = self.get_manifest(source_kind)
+        if manifest is not None:
+            return (source_manifest is not None and
+                    manifest.get('source_md5') == source_manifest['md5'] and
+                    file_matches(path, manifest))
+        return (os.path.exists(path) and os.path.exists(source_path) and
+                os.path.getmtime(path) >= os.path.getmtime(source_path) and
+                wav_duration(path) is not None)
+
+    def process_file(self, kind, path, source_kind, source_path, process_fn,
+                     next_state):
+        '''
+        Runs a local processing stage (`process_fn`, which converts
+        `source_path` into `path`) unless its output is already valid,
+        checks the result, and moves on to `next_state`.
+
+        Arguments:
+        - `kind`:
+        - `path`:
+        - `source_kind`:
+        - `source_path`:
+        - `process_fn`: a function taking the input and output paths
+          and returning an exit status
+        - `next_state`:
+        '''
+        self.services['cache'].touch(source_path)
+        if self.output_is_valid(kind, path, source_kind, source_path):
+            logger.info('Reusing existing %s file for %s', kind, str(self))
+        else:
+            status = process_fn(source_path, path)
+            if status != 0 or wav_duration(path) is None:
+                return self.retry_later(
+                    'could not make {} file (exit status {})'.format(
+                        kind, status))
+        source_manifest = self.get_manifest(source_kind)
+        if source_manifest is None:
+            source_manifest = describe_file(source_path)
+            self.record_manifest(source_kind, source_manifest)
+        self.register_artifact(kind, path, describe_file(
+            path, audio=True, source_md5=source_manifest['md5']))
+        self.set_state(next_state)
+        return True
 
     def tick(self):
         '''Tick method'''
         if not self.should_tick():
             return False
-        current_state = self.job_record['state']
-        state_idx = [i for i, (x, _y) in enumerate(TRANSCRIPTION_JOB_STATES)
-                     if x == current_state]
-        if not state_idx:
+        if self.job_record.failed:
+            # given up on; needs attention from an operator
+            return False
+        transition = STATE_TRANSITIONS.get(self.job_record.state)
+        if transition is None:
             logger.error('Cannot interpret TranscriptionJob state %s',
-                         current_state)
+                         self.job_record.state)
             return False
-        state_idx = state_idx[0]
-        state_action = TRANSCRIPTION_JOB_STATES[state_idx][1]
-        if state_idx < len(TRANSCRIPTION_JOB_STATES) - 1:
-            next_state = TRANSCRIPTION_JOB_STATES[state_idx + 1][0]
-        else:
-            next_state = current_state
+        state_action, next_state = transition
         if state_action is not None:
-            return state_action(self, next_state)
+            if not self.holds_lease():
+                if not self.claim_lease():
+                    self.set_next_tick(30)
+                    return False
+                # the job record may have been changed by another
+                # daemon, so tick again from its current state
+                return True
+            try:
+                with TRACER.span(state_action.__name__, 'state',
+                                 state=self.job_record.state,
+                                 **self.trace_tags()):
+                    return state_action(self, next_state)
+            except CircuitOpenError as exc:
+                # the API is failing: wait for its circuit breaker,
+                # without counting this against the job
+                self.set_next_tick(exc.retry_time - time.time() +
+                                   backoff_delay(1, RETRY_BASE_SECS))
+                return False
+            except RetryableError as exc:
+                return self.retry_later(exc)
+            except FatalError as exc:
+                self.give_up(exc)
+                return False
         return False
 
+    def retry_later(self, exc):
+        '''
+        Records a failed attempt at this job's current state, and
+        schedules a retry after an exponential backoff; gives up on
+        the job after RETRY_MAX_ATTEMPTS consecutive failures.  Returns
+        False.
+
+        Arguments:
+        - `exc`: the exception (or error message) describing the
+          failure
+        '''
+        self.job_record.attempts += 1
+        self.job_record.last_error = str(exc)
+        attempts = self.job_record.attempts
+        if attempts >= RETRY_MAX_ATTEMPTS:
+            self.give_up(exc)
+            return False
+        self.jobs.save(self.job_record)
+        delay = backoff_delay(attempts, RETRY_BASE_SECS, RETRY_MAX_SECS)
+        logger.warning('Attempt %d failed for %s (%s); retrying in %d secs',
+                       attempts, str(self), exc, delay)
+        TRACER.instant('retry', 'job', attempt=attempts, error=str(exc),
+                       delay_secs=int(delay), **self.trace_tags())
+        self.set_next_tick(delay)
+        return False
+
+    def give_up(self, exc):
+        '''
+        Marks this job as failed; it will not be ticked again until it
+        is reset with the retry command.
+
+        Arguments:
+        - `exc`: the exception (or error message) describing the
+          failure
+        '''
+        logger.error('Giving up on %s: %s', str(self), exc)
+        TRACER.instant('give up', 'job', error=str(exc), **self.trace_tags())
+        self.services['limits']['speech'].discard(self.job_name)
+        self.job_record.failed = str(exc)
+        self.jobs.save(self.job_record)
+        # failed jobs are not ticked, so the lease would only block
+        # other daemons once the job is retried
+        if self.services.get('leases') is not None:
+            self.services['leases'].release_job(self.job_id)
+
+    def holds_lease(self):
+        '''
+        Returns True if this daemon may work on this job: i.e., there
+        is no shared job store, or this daemon holds the job's lease.
+        '''
+        leases = self.services.get('leases')
+        return leases is None or leases.holds_job(self.job_id)
+
+    def claim_lease(self):
+        '''
+        Tries to claim the lease for this job in the shared job store.
+        On success, reloads the job record, which another daemon may
+        have worked on, and checks that the local files it needs are
+        present.  Returns True if the lease was claimed.
+        '''
+        if not self.services['leases'].claim_job(self.job_id):
+            return False
+        self.jobs.reload(self.job_id)
+        self.recover_local_state()
+        return True
+
+    def recover_local_state(self):
+        '''
+        Moves this job back through its states until the local files
+        needed by its current state are present (they will be missing
+        if the job was started by another daemon, or if they were
+        deleted from the cache).
+        '''
+        while True:
+            state = self.job_record.state
+            missing = [kind for kind, path_fn, last_state in JOB_ARTIFACTS
+                       if last_state == state and
+                       not os.path.exists(path_fn(self.job_name))]
+            if not missing:
+                break
+            previous_state = STATE_NAMES[STATE_INDEX[state] - 1]
+            logger.warning('Missing %s file for %s; returning to state %s',
+                           missing[0], str(self), previous_state)
+            self.set_state(previous_state)
+
     def download(self, next_state):
         '''
         State machine action to download the original audio recording file
         for this job.
         '''
-        logger.info('Downloading %s', str(self))
-        drive_download_file(self.services['drive'],
-                            self.job_record['drive_id'],
-                            local_input_file_path(self.job_name), True)
-        time.sleep(0.5)
-        # TODO: check that operation succeeded
-        self.job_record['state'] = next_state
-        self.pstorage.save()
+        drive_md5 = self.job_record.drive_md5
+        drive_size = self.job_record.drive_size
+        path = local_input_file_path(
+            self.job_name, int(drive_size) if drive_size else None)
+        if (drive_md5 and os.path.exists(path) and
+                os.path.getsize(path) == int(drive_size) and
+                md5_file(path) == drive_md5):
+            logger.info('Already downloaded %s', str(self))
+        else:
+            logger.info('Downloading %s', str(self))
+            drive_download_file(self.services['drive'],
+                                self.job_record.drive_id, path, True)
+        manifest = describe_file(path)
+        if drive_md5 and manifest['md5'] != drive_md5:
+            return self.retry_later('downloaded file does not match its '
+                                    'Google Drive checksum')
+        self.register_artifact('input', path, manifest)
+        self.job_record.probe = probe_audio(path)
+        self.set_state(next_state)
         return True
 
     def transcode_to_wav(self, next_state):
@@ -663,24 +1854,53 @@ class TranscriptionJobAction(LoopAction):
         steps.
         '''
         logger.info('Transcoding to wav %s', str(self))
-        convert_input_to_wav(local_input_file_path(self.job_name),
-                             local_wav_path(self.job_name))
-        # TODO: check that operation succeeded
-        self.job_record['state'] = next_state
-        self.pstorage.save()
-        return True
+        probe = self.probe()
+        if is_speech_ready(probe):
+            logger.info('No transcoding needed for %s', str(self))
+        duration = self.audio_duration()
+        return self.process_file(
+            'wav', local_wav_path(
+                self.job_name, duration and int(
+                    duration * SPEECH_SAMPLE_RATE * SPEECH_CHANNELS * 2)),
+            'input', local_input_file_path(self.job_name),
+            lambda source, path: convert_input_to_wav(source, path, probe),
+            next_state)
+
+    def probe(self):
+        '''
+        Returns the format of this job's audio recording file (see
+        `probe_audio`), probing the downloaded file if this has not
+        been done yet.
+        '''
+        if self.job_record.probe is None:
+            path = local_input_file_path(self.job_name)
+            if not os.path.exists(path):
+                return None
+            self.job_record.probe = probe_audio(path)
+            self.jobs.save(self.job_record)
+        return self.job_record.probe
+
+    def audio_duration(self):
+        '''
+        Returns the duration in seconds of this job's audio recording,
+        or None if it is not known yet.
+        '''
+        probe = self.job_record.probe
+        if probe is not None and probe.get('duration'):
+            return probe['duration']
+        return None
 
     def trim_wav(self, next_state):
         '''
         State machine action to trim silence from a WAV file.
         '''
         logger.info('Trimming wav %s', str(self))
-        trim_silence(local_wav_path(self.job_name),
-                     local_trimmed_wav_path(self.job_name))
-        # TODO: check that operation succeeded
-        self.job_record['state'] = next_state
-        self.pstorage.save()
-        return True
+        wav_path = local_wav_path(self.job_name)
+        # the trimmed file is no larger than the WAV file
+        size = os.path.getsize(wav_path) if os.path.exists(wav_path) else None
+        return self.process_file('trimmed',
+                                 local_trimmed_wav_path(self.job_name, size),
+                                 'wav', wav_path, trim_silence, next_state)
 
     def upload_to_cloud(self, next_state):
         '''
@@ -688,68 +1908,104 @@ class TranscriptionJobAction(LoopAction):
         '''
         logger.info('Uploading to cloud storage %s', str(self))
         filename = local_trimmed_wav_path(self.job_name)
-        try:
-            response = storage_upload_object(self.services['storage'], BUCKET,
-                                             filename=filename)
-        except socket.error:
-            logger.warning('socket.error')
-            response = None
-        time.sleep(0.5)
-        if response:
-            if os.stat(filename).st_size == int(response['size']):
-                self.job_record['state'] = next_state
-                self.pstorage.save()
-                return True
-        self.set_next_tick(5)
-        return False
+        self.services['cache'].touch(filename)
+        manifest = self.get_manifest('trimmed')
+        if manifest is None:
+            manifest = describe_file(filename, audio=True)
+            self.record_manifest('trimmed', manifest)
+        folder = self.services['folder']
+        # the object may be left over from an earlier attempt
+        response = storage_get_object(self.services['storage'],
+                                      folder.bucket, filename,
+                                      prefix=folder.object_prefix)
+        if response and storage_object_matches(response, manifest):
+            logger.info('Already uploaded %s', str(self))
+        else:
+            response = storage_upload_object(self.services['storage'],
+                                             folder.bucket, filename=filename,
+                                             prefix=folder.object_prefix)
+        if response and storage_object_matches(response, manifest):
+            self.record_manifest('object', {
+                'size': int(response['size']),
+                'md5': md5_base64_to_hex(response['md5Hash']),
+                'generation': response.get('generation')})
+            self.set_state(next_state)
+            return True
+        return self.retry_later('uploaded object does not match the local '
+                                'file')
 
     def submit_to_speech_api(self, next_state):
         '''
         State machine action to submit a speech recognition request to the
         Google Cloud Speech API.
         '''
+        speech_limit = self.services['limits']['speech']
+        if not speech_limit.try_acquire(self.job_name):
+            # too many operations in flight already
+            self.set_next_tick(30)
+            return False
         logger.info('Submitting to speech API %s', str(self))
-        filename = local_trimmed_wav_path(self.job_name)
-        phrases = ["semantics", "representation", "representational",
-                   "denotation",
-                   "denotational", "reference", "referential"]
+        filename = wav_name(self.job_name)
+        folder = self.services['folder']
         try:
-            response = submit_transcription_request(self.services['speech'],
-                                                    BUCKET,
-                                                    filename, phrases=phrases)
-            time.sleep(0.5)
-        except socket.error:
-            logger.warning('socket.error')
-            response = None
-        self.set_next_tick(15)
+            response = submit_transcription_request(
+                self.services['speech'], folder.bucket, filename,
+                phrases=folder.phrases, language_code=folder.language,
+                prefix=folder.object_prefix)
+        except RetryableError:
+            speech_limit.release(self.job_name, ok=False)
+            raise
+        except FatalError:
+            speech_limit.discard(self.job_name)
+            raise
         if response is not None and 'name' in response:
-            self.job_record['storage_id'] = response['name']
-            self.job_record['state'] = next_state
-            self.pstorage.save()
+            self.job_record.storage_id = response['name']
+            self.job_record.submitted_time = time.time()
+            self.set_state(next_state)
+            self.set_next_tick(15)
             return False
-        return False
+        speech_limit.discard(self.job_name)
+        return self.retry_later('no operation name in Speech API response')
 
     def poll_speech_api(self, next_state):
         '''
         State machine action to check to see if the Google Cloud Speech
         API has finished transcribing this job.
         '''
-        try:
-            response = poll_transcription_results(
-                self.services['speech'], self.job_record['storage_id'])
-            time.sleep(0.5)
-        except socket.error:
-            logger.warning('socket.error')
-            response = {}
+        # count the operation as in flight, if it was submitted before
+        # a restart or by another daemon
+        speech_limit = self.services['limits']['speech']
+        submitted_time = self.job_record.submitted_time
+        speech_limit.restore(self.job_name, submitted_time)
+        response = poll_transcription_results(
+            self.services['speech'], self.job_record.storage_id)
+        if response.get('done') and 'error' in response:
+            # the operation failed; submit it again
+            speech_limit.release(self.job_name, ok=False)
+            self.jobs.set_state(self.job_record, 'stored')
+            return self.retry_later('Speech API operation failed: {}'.format(
+                response['error'].get('message')))
         if 'done' in response and response['done']:
             logger.info('Speech API finished %s', str(self))
+            # the latency is measured per second of audio
+            trimmed = self.get_manifest('trimmed') or {}
+            speech_limit.release(
+                self.job_name,
+                work=trimmed.get('duration') or self.audio_duration())
             local_path = local_transcription_path(self.job_name)
-            with open(local_path, 'w') as output_file:
-                for result in response['response']['results']:
-                    output_file.write(result['alternatives'][0]['transcript'] +
-                                      "\n")
-            self.job_record['state'] = next_state
-            self.pstorage.save()
+            write_transcription(response, local_path)
+            self.register_artifact('transcription', local_path)
+            self.set_state(next_state)
+            return True
+        if submitted_time is None:
+            submitted_time = time.time()
+        if time.time() - submitted_time > SPEECH_OPERATION_DEADLINE_SECS:
+            logger.warning('Speech API stalled on %s; cancelling and '
+                           'resubmitting', str(self))
+            cancel_transcription_request(self.services['speech'],
+                                         self.job_record.storage_id)
+            speech_limit.release(self.job_name, ok=False)
+            self.set_state('stored')
             return True
         self.set_next_tick(10)
         return False
@@ -761,36 +2017,39 @@ class TranscriptionJobAction(LoopAction):
         '''
         logger.info('Uploading transcription to google drive %s', str(self))
         filename = local_transcription_path(self.job_name)
-        try:
-            response = drive_upload_file(self.services['drive'], filename,
-                                         self.job_record['drive_parents'],
-                                         'text/plain')
-            time.sleep(0.5)
-        except socket.error:
-            logger.warning('socket.error')
-            response = {}
+        self.services['cache'].touch(filename)
+        md5 = md5_file(filename)
+        # the transcription may have been uploaded by an earlier attempt
+        response = drive_find_file(self.services['drive'],
+                                   os.path.basename(filename),
+                                   self.job_record.drive_parents[0])
+        if response and response.get('md5Checksum') == md5:
+            logger.info('Transcription already on Google Drive %s', str(self))
+        else:
+            # the recording's ID is stored with the transcription, so
+            # that it can be matched up again (see `reconcile`)
+            response = drive_upload_file(
+                self.services['drive'], filename,
+                self.job_record.drive_parents, 'text/plain',
+                properties={TRANSCRIPTION_RECORDING_PROPERTY: self.job_id})
         if 'id' in response:
-            self.job_record['state'] = next_state
-            self.pstorage.save()
+            self.record_manifest('drive_transcription',
+                                 {'id': response['id'], 'md5': md5})
+            self.set_state(next_state)
             return True
-        self.set_next_tick(10)
-        return False
+        return self.retry_later('no file ID in Google Drive response')
 
     def clean_cloud(self, next_state):
         '''
         Delete a WAV file from the Google Cloud Storage.
         '''
         logger.info('Deleting from cloud %s', str(self))
-        filename = local_trimmed_wav_path(self.job_name)
-        try:
-            storage_delete_object(self.services['storage'], BUCKET, filename)
-        except socket.error:
-            logger.warning('socket.error')
-            return True
-        time.sleep(0.5)
+        filename = wav_name(self.job_name)
+        folder = self.services['folder']
+        storage_delete_object(self.services['storage'], folder.bucket,
+                              filename, prefix=folder.object_prefix)
         # response seems to be always empty
-        self.job_record['state'] = next_state
-        self.pstorage.save()
+        self.set_state(next_state)
         return True
 
     def destruct(self, next_state):
@@ -799,19 +2058,134 @@ class TranscriptionJobAction(LoopAction):
         poll loop.
         '''
         # empty, skip to done
-        self.job_record['state'] = next_state
-        self.pstorage.save()
+        self.set_state(next_state)
+        if self.job_record.created_time is not None:
+            logger.info('Finished %s in %d secs', str(self),
+                        time.time() - self.job_record.created_time)
         # remove self from poll loop
         idxs = [i for (i, j) in enumerate(self.poll_loop)
-                if j.identity(self.job_name)]
+                if j.identity(self.job_id)]
         for idx in reversed(idxs):
             logger.info('Removing poll loop action: %s',
                         str(self.poll_loop[idx]))
             del self.poll_loop[idx]
+        if self.services.get('leases') is not None:
+            self.services['leases'].release_job(self.job_id)
         self.set_next_tick(30)
         return False
 
 
+class StorageCleanupAction(LoopAction):
+    '''
+    Deletes objects left behind in Google Cloud Storage, one per tick
+    (see `DriveMonitorAction.reconcile`).
+    '''
+
+    def __init__(self, jobs, services, poll_loop, object_names):
+        '''
+        Constructor.
+
+        Arguments:
+        - `jobs`:
+        - `services`:
+        - `poll_loop`:
+        - `object_names`: the names of the objects to delete
+        '''
+        super(StorageCleanupAction, self).__init__(jobs, services,
+                                                   poll_loop)
+        self.object_names = list(object_names)
+        # consecutive failed attempts to delete an object
+        self.attempts = 0
+
+    def __str__(self):
+        return '<StorageCleanup bucket={} objects={}>'.format(
+            self.services['folder'].bucket, len(self.object_names))
+
+    def tick(self):
+        '''Tick method'''
+        if not self.should_tick():
+            return False
+        folder = self.services['folder']
+        object_name = self.object_names[-1]
+        try:
+            storage_delete_object(self.services['storage'], folder.bucket,
+                                  object_name[len(folder.object_prefix):],
+                                  prefix=folder.object_prefix)
+        except CircuitOpenError as exc:
+            self.set_next_tick(exc.retry_time - time.time())
+            return False
+        except RetryableError as exc:
+            self.attempts += 1
+            if self.attempts < RETRY_MAX_ATTEMPTS:
+                self.set_next_tick(backoff_delay(
+                    self.attempts, RETRY_BASE_SECS, RETRY_MAX_SECS))
+                return False
+            logger.error('Could not delete gs://%s/%s: %s', folder.bucket,
+                         object_name, exc)
+        except FatalError as exc:
+            logger.error('Could not delete gs://%s/%s: %s', folder.bucket,
+                         object_name, exc)
+        else:
+            logger.info('Deleted orphaned object gs://%s/%s', folder.bucket,
+                        object_name)
+        self.attempts = 0
+        self.object_names.pop()
+        if not self.object_names:
+            self.poll_loop.remove(self)
+            return False
+        return True
+
+
+class SharedStoreSyncAction(LoopAction):
+    '''
+    Pick up jobs created by other daemons sharing the job store.
+    '''
+
+    def __init__(self, jobs, services, poll_loop, folder_services):
+        '''Constructor.'''
+        super(SharedStoreSyncAction, self).__init__(jobs, services,
+                                                    poll_loop)
+        self.folder_services = folder_services
+
+    def __str__(self):
+        return '<SharedStoreSync owner={}>'.format(
+            self.services['leases'].owner)
+
+    def share_group(self):
+        '''
+        Returns the name of the group whose share of the `Scheduler`
+        this action uses.
+        '''
+        return '(shared store)'
+
+    def tick(self):
+        '''Tick method'''
+        if not self.should_tick():
+            return False
+        self.set_next_tick(15)
+        self.jobs.refresh(keep=self.services['leases'].held_jobs())
+        # unfinished jobs without an action, whether they were loaded
+        # by this refresh or by an earlier one (e.g., in `reconcile`)
+        active = set(action.job_id for action in self.poll_loop
+                     if isinstance(action, TranscriptionJobAction))
+        num_added = 0
+        for state in STATE_NAMES:
+            if state == 'done':
+                continue
+            for job_record in self.jobs.in_state(state):
+                if (job_record.drive_id in active or
+                        job_record.folder not in self.folder_services):
+                    continue
+                self.poll_loop.append(TranscriptionJobAction(
+                    self.jobs, self.folder_services[job_record.folder],
+                    self.poll_loop, job_record))
+                num_added += 1
+        if num_added:
+            logger.info('Picked up %d jobs from the shared job store',
+                        num_added)
+        return False
+
+
 # Structure to document the order of states in a
 # TranscriptionJobAction, and indicate the transition actions between
 # them
@@ -828,46 +2202,293 @@ TRANSCRIPTION_JOB_STATES = [
     ('done', None),
 ]
 
-
-@click.command()
-def main():
+# Precomputed from TRANSCRIPTION_JOB_STATES: the list of state names,
+# the position of each state, and, for each state, its transition
+# action and the state which follows it.
+STATE_NAMES = [state for state, _action in TRANSCRIPTION_JOB_STATES]
+STATE_INDEX = dict((state, idx) for idx, state in enumerate(STATE_NAMES))
+STATE_TRANSITIONS = dict(
+    (state, (action, STATE_NAMES[min(idx + 1, len(STATE_NAMES) - 1)]))
+    for idx, (state, action) in enumerate(TRANSCRIPTION_JOB_STATES))
+
+# The estimated processing time left in each state, in seconds per
+# second of audio (see STAGE_COSTS).
+REMAINING_COSTS = dict(
+    (state, sum(STAGE_COSTS.get(later_state, 0.0)
+                for later_state, _action in TRANSCRIPTION_JOB_STATES[idx:]))
+    for idx, (state, _action) in enumerate(TRANSCRIPTION_JOB_STATES))
+
+# The kinds of intermediate file (see JOB_ARTIFACTS) which a job still
+# needs in each state.
+CACHE_NEEDS = dict(
+    (state, [kind for kind, _path_fn, last_state in JOB_ARTIFACTS
+             if idx <= STATE_INDEX[last_state]])
+    for idx, state in enumerate(STATE_NAMES))
+
+
+@click.group(invoke_without_command=True)
+@click.option('--slow-tick-secs', default=5.0, show_default=True,
+              help='Log any poll loop tick which takes longer than this.')
+@click.option('--profile-secs', default=60.0, show_default=True,
+              help='How long to run cProfile for after receiving SIGUSR1.')
+@click.option('--profile-on-start', is_flag=True,
+              help='Start a profiling run immediately.')
+@click.option('--cache-budget-mb', default=CACHE_BUDGET_BYTES // 1024 ** 2,
+              show_default=True,
+              help='Maximum size of the intermediate files kept in the '
+              'cache directory.')
+@click.option('--ram-scratch', default=None, metavar='DIR',
+              help='Directory on a tmpfs (e.g., /dev/shm/google-transcribe) '
+              'in which to keep intermediate files, up to '
+              '--ram-budget-mb.')
+@click.option('--ram-budget-mb',
+              default=RAM_SCRATCH_BUDGET_BYTES // 1024 ** 2,
+              show_default=True,
+              help='Maximum size of the intermediate files kept in '
+              '--ram-scratch; the rest go to the cache directory.')
+@click.option('--config', 'config_path',
+              default=os.path.join(APP_CONFIG_DIR, 'config.json'),
+              show_default=True,
+              help='JSON file listing the Google Drive folders to monitor.')
+@click.option('--shared-store', default=None, metavar='PATH',
+              help='SQLite file holding the job store, to share the work '
+              'between several daemons.')
+@click.option('--lease-secs', default=60.0, show_default=True,
+              help='How long a job lease lasts after its daemon stops '
+              'renewing it (with --shared-store).')
+@click.option('--max-jobs', default=None, type=int,
+              help='Maximum number of jobs this daemon works on at once '
+              '(with --shared-store).')
+@click.option('--trace-dir', default=None, metavar='DIR',
+              help='Write a timeline of each job to trace files here, in '
+              'Chrome Trace Event format.')
+@click.option('--trace-sample-rate', default=1.0, show_default=True,
+              help='Fraction of jobs to trace (with --trace-dir).')
+@click.pass_context
+def main(ctx, slow_tick_secs, profile_secs, profile_on_start, cache_budget_mb,
+         ram_scratch, ram_budget_mb, config_path, shared_store, lease_secs,
+         max_jobs, trace_dir, trace_sample_rate):
     '''
     Google Speech Transcription Service.
 
     This program is constructed like a daemon; it runs in a loop,
-    checking the user's Google Drive folder, and transcribing any
-    audio files which appear there.
+    checking the user's Google Drive folders, and transcribing any
+    audio files which appear there.  The folders, and the bucket,
+    language, phrases and credentials used for each, are read from
+    the --config file.
+
+    Several daemons (on one or more machines) can share the work by
+    pointing --shared-store at the same SQLite file; each folder is
+    then monitored by one elected daemon, and jobs are claimed under
+    leases which expire if their daemon dies.
+
+    Sending the process SIGUSR1 turns on cProfile for --profile-secs
+    seconds; the statistics are written to the profiles subdirectory
+    of the cache directory.  With --trace-dir, spans for every stage,
+    API call, subprocess and scheduler wait of each job are written
+    to trace files which chrome://tracing or Perfetto show as a
+    timeline.
+
+    To transcribe local files instead, use the batch command.  To
+    retry jobs which were given up on, use the retry command.
     '''
-    # load the persistent storage object
     mkdir_p(APP_CONFIG_DIR)
-    pstorage = PersistentDict(os.path.join(APP_CONFIG_DIR, 'pstorage.json'))
-
-    # create services
-    services = {'drive': get_drive_service(),
-                'storage': get_storage_service(),
-                'speech': get_speech_service()}
-
-    # construct the polling loop:
-    poll_loop = []
-    # google drive monitor
-    poll_loop.append(DriveMonitorAction(pstorage, services, poll_loop,
-                                        FOLDER_NAME))
-    if 'jobs' not in pstorage:
-        pstorage['jobs'] = {}
-    # any (unfinished) jobs
-    poll_loop.extend([TranscriptionJobAction(pstorage, services, poll_loop,
-                                             job_name)
-                      for job_name in pstorage['jobs'].keys()])
+    jobs_path = shared_store or os.path.join(APP_CONFIG_DIR, 'jobs.db')
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = {'config_path': config_path, 'jobs_path': jobs_path}
+        return
+    # load the job store
+    jobs = JobStore(jobs_path)
+    shared = {}
+    if shared_store:
+        leases = LeaseManager(shared_store, lease_secs=lease_secs,
+                              max_jobs=max_jobs)
+        leases.start_heartbeat()
+        logger.info('Sharing job store %s as %s', shared_store, leases.owner)
+        shared['leases'] = leases
+
+    # manager for the intermediate files in the cache directory (and
+    # in memory)
+    mkdir_p(APP_CACHE_DIR)
+    SCRATCH.configure(APP_CACHE_DIR, ram_scratch,
+                      budget_bytes=ram_budget_mb * 1024 ** 2)
+    cache = CacheManager(os.path.join(APP_CACHE_DIR, 'cache_index.json'),
+                         budget_bytes=cache_budget_mb * 1024 ** 2,
+                         retention=CACHE_RETENTION)
+    atexit.register(cache.flush)
+    shared['cache'] = cache
+    # the budget in memory may have been lowered since the last run
+    spill_scratch(cache)
+    # priorities pinned by the operator, from the configuration file
+    priorities = PriorityPins(config_path)
+    shared['priorities'] = priorities
+    # adaptive limits on the operations in flight
+    shared['limits'] = ConcurrencyLimits(
+        {'speech': CONCURRENCY_LIMITS['speech']})
+
+    # create services for every monitored folder
+    folders = load_folder_configs(config_path, FOLDER_DEFAULTS)
+    LIMITER.configure(load_api_quotas(config_path, API_QUOTAS))
+    folder_services = get_folder_services(folders, shared)
+    # jobs from before the job store was keyed by Drive file ID
+    legacy_path = os.path.join(APP_CONFIG_DIR, 'pstorage.json')
+    if not shared_store and os.path.exists(legacy_path):
+        num_imported = jobs.import_records(
+            load_data(legacy_path).get('jobs', {}), folders[0].name)
+        os.rename(legacy_path, legacy_path + '.imported')
+        logger.info('Imported %d jobs from %s', num_imported, legacy_path)
+
+    # instrumentation for the polling loop
+    profiler = LoopProfiler(os.path.join(APP_CACHE_DIR, 'profiles'),
+                            slow_tick_secs=slow_tick_secs,
+                            profile_secs=profile_secs)
+    profiler.install_signal_handler()
+    if profile_on_start:
+        profiler.request_profile()
+
+    # timeline tracing of jobs
+    if trace_dir:
+        TRACER.configure(trace_dir, sample_rate=trace_sample_rate,
+                         max_file_bytes=TRACE_MAX_FILE_BYTES,
+                         max_files=TRACE_MAX_FILES,
+                         max_events_per_sec=TRACE_MAX_EVENTS_PER_SEC)
+        atexit.register(TRACER.close)
+
+    # the watchdog aborts any tick which runs past its budget
+    watchdog = Watchdog(tick=profiler.time_tick)
+
+    # construct the polling loop, which shares its time fairly
+    # between the folders, and works on short jobs first:
+    poll_loop = Scheduler(
+        weights=dict((folder.name, folder.weight) for folder in folders),
+        tick=watchdog.tick, aging_rate=PRIORITY_AGING_RATE)
+    # google drive monitors
+    for folder in folders:
+        poll_loop.append(DriveMonitorAction(jobs,
+                                            folder_services[folder.name],
+                                            poll_loop, folder.name))
+    # any unfinished jobs; jobs from before the configuration file
+    # belong to the first folder
+    for job_record in jobs:
+        if job_record.state == 'done':
+            continue
+        folder_name = job_record.folder or folders[0].name
+        if folder_name not in folder_services:
+            logger.warning('Skipping job %s: folder %s is not configured',
+                           job_record.local_name, folder_name)
+            continue
+        job = TranscriptionJobAction(jobs, folder_services[folder_name],
+                                     poll_loop, job_record)
+        if not shared_store:
+            # files kept in memory do not survive a reboot (with a
+            # shared store, this is done when the lease is claimed)
+            job.recover_local_state()
+        poll_loop.append(job)
+    if shared_store:
+        # jobs created by other daemons
+        poll_loop.append(SharedStoreSyncAction(jobs, shared, poll_loop,
+                                               folder_services))
+    if cache.is_new:
+        # adopt files left behind by jobs from before the cache index
+        for job_record in jobs:
+            for kind, path_fn, _last_state in JOB_ARTIFACTS:
+                path = path_fn(job_record.local_name)
+                if os.path.exists(path):
+                    cache.register(path, job_record.local_name, kind)
 
     # polling loop:
     while True:
-        # tick all the jobs in the loop (jobs manage their own timing
+        profiler.poll()
+        priorities.refresh()
+        TRACER.poll()
+        cache.flush()
+        # tick the jobs in the loop (jobs manage their own timing
         # independently)
-        for job in poll_loop:
-            while job.tick():
-                pass
-        # wait
-        time.sleep(1)
+        if not poll_loop.run_once():
+            # wait
+            time.sleep(1)
+
+
+@main.command()
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option('--output-dir', default=None, type=click.Path(),
+              help='Write transcriptions here (default: next to the '
+              'inputs).')
+@click.option('--jobs', '-j', default=4, show_default=True,
+              help='Largest number of files to prepare and upload in '
+              'parallel.')
+@click.option('--bucket', default=BUCKET, show_default=True,
+              help='Google Cloud Storage bucket for staging audio.')
+@click.option('--language', default=LANGUAGE, show_default=True,
+              help='Language of the recordings (BCP-47 tag).')
+@click.option('--phrase', 'phrases', multiple=True,
+              help='A word or phrase the Speech API should expect '
+              '(repeatable; default: PHRASES).')
+@click.option('--service-account', default=SERVICE_ACCOUNT_FILE,
+              show_default=True,
+              help='Service account key in the credentials directory.')
+@click.option('--manifest', 'manifest_path', default=None, type=click.Path(),
+              help='File recording progress, for resuming (default: in '
+              'the output directory, or the cache directory).')
+@click.pass_obj
+def batch(obj, paths, output_dir, jobs, bucket, language, phrases,
+          service_account, manifest_path):
+    '''
+    Transcribe local audio files.
+
+    PATHS are audio files, or directories which are searched for audio
+    files.  Each file is transcoded, trimmed, uploaded to Cloud
+    Storage and transcribed; the transcription is written as a TXT
+    file next to the input, or under --output-dir.  Progress is kept
+    in a manifest file, so an interrupted batch can be resumed by
+    running the same command again.
+    '''
+    from .batch import run_batch
+    settings = FolderConfig('(batch)', bucket, language=language,
+                            phrases=list(phrases) or PHRASES,
+                            service_account=service_account)
+    if manifest_path is None:
+        manifest_dir = output_dir or os.path.join(APP_CACHE_DIR, 'batch')
+        mkdir_p(manifest_dir)
+        manifest_path = os.path.join(manifest_dir, 'batch_manifest.jsonl')
+    LIMITER.configure(load_api_quotas(obj['config_path'], API_QUOTAS))
+    num_failed = run_batch(paths, settings, output_dir=output_dir,
+                           num_workers=jobs, manifest_path=manifest_path)
+    if num_failed:
+        sys.exit(1)
+
+
+@main.command()
+@click.argument('names', nargs=-1, required=True)
+@click.pass_obj
+def retry(obj, names):
+    '''
+    Retry jobs which were given up on.
+
+    NAMES are the file names, or Google Drive file IDs, of the
+    recordings.  Their jobs carry on from the state they failed in
+    when the daemon is next started.
+    '''
+    jobs = JobStore(obj['jobs_path'])
+    for name in names:
+        job_records = jobs.find(name) or [
+            job_record for job_record in [jobs.get(name)]
+            if job_record is not None]
+        if not job_records:
+            logger.error('No job for %s', name)
+        for job_record in job_records:
+            if job_record.failed is None:
+                logger.info('Job %s (%s) has not failed', job_record.name,
+                            job_record.drive_id)
+                continue
+            job_record.failed = None
+            job_record.attempts = 0
+            job_record.last_error = None
+            jobs.save(job_record)
+            logger.info('Job %s (%s) will be retried from state %s',
+                        job_record.name, job_record.drive_id,
+                        job_record.state)
 
 
 if __name__ == '__main__':
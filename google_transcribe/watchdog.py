@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+watchdog.py
+
+Deadlines for poll loop ticks and subprocesses, so that one hung
+request or program cannot freeze the daemon.
+'''
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from .tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimeout(Exception):
+    '''Raised when a tick or a subprocess runs past its deadline.'''
+    pass
+
+
+def run_subprocess(args, timeout_secs=None, poll_secs=0.1, stdout=None):
+    '''
+    Runs the command `args` and waits for it to finish, killing it if
+    it runs longer than `timeout_secs`.  The process is also killed if
+    waiting is interrupted (e.g., by the `Watchdog`).  Returns the
+    exit status.
+
+    Arguments:
+    - `args`: the command, as a list
+    - `timeout_secs`: the deadline in seconds, or None to wait
+      indefinitely
+    - `poll_secs`: how often to check whether the process has exited
+    - `stdout`: a file object to receive the process's output (a
+      real file, not a pipe, which could fill up while waiting)
+    '''
+    with TRACER.span(os.path.basename(args[0]), 'subprocess') as span:
+        process = subprocess.Popen(args, stdout=stdout)
+        deadline = (None if timeout_secs is None else
+                    time.time() + timeout_secs)
+        try:
+            while process.poll() is None:
+                if deadline is not None and time.time() > deadline:
+                    raise StageTimeout('{} took longer than {} secs'.format(
+                        args[0], timeout_secs))
+                time.sleep(poll_secs)
+        finally:
+            if process.returncode is None:
+                logger.warning('Killing %s', args[0])
+                process.kill()
+                process.wait()
+        span.set(status=process.returncode)
+    return process.returncode
+
+
+class Watchdog(object):
+    '''
+    Enforces a time budget on each tick of the polling loop.
+
+    Before a tick, the action's budget (see `LoopAction.tick_budget`)
+    is armed as a SIGALRM timer.  If the tick is still running when
+    the timer fires, a `StageTimeout` is raised inside it, which
+    aborts whatever the tick was blocked on; the action is then told
+    (see `LoopAction.stalled`) so that it can schedule a retry, and
+    the polling loop carries on.  Timers can only be used on the main
+    thread; elsewhere, ticks run without a budget.
+
+    Any other exception raised by a tick (e.g., an OSError from a
+    full disk) is handed to the action likewise (see
+    `LoopAction.tick_failed`), rather than stopping the polling loop.
+    '''
+
+    def __init__(self, tick=None):
+        '''
+        Constructor.
+
+        Arguments:
+        - `tick`: the function used to tick an action (e.g.,
+          `LoopProfiler.time_tick`); defaults to `action.tick()`
+        '''
+        self.tick_fn = tick or (lambda action: action.tick())
+        self.num_stalls = 0
+        self.num_errors = 0
+
+    @staticmethod
+    def _handle_alarm(_signum, _frame):
+        raise StageTimeout('tick ran past its deadline')
+
+    @contextmanager
+    def deadline(self, budget_secs):
+        '''
+        Context manager which raises `StageTimeout` in the block if it
+        runs longer than `budget_secs`.
+
+        Arguments:
+        - `budget_secs`: the deadline in seconds, or None for no
+          deadline
+        '''
+        if (budget_secs is None or not hasattr(signal, 'setitimer') or
+                threading.current_thread().name != 'MainThread'):
+            yield
+            return
+        previous = signal.signal(signal.SIGALRM, self._handle_alarm)
+        signal.setitimer(signal.ITIMER_REAL, budget_secs)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    def tick(self, action):
+        '''
+        Ticks `action` within its time budget.  Returns the tick's
+        result, or False if the tick overran or raised an exception.
+
+        Arguments:
+        - `action`: a `LoopAction`
+        '''
+        budget_secs = action.tick_budget()
+        try:
+            with self.deadline(budget_secs):
+                return self.tick_fn(action)
+        except StageTimeout as exc:
+            self.num_stalls += 1
+            logger.error('Aborted stalled tick of %s: %s', str(action), exc)
+            action.stalled(exc)
+            return False
+        except Exception as exc:
+            self.num_errors += 1
+            logger.exception('Error in tick of %s', str(action))
+            action.tick_failed(exc)
+            return False
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_cache.py
+
+Tests of the eviction and retention of cached artifacts.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from google_transcribe.cache import (RETAIN_LRU, RETAIN_UNTIL_CONSUMED,
+                                     CacheManager)
+from google_transcribe.datastore import load_data
+
+
+class TestCacheManager(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.dir, 'index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, size):
+        '''Writes a file of `size` bytes into the cache directory.'''
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as output_file:
+            output_file.write(b'x' * size)
+        return path
+
+    def register(self, cache, name, job_name, kind, size, atime):
+        '''
+        Writes and registers an artifact last used at `atime`; it may
+        be evicted straight away.
+        '''
+        path = self.write(name, size)
+        cache.register(path, job_name, kind)
+        if path in cache:
+            cache.index[path]['atime'] = atime
+        return path
+
+    def test_evicts_least_recently_used(self):
+        cache = CacheManager(self.index_filename, budget_bytes=300)
+        old = self.register(cache, 'old.flac', 'a', 'flac', 100, 1)
+        new = self.register(cache, 'new.flac', 'b', 'flac', 100, 3)
+        mid = self.register(cache, 'mid.flac', 'c', 'flac', 100, 2)
+        latest = self.register(cache, 'latest.flac', 'd', 'flac', 100, 4)
+        # registering the fourth file evicted the oldest
+        self.assertFalse(os.path.exists(old))
+        self.assertNotIn(old, cache)
+        self.assertEqual(cache.total_bytes, 300)
+        cache.touch(mid)
+        cache.budget_bytes = 200
+        cache.enforce_budget()
+        self.assertFalse(os.path.exists(new))
+        self.assertTrue(os.path.exists(mid))
+        self.assertTrue(os.path.exists(latest))
+        self.assertEqual(cache.total_bytes, 200)
+
+    def test_needed_files_are_not_evicted(self):
+        cache = CacheManager(self.index_filename, budget_bytes=150)
+        cache.set_needed('a', ['flac'])
+        needed = self.register(cache, 'a.flac', 'a', 'flac', 100, 1)
+        other = self.register(cache, 'b.flac', 'b', 'flac', 100, 2)
+        self.assertTrue(os.path.exists(needed))
+        self.assertFalse(os.path.exists(other))
+        # over budget, but everything left is needed
+        cache.set_needed('a', ['flac', 'wav'])
+        wav = self.register(cache, 'a.wav', 'a', 'wav', 100, 3)
+        self.assertTrue(os.path.exists(needed))
+        self.assertTrue(os.path.exists(wav))
+        self.assertEqual(cache.total_bytes, 200)
+
+    def test_consumed_wav_is_deleted(self):
+        cache = CacheManager(self.index_filename,
+                             retention={'wav': RETAIN_UNTIL_CONSUMED})
+        cache.set_needed('a', ['m4a', 'wav'])
+        m4a = self.register(cache, 'a.m4a', 'a', 'm4a', 10, 1)
+        wav = self.register(cache, 'a.wav', 'a', 'wav', 10, 2)
+        other_wav = self.register(cache, 'b.wav', 'b', 'wav', 10, 3)
+        cache.set_needed('a', ['flac'])
+        self.assertFalse(os.path.exists(wav))
+        self.assertNotIn(wav, cache)
+        # LRU artifacts and other jobs' files are kept
+        self.assertTrue(os.path.exists(m4a))
+        self.assertTrue(os.path.exists(other_wav))
+        self.assertEqual(cache.total_bytes, 20)
+
+    def test_needed_wav_is_kept(self):
+        cache = CacheManager(self.index_filename,
+                             retention={'wav': RETAIN_UNTIL_CONSUMED,
+                                        'flac': RETAIN_LRU})
+        cache.set_needed('a', ['wav'])
+        wav = self.register(cache, 'a.wav', 'a', 'wav', 10, 1)
+        cache.set_needed('a', ['wav', 'flac'])
+        self.assertTrue(os.path.exists(wav))
+        flac = self.register(cache, 'a.flac', 'a', 'flac', 10, 2)
+        # finishing the job only deletes the consumed kinds
+        cache.set_needed('a', [])
+        self.assertFalse(os.path.exists(wav))
+        self.assertTrue(os.path.exists(flac))
+
+    def test_flush_writes_changed_index(self):
+        cache = CacheManager(self.index_filename)
+        self.assertTrue(cache.is_new)
+        cache.flush()
+        self.assertFalse(os.path.exists(self.index_filename))
+        path = self.register(cache, 'a.flac', 'a', 'flac', 10, 1)
+        cache.flush()
+        self.assertEqual(load_data(self.index_filename)[path]['size'], 10)
+        reopened = CacheManager(self.index_filename)
+        self.assertFalse(reopened.is_new)
+        self.assertIn(path, reopened)
+        self.assertEqual(reopened.total_bytes, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
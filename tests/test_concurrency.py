@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_concurrency.py
+
+Simulations of the adaptive concurrency limits against latency curves
+like those seen by the daemon and by batch mode.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import heapq
+import math
+import random
+import unittest
+
+from google_transcribe.concurrency import AIMDLimit
+
+
+class FakeClock(object):
+    '''A clock which only moves when it is told to.'''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def speech_latency(rng, duration):
+    '''
+    Returns the latency the daemon sees for a Speech API operation on
+    `duration` seconds of audio: the operation is first polled after
+    15 seconds, and then every 10 seconds.
+    '''
+    processing = duration * rng.uniform(0.2, 0.4)
+    if processing <= 15:
+        return 15.0
+    return 15.0 + 10.0 * math.ceil((processing - 15.0) / 10.0)
+
+
+def recording_duration(rng):
+    '''Returns a duration between 20 seconds and 2 hours.'''
+    return math.exp(rng.uniform(math.log(20), math.log(2 * 60 * 60)))
+
+
+def simulate(limit, clock, latency_and_work, num_operations):
+    '''
+    Keeps `limit` saturated with operations for `num_operations`
+    operations, each taking the latency given by
+    `latency_and_work()`, which also returns the operation's work.
+    Returns the lowest capacity seen while the limit was saturated.
+    '''
+    in_flight = []
+    lowest = limit.capacity
+    for key in range(num_operations):
+        while not limit.try_acquire(key):
+            finish_time, done_key, work = heapq.heappop(in_flight)
+            clock.now = finish_time
+            limit.release(done_key, work=work)
+            lowest = min(lowest, limit.capacity)
+        latency, work = latency_and_work()
+        heapq.heappush(in_flight, (clock.now + latency, key, work))
+    for finish_time, done_key, work in sorted(in_flight):
+        clock.now = finish_time
+        limit.release(done_key, work=work)
+    return lowest
+
+
+class TestAIMDLimit(unittest.TestCase):
+
+    def test_speech_mix_does_not_collapse(self):
+        rng = random.Random(1)
+        clock = FakeClock()
+        limit = AIMDLimit('speech', initial=8, maximum=200, tolerance=3.0,
+                          holdoff_secs=60, resolution_secs=25, clock=clock,
+                          load=lambda: None)
+
+        def latency_and_work():
+            duration = recording_duration(rng)
+            return speech_latency(rng, duration), duration
+
+        lowest = simulate(limit, clock, latency_and_work, 5000)
+        self.assertGreaterEqual(lowest, 8)
+        self.assertGreater(limit.capacity, 8)
+
+    def test_jitter_does_not_lower_limit(self):
+        rng = random.Random(2)
+        clock = FakeClock()
+        limit = AIMDLimit('transcode', initial=2, maximum=8, clock=clock,
+                          load=lambda: None)
+
+        def latency_and_work():
+            return rng.uniform(1e-6, 1e-4), recording_duration(rng)
+
+        lowest = simulate(limit, clock, latency_and_work, 5000)
+        self.assertGreaterEqual(lowest, 2)
+        self.assertEqual(limit.capacity, 8)
+
+    def test_slowdown_lowers_limit(self):
+        rng = random.Random(3)
+        clock = FakeClock()
+        limit = AIMDLimit('upload', initial=16, clock=clock,
+                          load=lambda: None)
+        slowdown = [1.0]
+
+        def latency_and_work():
+            work = rng.uniform(1, 100)
+            return work * rng.uniform(0.9, 1.1) * slowdown[0], work
+
+        simulate(limit, clock, latency_and_work, 500)
+        capacity = limit.capacity
+        slowdown[0] = 5.0
+        lowest = simulate(limit, clock, latency_and_work, 200)
+        self.assertLess(lowest, capacity)
+
+    def test_failure_lowers_limit(self):
+        clock = FakeClock()
+        limit = AIMDLimit('speech', initial=8, clock=clock,
+                          load=lambda: None)
+        limit.try_acquire('a')
+        limit.release('a', ok=False)
+        self.assertEqual(limit.capacity, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_jobs.py
+
+Tests of the job store, as shared by two processes.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from google_transcribe.jobs import JobRecord, JobStore
+
+
+class TestJobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'jobs.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_records_are_kept(self):
+        jobs = JobStore(self.filename)
+        jobs.add(JobRecord('id1', 'a.m4a', folder='inbox'))
+        reopened = JobStore(self.filename)
+        self.assertEqual(len(reopened), 1)
+        record = reopened.get('id1')
+        self.assertEqual(record.name, 'a.m4a')
+        self.assertEqual(record.folder, 'inbox')
+        self.assertEqual(reopened.find('a.m4a'), [record])
+        self.assertEqual(reopened.in_state('uploaded'), [record])
+
+    def test_refresh_loads_newer_versions(self):
+        first = JobStore(self.filename)
+        second = JobStore(self.filename)
+        record = first.add(JobRecord('id1', 'a.m4a'))
+        self.assertEqual(second.refresh(), ['id1'])
+        other = second.get('id1')
+        first.set_state(record, 'downloaded')
+        first.save(record)
+        # nothing has changed since the last refresh
+        self.assertEqual(first.refresh(), [])
+        self.assertEqual(second.refresh(), [])
+        # the record is updated in place, and reindexed
+        self.assertIs(second.get('id1'), other)
+        self.assertEqual(other.state, 'downloaded')
+        self.assertEqual(second.in_state('uploaded'), [])
+        self.assertEqual(second.in_state('downloaded'), [other])
+
+    def test_refresh_keeps_local_records(self):
+        first = JobStore(self.filename)
+        second = JobStore(self.filename)
+        first.add(JobRecord('id1', 'a.m4a'))
+        second.refresh()
+        mine = second.get('id1')
+        second.set_state(mine, 'transcoded')
+        record = first.get('id1')
+        record.attempts = 3
+        first.save(record)
+        second.refresh(keep=['id1'])
+        self.assertEqual(mine.state, 'transcoded')
+        self.assertEqual(mine.attempts, 0)
+
+    def test_first_added_record_wins(self):
+        first = JobStore(self.filename)
+        second = JobStore(self.filename)
+        first.add(JobRecord('id1', 'a.m4a', local_name='a.m4a'))
+        record = second.add(JobRecord('id1', 'a.m4a',
+                                      local_name='a-id1.m4a'))
+        self.assertEqual(record.local_name, 'a.m4a')
+        self.assertEqual(len(second), 1)
+        # later saves update the row, rather than inserting one
+        record.attempts = 1
+        second.save(record)
+        first.refresh()
+        self.assertEqual(first.get('id1').attempts, 1)
+
+    def test_reload(self):
+        first = JobStore(self.filename)
+        second = JobStore(self.filename)
+        record = first.add(JobRecord('id1', 'a.m4a'))
+        second.refresh()
+        record.last_error = 'timed out'
+        first.save(record)
+        self.assertTrue(second.reload('id1'))
+        self.assertEqual(second.get('id1').last_error, 'timed out')
+        self.assertFalse(second.reload('id2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_ratelimit.py
+
+Tests of the token buckets which rate limit calls to the Google APIs.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import unittest
+
+from google_transcribe.ratelimit import RateLimiter, TokenBucket
+
+
+class FakeClock(object):
+    '''A clock which moves when it is told to, or when slept on.'''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def bucket(self, rate, burst=None):
+        return TokenBucket(rate, burst, clock=self.clock,
+                           sleep=self.clock.sleep)
+
+    def test_burst(self):
+        bucket = self.bucket(2, burst=5)
+        for _ in range(5):
+            self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0.5)
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+    def test_default_burst(self):
+        self.assertEqual(self.bucket(10).burst, 10)
+        self.assertEqual(self.bucket(0.1).burst, 1)
+
+    def test_refill(self):
+        bucket = self.bucket(2, burst=4)
+        for _ in range(4):
+            bucket.acquire()
+        self.clock.now += 1
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0.5)
+        # refilling stops at the burst size
+        self.clock.now += 100
+        for _ in range(4):
+            self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0.5)
+
+    def test_debt_is_queued(self):
+        bucket = self.bucket(1, burst=1)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 1)
+        self.assertEqual(bucket.reserve(), 2)
+        self.assertEqual(bucket.reserve(3), 5)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(
+            {'speech': {'rate': 10},
+             'speech.operations.get': {'rate': 1, 'burst': 2}},
+            clock=self.clock, sleep=self.clock.sleep)
+
+    def test_method_quota(self):
+        for _ in range(2):
+            self.assertEqual(self.limiter.acquire('speech',
+                                                  'operations.get'), 0)
+        self.assertEqual(self.limiter.acquire('speech', 'operations.get'), 1)
+        self.assertEqual(self.clock.sleeps, [1])
+
+    def test_api_quota(self):
+        for _ in range(10):
+            self.limiter.acquire('speech', 'recognize')
+        self.assertEqual(self.limiter.acquire('speech', 'recognize'), 0.1)
+
+    def test_unconfigured_api(self):
+        for _ in range(100):
+            self.assertEqual(self.limiter.acquire('drive', 'files.list'), 0)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_configure(self):
+        self.limiter.configure({'drive': {'rate': 1}})
+        self.limiter.acquire('drive', 'files.list')
+        self.assertEqual(self.limiter.acquire('drive', 'files.list'), 1)
+        self.assertEqual(self.limiter.acquire('speech', 'recognize'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_retry.py
+
+Tests of the classification of API errors, backoff, circuit breakers
+and retries.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import errno
+import socket
+import unittest
+
+from google_transcribe import retry
+from google_transcribe.retry import (CircuitBreaker, CircuitOpenError,
+                                     FatalError, RetryableError,
+                                     backoff_delay, call_with_retries,
+                                     guarded, is_api_error, is_retryable)
+
+
+class FakeClock(object):
+    '''A clock which only moves when it is told to.'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeHttpError(Exception):
+    '''Looks like a googleapiclient.errors.HttpError.'''
+
+    def __init__(self, status, content=b''):
+        super(FakeHttpError, self).__init__(status)
+        self.resp = FakeResponse(status)
+        self.content = content
+
+
+# looks like an exception from httplib2
+ServerNotFoundError = type(str('ServerNotFoundError'), (Exception,),
+                           {'__module__': 'httplib2'})
+RedirectLimit = type(str('RedirectLimit'), (Exception,),
+                     {'__module__': 'httplib2'})
+
+
+class TestClassification(unittest.TestCase):
+
+    def test_http_status(self):
+        for status in (408, 429, 500, 502, 503, 504):
+            self.assertTrue(is_retryable(FakeHttpError(status)))
+        for status in (400, 401, 404):
+            self.assertFalse(is_retryable(FakeHttpError(status)))
+        self.assertTrue(is_retryable(FakeHttpError('503')))
+
+    def test_403_reasons(self):
+        self.assertTrue(is_retryable(FakeHttpError(
+            403, b'{"reason": "userRateLimitExceeded"}')))
+        self.assertFalse(is_retryable(FakeHttpError(
+            403, b'{"reason": "insufficientPermissions"}')))
+
+    def test_connection_errors(self):
+        self.assertTrue(is_retryable(socket.timeout()))
+        self.assertTrue(is_retryable(socket.gaierror()))
+        self.assertTrue(is_retryable(
+            socket.error(errno.ECONNRESET, 'reset')))
+        self.assertTrue(is_retryable(ServerNotFoundError()))
+        self.assertFalse(is_retryable(RedirectLimit()))
+
+    def test_local_errors(self):
+        for exc in (IOError(errno.ENOENT, 'missing'),
+                    OSError(errno.ENOSPC, 'full'), ValueError()):
+            self.assertFalse(is_api_error(exc))
+            self.assertFalse(is_retryable(exc))
+        for exc in (FakeHttpError(404), socket.timeout(),
+                    OSError(errno.ECONNREFUSED, 'refused'),
+                    RedirectLimit()):
+            self.assertTrue(is_api_error(exc))
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_bounds(self):
+        for attempt, bound in ((1, 5), (2, 10), (3, 20), (20, 1800)):
+            self.assertEqual(backoff_delay(attempt, rng=lambda: 0.0),
+                             bound / 2)
+            self.assertEqual(backoff_delay(attempt, rng=lambda: 1.0),
+                             bound)
+
+    def test_max_secs(self):
+        self.assertEqual(backoff_delay(5, 1, 4, rng=lambda: 1.0), 4)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('drive', failure_threshold=3,
+                                      cooldown_secs=30,
+                                      max_cooldown_secs=100,
+                                      clock=self.clock)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        self.fail(2)
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertFalse(self.breaker.is_open)
+        self.fail(1)
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(CircuitOpenError) as context:
+            self.breaker.before_call()
+        self.assertEqual(context.exception.retry_time, 1030)
+
+    def test_half_open_trial_closes(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.breaker.before_call()
+        # only one trial call is let through
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.before_call()
+
+    def test_failed_trial_reopens_for_longer(self):
+        self.fail(3)
+        for cooldown_secs in (60, 100, 100):
+            self.clock.now = self.breaker.open_until
+            self.fail(1)
+            self.assertEqual(self.breaker.open_until,
+                             self.clock.now + cooldown_secs)
+        self.clock.now = self.breaker.open_until
+        self.breaker.before_call()
+        self.breaker.record_success()
+        # the cooldown starts again from the beginning
+        self.fail(3)
+        self.assertEqual(self.breaker.open_until, self.clock.now + 30)
+
+    def test_local_error_releases_trial(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.breaker.before_call()
+        self.breaker.record_local_error()
+        self.breaker.before_call()
+        self.assertTrue(self.breaker.is_open)
+
+
+class TestGuarded(unittest.TestCase):
+
+    def setUp(self):
+        retry.BREAKERS.clear()
+
+    def tearDown(self):
+        retry.BREAKERS.clear()
+
+    def call(self, exc):
+        @guarded('test')
+        def func():
+            raise exc
+        func()
+
+    def test_classifies_api_errors(self):
+        with self.assertRaises(RetryableError) as context:
+            self.call(FakeHttpError(503))
+        self.assertEqual(context.exception.api, 'test')
+        self.assertEqual(context.exception.cause.resp.status, 503)
+        self.assertRaises(FatalError, self.call, FakeHttpError(404))
+        self.assertRaises(RetryableError, self.call, socket.timeout())
+
+    def test_local_errors_are_unchanged(self):
+        self.assertRaises(IOError, self.call,
+                          IOError(errno.ENOENT, 'missing'))
+        self.assertRaises(ValueError, self.call, ValueError())
+        self.assertEqual(retry.get_breaker('test').failures, 0)
+
+    def test_opens_breaker(self):
+        for _ in range(5):
+            self.assertRaises(RetryableError, self.call, FakeHttpError(500))
+        self.assertRaises(CircuitOpenError, self.call, FakeHttpError(500))
+
+
+class TestCallWithRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.delays = []
+
+    def failing(self, errors, result='done'):
+        '''Returns a function which raises `errors`, then succeeds.'''
+        errors = list(errors)
+
+        def func():
+            if errors:
+                raise errors.pop(0)
+            return result
+        return func
+
+    def test_retries_until_success(self):
+        func = self.failing([RetryableError('drive', Exception())] * 3)
+        self.assertEqual(call_with_retries(func, sleep=self.delays.append),
+                         'done')
+        self.assertEqual(len(self.delays), 3)
+        for attempt, delay in enumerate(self.delays, 1):
+            bound = 5 * 2 ** (attempt - 1)
+            self.assertTrue(bound / 2 <= delay <= bound)
+
+    def test_gives_up_after_max_attempts(self):
+        func = self.failing([RetryableError('drive', Exception())] * 5)
+        self.assertRaises(RetryableError, call_with_retries, func,
+                          max_attempts=3, sleep=self.delays.append)
+        self.assertEqual(len(self.delays), 2)
+
+    def test_fatal_error_is_not_retried(self):
+        func = self.failing([FatalError('drive', Exception())])
+        self.assertRaises(FatalError, call_with_retries, func,
+                          sleep=self.delays.append)
+        self.assertEqual(self.delays, [])
+
+    def test_waits_for_open_circuit(self):
+        # a circuit which is already due to let a trial call through
+        func = self.failing([CircuitOpenError('drive', 0)] * 20)
+        self.assertEqual(call_with_retries(func, max_attempts=3,
+                                           sleep=self.delays.append),
+                         'done')
+        # open circuits do not count as attempts
+        self.assertEqual(len(self.delays), 20)
+        self.assertTrue(all(2.5 <= delay <= 5 for delay in self.delays))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_sharedstore.py
+
+Tests of the leases which daemons sharing a job store use to divide
+the work between them.
+'''
+
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from google_transcribe.sharedstore import LeaseManager
+
+
+class FakeClock(object):
+    '''A clock which only moves when it is told to.'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLeaseManager(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'jobs.db')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def leases(self, owner, **kwargs):
+        return LeaseManager(self.filename, lease_secs=60, owner=owner,
+                            clock=self.clock, **kwargs)
+
+    def test_claim_is_exclusive(self):
+        first = self.leases('first')
+        second = self.leases('second')
+        self.assertTrue(first.claim_job('a'))
+        self.assertTrue(first.holds_job('a'))
+        self.assertFalse(second.claim_job('a'))
+        self.assertFalse(second.holds_job('a'))
+        # claiming again renews the lease
+        self.assertTrue(first.claim_job('a'))
+        self.assertEqual(first.held_jobs(), set(['a']))
+
+    def test_release(self):
+        first = self.leases('first')
+        second = self.leases('second')
+        first.claim_job('a')
+        first.release_job('a')
+        self.assertFalse(first.holds_job('a'))
+        self.assertTrue(second.claim_job('a'))
+
+    def test_max_jobs(self):
+        leases = self.leases('first', max_jobs=2)
+        self.assertTrue(leases.claim_job('a'))
+        self.assertTrue(leases.claim_job('b'))
+        self.assertFalse(leases.claim_job('c'))
+        # other leases do not count against the limit
+        self.assertTrue(leases.claim('monitor:folder'))
+        self.assertTrue(leases.claim_job('a'))
+
+    def test_renew_keeps_lease(self):
+        first = self.leases('first')
+        second = self.leases('second')
+        first.claim_job('a')
+        self.clock.now += 50
+        first.renew()
+        self.clock.now += 50
+        self.assertFalse(second.claim_job('a'))
+        self.assertTrue(first.holds_job('a'))
+
+    def test_takeover_of_expired_lease(self):
+        first = self.leases('first')
+        second = self.leases('second')
+        first.claim_job('a')
+        self.clock.now += 59
+        self.assertFalse(second.claim_job('a'))
+        self.clock.now += 2
+        self.assertTrue(second.claim_job('a'))
+        self.assertTrue(second.holds_job('a'))
+
+    def test_lost_lease(self):
+        first = self.leases('first')
+        second = self.leases('second')
+        first.claim_job('a')
+        first.claim_job('b')
+        self.clock.now += 61
+        second.claim_job('a')
+        first.renew()
+        self.assertEqual(first.held_jobs(), set(['b']))
+        self.assertEqual(second.held_jobs(), set(['a']))
+        # the renewed lease is still held
+        self.clock.now += 59
+        self.assertFalse(second.claim_job('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()